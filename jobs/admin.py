@@ -0,0 +1,12 @@
+from django.contrib import admin
+
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'status', 'processed', 'total', 'attempts',
+                    'worker', 'created_at', 'finished_at')
+    list_filter = ('status', 'name')
+    ordering = ('-id',)
+    raw_id_fields = ('user',)
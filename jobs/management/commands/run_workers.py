@@ -0,0 +1,53 @@
+import multiprocessing
+import signal
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def work(stop, poll_interval, burst):
+    # the parent handles Ctrl-C and tells every worker to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # a no-op in forked workers, spawned ones start from scratch
+    django.setup()
+    from jobs.queue import run_worker
+    try:
+        run_worker(stop.is_set, poll_interval, burst)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Run a pool of worker processes for the jobs queued in the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.JOBS_WORKERS,
+                            help='Number of worker processes.')
+        parser.add_argument('--poll-interval', type=float, default=settings.JOBS_POLL_INTERVAL,
+                            help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--burst', action='store_true',
+                            help='Exit once the queue is empty.')
+
+    def handle(self, *args, **options):
+        stop = multiprocessing.Event()
+        # workers must open their own connections
+        connections.close_all()
+        workers = [
+            multiprocessing.Process(target=work, name='jobs-worker-%d' % i,
+                                    args=(stop, options['poll_interval'], options['burst']))
+            for i in range(options['processes'])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write('Started %d workers' % len(workers))
+
+        def shutdown(signum, frame):
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        for worker in workers:
+            worker.join()
+        self.stdout.write('Workers stopped')
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+
+class Job(models.Model):
+    """
+    A task call waiting for, or run by, the workers of `manage.py run_workers`.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = ((PENDING, _('pending')), (RUNNING, _('running')),
+                (DONE, _('done')), (FAILED, _('failed')))
+
+    name = models.CharField(max_length=100)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    processed = models.IntegerField(default=0)
+    total = models.IntegerField(default=0)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.IntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True,
+                             on_delete=models.SET_NULL, related_name='+')
+    organization_id = models.IntegerField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'id'])]
+
+    def __str__(self):
+        return '%s #%s (%s)' % (self.name, self.pk, self.status)
+
+    @property
+    def progress(self):
+        if self.status == self.DONE:
+            return 1.0
+        return min(self.processed / self.total, 1.0) if self.total else 0.0
+
+    def report(self, processed, total=None):
+        """
+        Save the progress of the running task, also a heartbeat for
+        `requeue_stale`.
+        """
+        self.processed = processed
+        self.total = self.total if total is None else total
+        self.heartbeat_at = timezone.now()
+        Job.objects.filter(pk=self.pk).update(
+            processed=self.processed, total=self.total, heartbeat_at=self.heartbeat_at)
@@ -0,0 +1,180 @@
+"""
+Task queue stored in the project database.
+
+Functions registered with `task` are queued with `enqueue`, in the
+transaction of the caller, and run by the workers of `manage.py run_workers`.
+Workers claim pending jobs with SELECT ... FOR UPDATE SKIP LOCKED where the
+database supports it. SQLite serializes writes, so there a job is claimed by
+a conditional UPDATE of its status instead.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# pending jobs tried per claim when SKIP LOCKED isn't available
+CLAIM_CANDIDATES = 10
+
+registry = {}
+
+
+def task(name):
+    """
+    Register the decorated function as task `name`. It's called with the
+    running `Job` and the keyword arguments given to `enqueue`.
+    """
+    def decorator(func):
+        registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, user=None, organization_id=None, total=0, **kwargs):
+    """
+    Queue a call of task `name` with JSON serializable `kwargs`, returns the
+    `Job`. `user` and `organization_id` scope who can see the job.
+    """
+    if name not in registry:
+        raise KeyError('Unknown task %s' % name)
+    return Job.objects.create(name=name, kwargs=kwargs, total=total,
+                              user=user if user and user.is_authenticated else None,
+                              organization_id=organization_id)
+
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def claim(worker=None):
+    """
+    Mark the oldest pending job as running and return it, None if the queue
+    is empty.
+    """
+    now = timezone.now()
+    claimed = {'status': Job.RUNNING, 'worker': worker or worker_name(),
+               'attempts': F('attempts') + 1, 'started_at': now, 'heartbeat_at': now}
+    pending = Job.objects.filter(status=Job.PENDING).order_by('id')
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = pending.select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            Job.objects.filter(pk=job.pk).update(**claimed)
+    else:
+        for pk in pending.values_list('pk', flat=True)[:CLAIM_CANDIDATES]:
+            if Job.objects.filter(pk=pk, status=Job.PENDING).update(**claimed):
+                break
+        else:
+            return None
+        job = Job(pk=pk)
+    job.refresh_from_db()
+    return job
+
+
+class Heartbeat(threading.Thread):
+    """
+    Refreshes the heartbeat of a claimed job every `interval` seconds while
+    its task runs, so `requeue_stale` doesn't hand a long task that reports
+    no progress to a second worker. Only lost workers stop beating.
+    """
+
+    def __init__(self, job, interval=None):
+        super().__init__(name='heartbeat-%s' % job.pk, daemon=True)
+        self.job = job
+        self.interval = settings.JOBS_STALE_SECONDS / 3 if interval is None else interval
+        self.stopped = threading.Event()
+
+    def beat(self):
+        Job.objects.filter(pk=self.job.pk, status=Job.RUNNING, worker=self.job.worker).update(
+            heartbeat_at=timezone.now())
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                self.beat()
+        finally:
+            # the connection of this thread
+            connection.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.join()
+
+
+def execute(job):
+    """
+    Run a claimed job and save its result or error.
+    """
+    try:
+        with Heartbeat(job):
+            result = registry[job.name](job, **job.kwargs)
+    except Exception as e:
+        logger.exception('Job %s failed', job)
+        job.status = Job.FAILED
+        job.error = '%s: %s' % (type(e).__name__, e)
+    else:
+        job.status = Job.DONE
+        job.result = result
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'finished_at'])
+    return job
+
+
+def run_next(worker=None):
+    """
+    Claim and run one job, returns it or None if the queue is empty.
+    """
+    job = claim(worker)
+    return execute(job) if job is not None else None
+
+
+def requeue_stale():
+    """
+    Put back in the queue the jobs of workers that stopped beating for
+    `JOBS_STALE_SECONDS`, jobs out of attempts fail. Tasks must be safe to
+    run again.
+    """
+    stale = timezone.now() - timezone.timedelta(seconds=settings.JOBS_STALE_SECONDS)
+    running = Job.objects.filter(status=Job.RUNNING, heartbeat_at__lt=stale)
+    failed = running.filter(attempts__gte=settings.JOBS_MAX_ATTEMPTS).update(
+        status=Job.FAILED, error='Worker lost', finished_at=timezone.now())
+    requeued = running.update(status=Job.PENDING, worker='')
+    return requeued, failed
+
+
+def run_worker(should_stop=lambda: False, poll_interval=None, burst=False):
+    """
+    Run jobs until `should_stop` returns True, or the queue is empty with
+    `burst`. Returns the number of jobs run.
+    """
+    poll_interval = settings.JOBS_POLL_INTERVAL if poll_interval is None else poll_interval
+    worker = worker_name()
+    count = 0
+    last_requeue = 0
+    while not should_stop():
+        if time.monotonic() - last_requeue > settings.JOBS_STALE_SECONDS:
+            requeue_stale()
+            last_requeue = time.monotonic()
+        if run_next(worker) is not None:
+            count += 1
+        elif burst:
+            break
+        else:
+            time.sleep(poll_interval)
+    return count
@@ -0,0 +1,12 @@
+from rest_framework import serializers
+
+from .models import Job
+
+
+class JobSerializer(serializers.ModelSerializer):
+    progress = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = Job
+        fields = ('id', 'name', 'status', 'processed', 'total', 'progress',
+                  'result', 'error', 'created_at', 'started_at', 'finished_at')
@@ -0,0 +1,171 @@
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.constants import ADMIN, VIEWER
+from users.jobs import schedule_organization_delete
+from users.models import User, Organization
+
+from .models import Job
+from .queue import Heartbeat, claim, enqueue, registry, requeue_stale, run_next, run_worker, task
+from .views import accepted
+
+
+@task('jobs.tests.add')
+def add(job, a, b):
+    job.report(1, 1)
+    return a + b
+
+
+@task('jobs.tests.fail')
+def fail(job):
+    raise ValueError('boom')
+
+
+@task('jobs.tests.sleep')
+def sleep(job, seconds):
+    time.sleep(seconds)
+
+
+class QueueTests(TestCase):
+
+    def test_run_jobs(self):
+        """
+        Jobs run oldest first, saving their result, progress or error
+        """
+        first = enqueue('jobs.tests.add', a=1, b=2)
+        second = enqueue('jobs.tests.fail')
+        with self.assertRaises(KeyError):
+            enqueue('jobs.tests.unknown')
+
+        job = run_next('test')
+        self.assertEqual((job.pk, job.status, job.result), (first.pk, Job.DONE, 3))
+        first.refresh_from_db()
+        self.assertEqual((first.processed, first.total, first.progress, first.attempts),
+                         (1, 1, 1.0, 1))
+        self.assertEqual(first.worker, 'test')
+
+        with self.assertLogs('jobs.queue', 'ERROR'):
+            job = run_next()
+        self.assertEqual((job.pk, job.status, job.error), (second.pk, Job.FAILED, 'ValueError: boom'))
+        self.assertIsNone(run_next())
+
+    def test_claim(self):
+        """
+        A job is claimed once, with SKIP LOCKED or the conditional update
+        """
+        for skip_locked in (True, False):
+            with mock.patch.object(connection.features, 'has_select_for_update_skip_locked', skip_locked):
+                job = enqueue('jobs.tests.add', a=1, b=1)
+                self.assertEqual(claim().pk, job.pk)
+                self.assertIsNone(claim())
+
+    def test_requeue_stale(self):
+        """
+        Jobs of lost workers go back to the queue until out of attempts
+        """
+        job = enqueue('jobs.tests.add', a=1, b=1)
+        claim()
+        Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(requeue_stale(), (1, 0))
+        self.assertEqual(run_worker(burst=True), 1)
+
+        job = enqueue('jobs.tests.add', a=1, b=1)
+        claim()
+        Job.objects.filter(pk=job.pk).update(attempts=3, heartbeat_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(requeue_stale(), (0, 1))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+
+    def test_heartbeat(self):
+        """
+        Running jobs keep beating without reporting progress, only while
+        claimed by their worker
+        """
+        job = enqueue('jobs.tests.sleep', seconds=0.1)
+        with mock.patch.object(Heartbeat, 'beat') as beat, \
+                self.settings(JOBS_STALE_SECONDS=0.03):
+            run_next()
+        self.assertTrue(beat.called)
+
+        job = enqueue('jobs.tests.add', a=1, b=1)
+        claim('test')
+        Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        Heartbeat(Job.objects.get(pk=job.pk)).beat()
+        self.assertEqual(requeue_stale(), (0, 0))
+        Job.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        Heartbeat(Job(pk=job.pk, worker='other')).beat()
+        self.assertEqual(requeue_stale(), (1, 0))
+
+    def test_registry(self):
+        self.assertIn('users.organization_job', registry)
+
+
+class JobAPITests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.organization = Organization.objects.create(name='AAAIMX')
+        cls.admin = User.objects.create_user('admin@test.org', organization=cls.organization)
+        cls.admin.groups.add(Group.objects.get(name=ADMIN))
+        cls.user = User.objects.create_user('user@test.org', organization=cls.organization)
+
+    def authenticate(self, user):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(user))
+
+    def test_job_status(self):
+        """
+        Queued work is answered with 202 and the job, whose status runs
+        through GET /api/jobs/{id}/
+        """
+        job = schedule_organization_delete(self.organization, user=self.admin).task
+        request = Request(APIRequestFactory().delete('/'))
+        response = accepted(request, job)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_url = response['Location']
+        self.assertEqual(response.data['status'], Job.PENDING)
+        self.assertEqual(response.data['total'], 2)
+        self.assertTrue(Organization.objects.filter(pk=self.organization.pk).exists())
+
+        # only its creator and the organization administrators see the job
+        self.authenticate(self.user)
+        self.assertEqual(self.client.get(job_url).status_code, status.HTTP_404_NOT_FOUND)
+
+        run_next()
+        self.authenticate(self.admin)
+        data = self.client.get(job_url).json()
+        self.assertEqual((data['status'], data['processed'], data['progress']), (Job.DONE, 2, 1.0))
+        self.assertFalse(Organization.objects.filter(pk=self.organization.pk).exists())
+
+    def test_assign_groups(self):
+        """
+        POST /api/users/groups/ queues the group changes and answers 202
+        """
+        viewer = Group.objects.get(name=VIEWER)
+        other = User.objects.create_user('other@test.org', organization=Organization.objects.create(name='LHT'))
+        self.authenticate(self.user)
+        data = {'users': [self.user.pk], 'groups': [viewer.pk]}
+        self.assertEqual(self.client.post('/api/users/groups/', data, format='json').status_code,
+                         status.HTTP_403_FORBIDDEN)
+
+        self.authenticate(self.admin)
+        response = self.client.post('/api/users/groups/', {'users': [other.pk], 'groups': [viewer.pk]},
+                                    format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/api/users/groups/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(self.user.groups.exists())
+
+        run_next()
+        data = self.client.get(response['Location']).json()
+        self.assertEqual((data['status'], data['processed'], data['total']), (Job.DONE, 1, 1))
+        self.assertEqual(list(self.user.groups.all()), [viewer])
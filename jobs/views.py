@@ -0,0 +1,33 @@
+from django.db.models import Q
+from rest_framework import mixins, status, viewsets
+from rest_framework.response import Response
+from rest_framework.reverse import reverse
+
+from users.permissions import is_admin
+
+from .models import Job
+from .serializers import JobSerializer
+
+
+def accepted(request, job):
+    """
+    202 response for work queued as `job`, pointing to its status.
+    """
+    return Response(JobSerializer(job).data, status=status.HTTP_202_ACCEPTED,
+                    headers={'Location': reverse('job-detail', args=[job.pk], request=request)})
+
+
+class JobViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    GET /api/jobs/{id}/ status and progress of a queued job, visible to
+    the user who queued it and the `Administrator` of its organization.
+    """
+    serializer_class = JobSerializer
+    queryset = Job.objects.all()
+
+    def get_queryset(self):
+        user = self.request.user
+        visible = Q(user_id=user.id)
+        if user.organization_id is not None and is_admin(user):
+            visible |= Q(organization_id=user.organization_id)
+        return Job.objects.filter(visible)
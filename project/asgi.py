@@ -13,4 +13,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# load process local caches before serving the first request
+from users.events import EventStreamApp  # noqa: E402
+from users.registry import group_registry  # noqa: E402
+
+# organization event streams are served here, Django 3.1 can't stream async responses
+application = EventStreamApp(django_application)
+
+group_registry.warm_up()
@@ -0,0 +1,241 @@
+"""
+API response compression.
+
+`CompressionMiddleware` compresses the responses under `COMPRESSION_PREFIX`
+with the encoding of `COMPRESSION_ENCODINGS` the client prefers in its
+Accept-Encoding, the order of the setting breaking ties. Bodies under
+`COMPRESSION_MIN_SIZE` bytes, already encoded or of a compressed media type
+are sent as they are. Streaming responses are compressed chunk by chunk and
+flushed, so clients still get every chunk as soon as it is produced.
+
+Responses of `COMPRESSION_EXCLUDE_PATHS`, which carry secrets like tokens,
+are never compressed: compressed lengths of a secret sent along with text
+the attacker controls leak it (BREACH).
+
+gzip is always available, `br` needs the Brotli package and `zstd` the
+zstandard one, encodings whose package is missing are skipped.
+"""
+
+import gzip
+import logging
+import re
+import time
+import zlib
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.cache import patch_vary_headers
+
+from .metrics import get_request_metrics
+
+logger = logging.getLogger(__name__)
+
+# media types not worth compressing again
+COMPRESSED_TYPES = (
+    'image/', 'video/', 'audio/', 'font/woff', 'application/zip',
+    'application/gzip', 'application/x-gzip', 'application/zstd',
+    'application/octet-stream',
+)
+
+ACCEPT_ENCODING_RE = re.compile(r'^\s*([^\s;,]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$')
+
+
+class GzipCodec:
+    name = 'gzip'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return gzip.compress(data, self.level, mtime=0)
+
+    def stream(self, chunks):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+class BrotliCodec:
+    name = 'br'
+
+    def __init__(self, level):
+        import brotli
+        self._brotli = brotli
+        self.level = level
+
+    def compress(self, data):
+        return self._brotli.compress(data, quality=self.level)
+
+    def stream(self, chunks):
+        compressor = self._brotli.Compressor(quality=self.level)
+        for chunk in chunks:
+            yield compressor.process(chunk) + compressor.flush()
+        yield compressor.finish()
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    def __init__(self, level):
+        import zstandard
+        self._zstd = zstandard
+        self.level = level
+
+    # compressors aren't thread safe, one per body
+    def compress(self, data):
+        return self._zstd.ZstdCompressor(level=self.level).compress(data)
+
+    def stream(self, chunks):
+        compressor = self._zstd.ZstdCompressor(level=self.level).compressobj()
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(self._zstd.COMPRESSOBJ_FLUSH_BLOCK)
+        yield compressor.flush()
+
+
+CODECS = {codec.name: codec for codec in (GzipCodec, BrotliCodec, ZstdCodec)}
+
+
+@lru_cache(maxsize=None)
+def get_codecs():
+    """
+    The available codecs of `COMPRESSION_ENCODINGS`, by encoding name in
+    order of preference.
+    """
+    codecs = {}
+    for name, level in settings.COMPRESSION_ENCODINGS.items():
+        try:
+            codecs[name] = CODECS[name](level)
+        except ImportError:
+            logger.warning('%s compression is disabled, its package is not installed', name)
+    return codecs
+
+
+@receiver(setting_changed)
+def reset_codecs(setting, **kwargs):
+    if setting == 'COMPRESSION_ENCODINGS':
+        get_codecs.cache_clear()
+
+
+def parse_accept_encoding(header):
+    """
+    Return the quality by coding of an Accept-Encoding header.
+    """
+    qualities = {}
+    for item in header.split(','):
+        match = ACCEPT_ENCODING_RE.match(item)
+        if match is None:
+            continue
+        coding, quality = match.groups()
+        try:
+            qualities[coding.lower()] = float(quality) if quality is not None else 1.0
+        except ValueError:
+            continue
+    return qualities
+
+
+def choose_codec(header):
+    """
+    The preferred codec accepted by an Accept-Encoding header, or None.
+    """
+    qualities = parse_accept_encoding(header or '')
+    best, best_quality = None, 0
+    for name, codec in get_codecs().items():
+        quality = qualities.get(name, qualities.get('*', 0))
+        if quality > best_quality:
+            best, best_quality = codec, quality
+    return best
+
+
+@lru_cache(maxsize=None)
+def get_excluded_paths():
+    return re.compile('|'.join(settings.COMPRESSION_EXCLUDE_PATHS) or r'(?!)')
+
+
+@receiver(setting_changed)
+def reset_excluded_paths(setting, **kwargs):
+    if setting == 'COMPRESSION_EXCLUDE_PATHS':
+        get_excluded_paths.cache_clear()
+
+
+def timed_stream(codec, chunks, metrics):
+    """
+    Compress `chunks` with `codec`, adding to the request `metrics` the time
+    spent compressing, out of the time producing the chunks.
+    """
+    produced = 0
+
+    def produce():
+        nonlocal produced
+        chunks_iter = iter(chunks)
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks_iter)
+            except StopIteration:
+                return
+            finally:
+                produced += time.perf_counter() - start
+            yield chunk
+
+    compressed = codec.stream(produce())
+    while True:
+        start, before = time.perf_counter(), produced
+        try:
+            chunk = next(compressed)
+        except StopIteration:
+            return
+        finally:
+            metrics.compress_time += time.perf_counter() - start - (produced - before)
+        yield chunk
+
+
+def is_compressible(response):
+    if response.has_header('Content-Encoding'):
+        return False
+    content_type = response.get('Content-Type', '').lower()
+    return not content_type.startswith(COMPRESSED_TYPES)
+
+
+class CompressionMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if not request.path.startswith(settings.COMPRESSION_PREFIX) or \
+                get_excluded_paths().match(request.path) or not is_compressible(response):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        codec = choose_codec(request.META.get('HTTP_ACCEPT_ENCODING'))
+        if codec is None:
+            return response
+
+        metrics = get_request_metrics()
+        if response.streaming:
+            chunks = response.streaming_content
+            response.streaming_content = codec.stream(chunks) if metrics is None else \
+                timed_stream(codec, chunks, metrics)
+            del response['Content-Length']
+        else:
+            start = time.perf_counter()
+            compressed = codec.compress(response.content)
+            if metrics is not None:
+                metrics.compress_time += time.perf_counter() - start
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        # the encoded body isn't byte for byte the entity of a strong ETag
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = codec.name
+        return response
@@ -17,7 +17,9 @@ THIRD_PARTY_APPS = (
 )
 
 LOCAL_APPS = (
-    'users',
+    'users.apps.UsersConfig',
+    'jobs.apps.JobsConfig',
+    'querylog.apps.QuerylogConfig',
 )
 
 INSTALLED_APPS = DJANGO_APPS + LOCAL_APPS + THIRD_PARTY_APPS
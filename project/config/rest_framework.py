@@ -1,5 +1,6 @@
 
 import datetime
+import os
 
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
@@ -12,15 +13,52 @@ REST_FRAMEWORK = {
         "rest_framework.filters.OrderingFilter",
         "rest_framework.filters.SearchFilter",
     ],
+    # tokens first, API calls carrying one never load a session. Requests
+    # without a token, from the admin and the browsable API, use the session.
     "DEFAULT_AUTHENTICATION_CLASSES": (
+        # simplejwt authentication loading users from their shard
+        "users.sharding.JWTAuthentication",
         "rest_framework.authentication.SessionAuthentication",
         "rest_framework.authentication.BasicAuthentication",
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
     ),
+    "DEFAULT_RENDERER_CLASSES": (
+        "project.renderers.JSONRenderer",
+        "project.renderers.MessagePackRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
+    "DEFAULT_PARSER_CLASSES": (
+        "rest_framework.parsers.JSONParser",
+        "project.parsers.MessagePackParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ),
+    "DEFAULT_THROTTLE_CLASSES": [
+        "project.throttling.TokenBucketThrottle",
+    ],
+    # proxies trusted to set X-Forwarded-For, with none client IPs of the
+    # throttles are the REMOTE_ADDR and can't be spoofed
+    'NUM_PROXIES': int(os.environ.get('NUM_PROXIES', 0)),
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.LimitOffsetPagination",
     "PAGE_SIZE": 10,
-    'TEST_REQUEST_DEFAULT_FORMAT': 'json'
+    'TEST_REQUEST_DEFAULT_FORMAT': 'json',
+    'TEST_REQUEST_RENDERER_CLASSES': (
+        "rest_framework.renderers.MultiPartRenderer",
+        "rest_framework.renderers.JSONRenderer",
+        "project.renderers.MessagePackRenderer",
+    ),
+}
+
+# Token bucket throttling, see project/throttling.py
+# Rates refill the bucket of each dimension and also bound its bursts
+
+THROTTLE_BUCKETS = {
+    'login': {'ip': '30/min', 'email': '10/min'},
+    'write': {'user': '60/min', 'org': '600/min', 'ip': '300/min'},
+    'read': {'user': '600/min', 'org': '6000/min', 'ip': '3000/min'},
 }
+# LocalBucketStore, SharedMemoryBucketStore or CacheBucketStore
+THROTTLE_STORE = 'project.throttling.LocalBucketStore'
+THROTTLE_STORE_OPTIONS = {}
 
 # Simple JWT
 # https://django-rest-framework-simplejwt.readthedocs.io/en/latest/getting_started.html
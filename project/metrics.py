@@ -0,0 +1,200 @@
+"""
+Per-view request metrics.
+
+`MetricsMiddleware` records the number of queries, database time,
+serialization (serializer `data` and rendering) time, compression time and
+total time of every DRF view into process local histograms, exposed in
+Prometheus text format by `project.views.MetricsAPIView`. Streaming responses
+are recorded once their body is sent.
+Requests over `METRICS_QUERY_BUDGET` queries are logged as warnings to catch
+N+1 regressions, and queries over `SLOW_QUERY_MS` go to the slow query log.
+"""
+
+import logging
+import threading
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+METRICS = (
+    ('api_request_duration_seconds', 'Total request time.', DURATION_BUCKETS),
+    ('api_db_duration_seconds', 'Database time per request.', DURATION_BUCKETS),
+    ('api_serialize_duration_seconds', 'Serializer and rendering time per request.', DURATION_BUCKETS),
+    ('api_compress_duration_seconds', 'Response compression time per request.', DURATION_BUCKETS),
+    ('api_db_queries', 'Database queries per request.', QUERY_BUCKETS),
+)
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+        yield '+Inf', self.count
+
+
+class MetricsRegistry:
+    """
+    Histograms by metric name and view, shared by the threads of a process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def observe(self, view, values):
+        with self._lock:
+            for name, _, buckets in METRICS:
+                key = (name, view)
+                if key not in self._histograms:
+                    self._histograms[key] = Histogram(buckets)
+                self._histograms[key].observe(values[name])
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, description, _ in METRICS:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s histogram' % name)
+                for (metric, view), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        lines.append('%s_bucket{view="%s",le="%s"} %d' %
+                                     (name, view, bound, count))
+                    lines.append('%s_sum{view="%s"} %s' % (name, view, histogram.sum))
+                    lines.append('%s_count{view="%s"} %d' % (name, view, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class RequestMetrics:
+    """
+    Counters of the request being served, also a database execute wrapper.
+    """
+
+    def __init__(self):
+        self.view = None
+        self.queries = 0
+        self.db_time = 0
+        self.serialize_time = 0
+        self.compress_time = 0
+        # (alias, sql, params, seconds) of the queries over the threshold
+        self.slow_queries = []
+        self.slow_threshold = settings.SLOW_QUERY_MS / 1000
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.db_time += duration
+            self.queries += 1
+            if duration >= self.slow_threshold and not many:
+                self.slow_queries.append((context['connection'].alias, sql, params, duration))
+
+
+def get_request_metrics():
+    return _current.get()
+
+
+def get_view_name(request, view_func):
+    """
+    Return `ViewClass.action` for DRF views, None for any other view.
+    """
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return None
+    actions = getattr(view_func, 'actions', None) or {}
+    action = actions.get(request.method.lower(), request.method.lower())
+    return '%s.%s' % (cls.__name__, action)
+
+
+class MetricsMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        if response.streaming:
+            # streamed bodies are rendered and compressed as they are sent
+            response.streaming_content = self.record_after(
+                response.streaming_content, request, metrics, start)
+        else:
+            self.record(request, metrics, time.perf_counter() - start)
+        return response
+
+    def record_after(self, chunks, request, metrics, start):
+        try:
+            yield from chunks
+        finally:
+            self.record(request, metrics, time.perf_counter() - start)
+
+    def record(self, request, metrics, total):
+        if metrics.view is not None:
+            registry.observe(metrics.view, {
+                'api_request_duration_seconds': total,
+                'api_db_duration_seconds': metrics.db_time,
+                'api_serialize_duration_seconds': metrics.serialize_time,
+                'api_compress_duration_seconds': metrics.compress_time,
+                'api_db_queries': metrics.queries,
+            })
+            budget = getattr(settings, 'METRICS_QUERY_BUDGET', 30)
+            if metrics.queries > budget:
+                logger.warning('%s %s ran %d queries (budget %d) in %.3fs',
+                               metrics.view, request.get_full_path(),
+                               metrics.queries, budget, total)
+        if metrics.slow_queries:
+            from querylog.recorder import record
+            try:
+                record(metrics.view, metrics.slow_queries)
+            except DatabaseError:
+                logger.exception('Could not record the slow queries of %s', metrics.view)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = get_request_metrics()
+        if metrics is not None:
+            metrics.view = get_view_name(request, view_func)
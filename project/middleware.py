@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.contrib.auth import middleware as auth
+from django.contrib.messages import middleware as messages
+from django.contrib.sessions import middleware as sessions
+from django.db import OperationalError
+from django.middleware import clickjacking, csrf
+from rest_framework.permissions import SAFE_METHODS
+
+from .routers import bind_state, unbind_state, get_state, pin_user, replica_health
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Binds the routing state of the request for `ReplicaRouter`, pins users to
+    the primary after their writes and marks a replica down when a request
+    served from it fails with a database error.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = bind_state(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            unbind_state(token)
+
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and \
+                user is not None and user.is_authenticated:
+            pin_user(user, response)
+        return response
+
+    def process_exception(self, request, exception):
+        state = get_state()
+        if isinstance(exception, OperationalError) and state:
+            for replica in filter(None, state.replicas.values()):
+                replica_health.mark_down(replica)
+
+
+def is_token_api_request(request):
+    """
+    Token authenticated API calls never use sessions, messages or CSRF. The
+    token authentication comes first, a session cookie sent along is unused.
+    """
+    prefix = getattr(settings, 'LEAN_API_PREFIX', '/api/')
+    return request.path_info.startswith(prefix) and \
+        request.META.get('HTTP_AUTHORIZATION', '').startswith('Bearer ')
+
+
+class LeanAPIMixin:
+    """
+    Skips the wrapped middleware for token authenticated API calls, admin and
+    browsable API requests keep the full stack.
+    """
+
+    def __call__(self, request):
+        if is_token_api_request(request):
+            return self.get_response(request)
+        return super().__call__(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        parent = getattr(super(), 'process_view', None)
+        if parent is None or is_token_api_request(request):
+            return None
+        return parent(request, view_func, view_args, view_kwargs)
+
+
+class SessionMiddleware(LeanAPIMixin, sessions.SessionMiddleware):
+    pass
+
+
+class CsrfViewMiddleware(LeanAPIMixin, csrf.CsrfViewMiddleware):
+    pass
+
+
+class AuthenticationMiddleware(LeanAPIMixin, auth.AuthenticationMiddleware):
+    pass
+
+
+class MessageMiddleware(LeanAPIMixin, messages.MessageMiddleware):
+    pass
+
+
+class XFrameOptionsMiddleware(LeanAPIMixin, clickjacking.XFrameOptionsMiddleware):
+    pass
@@ -0,0 +1,189 @@
+"""
+Profiling of single API requests.
+
+Views with `ProfilingMixin` profile requests of staff users sending
+`X-Profile: inline` or `?_profile=1`, returning the report in place of the
+response, or `X-Profile: store` / `?_profile=store`, saving it under
+`PROFILE_DIR` for `/api/profiles/{id}/`. `PROFILE_SAMPLE_RATE` of every
+other request is profiled and stored as well. Only the `PROFILE_MAX_FILES`
+newest profiles are kept.
+
+Reports hold the cProfile top functions, the SQL queries with their time,
+and the time spent in serializers and rendering.
+"""
+
+import cProfile
+import json
+import pstats
+import random
+import re
+import time
+import uuid
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.http import JsonResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+INLINE = 'inline'
+STORE = 'store'
+PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def get_profile_mode(request):
+    """
+    Return the profiling mode asked by `request`, None when not profiled.
+    """
+    asked = request.META.get('HTTP_X_PROFILE') or request.query_params.get('_profile')
+    if asked and request.user.is_staff:
+        return STORE if asked == STORE else INLINE
+    if random.random() < settings.PROFILE_SAMPLE_RATE:
+        return STORE
+    return None
+
+
+class RequestProfile:
+    """
+    Collects the profile of the request from `start` to `finish`.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.id = uuid.uuid4().hex
+        self.queries = []
+        self.profiler = cProfile.Profile()
+        self._wrappers = ExitStack()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({'sql': sql, 'ms': (time.perf_counter() - start) * 1000})
+
+    def start(self):
+        for connection in connections.all():
+            self._wrappers.enter_context(connection.execute_wrapper(self))
+        try:
+            self.profiler.enable()
+        except ValueError:
+            # another profiler runs in this process
+            self.profiler = None
+        self.started = time.perf_counter()
+        return self
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self._wrappers.close()
+
+    def finish(self, request, response, render_time):
+        total = time.perf_counter() - self.started
+        self.stop()
+
+        functions, serializer_time = [], 0
+        if self.profiler is not None:
+            stats = pstats.Stats(self.profiler)
+            for (path, line, name), (cc, calls, tottime, cumtime, _) in stats.stats.items():
+                if name == 'data' and path.endswith('rest_framework/serializers.py'):
+                    serializer_time = max(serializer_time, cumtime)
+            top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+            for (path, line, name), (cc, calls, tottime, cumtime, _) in top[:settings.PROFILE_TOP_FUNCTIONS]:
+                functions.append({
+                    'function': '%s:%d(%s)' % (path, line, name), 'calls': calls,
+                    'tottime_ms': round(tottime * 1000, 3), 'cumtime_ms': round(cumtime * 1000, 3),
+                })
+
+        return {
+            'id': self.id,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'user_id': request.user.pk,
+            'total_ms': round(total * 1000, 3),
+            'sql_ms': round(sum(q['ms'] for q in self.queries), 3),
+            'serializer_ms': round(serializer_time * 1000, 3),
+            'render_ms': round(render_time * 1000, 3),
+            'queries': [{'sql': q['sql'], 'ms': round(q['ms'], 3)} for q in self.queries],
+            'functions': functions,
+        }
+
+    def save(self, report):
+        directory = Path(settings.PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / ('%s.json' % self.id)).write_text(json.dumps(report, cls=JSONEncoder))
+        if self.profiler is not None:
+            self.profiler.dump_stats(directory / ('%s.prof' % self.id))
+        prune_profiles(directory, settings.PROFILE_MAX_FILES)
+
+
+def prune_profiles(directory, keep):
+    """
+    Delete the stored profiles older than the `keep` newest ones.
+    """
+    reports = []
+    for path in directory.glob('*.json'):
+        try:
+            reports.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            # pruned by another process
+            pass
+    reports.sort()
+    for _, report in reports[:max(0, len(reports) - keep)]:
+        for path in (report, report.with_suffix('.prof')):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def get_profile_path(profile_id, suffix='.json'):
+    """
+    Return the path of a stored profile, None if there is no such profile.
+    """
+    if not PROFILE_ID.match(profile_id):
+        return None
+    path = Path(settings.PROFILE_DIR) / (profile_id + suffix)
+    return path if path.exists() else None
+
+
+class ProfilingMixin:
+    """
+    Profiles the requests of the view, from after authentication to the
+    rendered response.
+    """
+    profile = None
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # exceptions re-raised by `handle_exception` skip `finalize_response`
+            profile, self.profile = self.profile, None
+            if profile is not None:
+                profile.stop()
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        mode = get_profile_mode(request)
+        if mode is not None:
+            self.profile = RequestProfile(mode).start()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        profile, self.profile = self.profile, None
+        if profile is None:
+            return response
+
+        start = time.perf_counter()
+        # streamed bodies are produced after the view returns, out of the profile
+        if not response.streaming:
+            response.render()
+        report = profile.finish(request, response, time.perf_counter() - start)
+        if profile.mode == INLINE:
+            return JsonResponse(report, encoder=JSONEncoder)
+        profile.save(report)
+        response['X-Profile-Id'] = profile.id
+        return response
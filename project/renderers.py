@@ -0,0 +1,92 @@
+import time
+
+import msgpack
+from rest_framework import renderers
+from rest_framework.utils.encoders import JSONEncoder
+
+from .metrics import get_request_metrics
+
+# dates, decimals, lazy strings... as the JSON renderer writes them
+_json_encoder = JSONEncoder()
+
+
+class TimedRendererMixin:
+    """
+    Accounts the render time as serialization time of the request.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        start = time.perf_counter()
+        try:
+            return super().render(data, accepted_media_type, renderer_context)
+        finally:
+            metrics = get_request_metrics()
+            if metrics is not None:
+                metrics.serialize_time += time.perf_counter() - start
+
+
+class TimedSerializerMixin:
+    """
+    Accounts the time the serializers of the view take to build their
+    `data` as serialization time of the request.
+    """
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        to_representation = serializer.to_representation
+
+        def timed_to_representation(instance):
+            start = time.perf_counter()
+            try:
+                return to_representation(instance)
+            finally:
+                metrics = get_request_metrics()
+                if metrics is not None:
+                    metrics.serialize_time += time.perf_counter() - start
+
+        # `data` of list serializers calls it once, their children aren't timed again
+        serializer.to_representation = timed_to_representation
+        return serializer
+
+
+class JSONRenderer(TimedRendererMixin, renderers.JSONRenderer):
+    """
+    JSON renderer accounting its time as serialization time of the request.
+    """
+
+    def render_stream(self, batches, accepted_media_type=None, renderer_context=None):
+        """
+        Yield `batches` of items as the chunks of a single JSON array.
+        """
+        yield b'['
+        separator = b''
+        for batch in batches:
+            if batch:
+                yield separator + self.render(batch, accepted_media_type, renderer_context)[1:-1]
+                separator = b','
+        yield b']'
+
+
+class MessagePackRenderer(TimedRendererMixin, renderers.BaseRenderer):
+    """
+    MessagePack renderer, values without a MessagePack type are written
+    like the JSON renderer does, e.g. datetimes as ISO 8601 strings.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_json_encoder.default, use_bin_type=True)
+
+    def render_stream(self, batches, accepted_media_type=None, renderer_context=None):
+        """
+        Yield the items of `batches` as a sequence of MessagePack objects,
+        read them back with `msgpack.Unpacker`.
+        """
+        packer = msgpack.Packer(default=_json_encoder.default, use_bin_type=True)
+        for batch in batches:
+            yield b''.join(packer.pack(item) for item in batch)
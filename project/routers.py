@@ -0,0 +1,224 @@
+"""
+Database routing for read replicas.
+
+Reads made while serving a safe (GET, HEAD, OPTIONS) request go to one of the
+`DATABASE_REPLICAS`, everything else goes to the primary database. A user is
+pinned to the primary for `REPLICA_STICKY_SECONDS` after one of his own writes
+so he always reads what he just wrote, and replicas failing a health check are
+skipped until `REPLICA_HEALTH_CHECK_INTERVAL` seconds have passed.
+
+The user shards have replicas of their own in `USER_SHARD_REPLICAS`, chosen
+the same way by `users.sharding.ShardRouter` through `read_replica`.
+
+Pins are kept in the `REPLICA_PIN_CACHE` cache, which every process must
+share. When it is local to the process, like the default local memory
+cache, pins are kept in a signed cookie of the client instead.
+"""
+
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework.permissions import SAFE_METHODS
+
+_state = ContextVar('replica_state', default=None)
+
+PIN_KEY = 'replica-pin:%s'
+PIN_COOKIE = 'replica_pin'
+
+
+def get_replicas(primary=DEFAULT_DB_ALIAS):
+    """
+    The replicas of the `primary` database.
+    """
+    if primary == DEFAULT_DB_ALIAS:
+        return getattr(settings, 'DATABASE_REPLICAS', [])
+    return getattr(settings, 'USER_SHARD_REPLICAS', {}).get(primary, [])
+
+
+def get_sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+
+
+def get_pin_cache():
+    """
+    The cache of the pins, None when it is local to the process.
+    """
+    cache = caches[getattr(settings, 'REPLICA_PIN_CACHE', 'default')]
+    if isinstance(cache, (LocMemCache, DummyCache)):
+        return None
+    return cache
+
+
+def pin_user(user, response):
+    """
+    Send the reads of `user` to the primary for the sticky window, in the
+    pin cache or a signed cookie of `response`.
+    """
+    cache = get_pin_cache()
+    if cache is not None:
+        cache.set(PIN_KEY % user.pk, True, get_sticky_seconds())
+    else:
+        response.set_signed_cookie(PIN_COOKIE, user.pk, salt=PIN_COOKIE,
+                                   max_age=get_sticky_seconds(), httponly=True,
+                                   samesite='Lax')
+
+
+def is_pinned(request, user):
+    cache = get_pin_cache()
+    if cache is not None:
+        return bool(cache.get(PIN_KEY % user.pk))
+    # None for a missing, expired or tampered cookie
+    pinned = request.get_signed_cookie(PIN_COOKIE, None, salt=PIN_COOKIE,
+                                       max_age=get_sticky_seconds())
+    return pinned == str(user.pk)
+
+
+class ReplicaHealth:
+    """
+    Process wide health of the replicas. A replica is checked at most once
+    per interval and skipped until the next check when it fails.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked_at = {}
+        self._healthy = {}
+
+    def interval(self):
+        return getattr(settings, 'REPLICA_HEALTH_CHECK_INTERVAL', 30)
+
+    def is_healthy(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            checked_at = self._checked_at.get(alias)
+            if checked_at is not None and now - checked_at < self.interval():
+                return self._healthy[alias]
+            self._checked_at[alias] = now
+        healthy = self.check(alias)
+        with self._lock:
+            self._healthy[alias] = healthy
+        return healthy
+
+    def check(self, alias):
+        connection = connections[alias]
+        try:
+            connection.ensure_connection()
+            if connection.is_usable():
+                return True
+        except DatabaseError:
+            pass
+        connection.close()
+        return False
+
+    def mark_down(self, alias):
+        with self._lock:
+            self._checked_at[alias] = time.monotonic()
+            self._healthy[alias] = False
+
+    def reset(self):
+        with self._lock:
+            self._checked_at.clear()
+            self._healthy.clear()
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaState:
+    """
+    Routing decisions for the request being served, the replica of each
+    primary database is chosen once so every read of the request sees the
+    same snapshot.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.safe = request.method in SAFE_METHODS
+        # chosen replica by primary database
+        self.replicas = {}
+        self._pinned = None
+        self._resolving = False
+
+    def is_pinned(self):
+        if self._pinned is None:
+            if self._resolving:
+                # loading the lazy session user reads from the database too
+                return False
+            self._resolving = True
+            try:
+                user = getattr(self.request, 'user', None)
+                if user is None or not user.is_authenticated:
+                    # DRF authenticates inside the view, check again later
+                    return False
+                self._pinned = is_pinned(self.request, user)
+            finally:
+                self._resolving = False
+        return self._pinned
+
+    def choose_replica(self, primary=DEFAULT_DB_ALIAS):
+        replica = self.replicas.get(primary)
+        if replica is not None and replica_health.is_healthy(replica):
+            return replica
+        healthy = [alias for alias in get_replicas(primary)
+                   if replica_health.is_healthy(alias)]
+        self.replicas[primary] = random.choice(healthy) if healthy else None
+        return self.replicas[primary]
+
+
+def bind_state(request):
+    return _state.set(ReplicaState(request))
+
+
+def unbind_state(token):
+    _state.reset(token)
+
+
+def get_state():
+    return _state.get()
+
+
+def read_replica(primary=DEFAULT_DB_ALIAS):
+    """
+    The replica of `primary` serving the reads of the current request, None
+    when they go to `primary`.
+    """
+    state = get_state()
+    if state is None or not state.safe or not get_replicas(primary):
+        return None
+    if connections[primary].in_atomic_block:
+        return None
+    if state.is_pinned():
+        return None
+    return state.choose_replica(primary)
+
+
+class ReplicaRouter:
+    """
+    Routes reads of safe requests to a healthy replica, anything else falls
+    through to the primary database.
+    """
+
+    def db_for_read(self, model, **hints):
+        return read_replica()
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_replicas():
+            return False
+        return None
@@ -43,17 +43,71 @@ logger.warning('Project started in mode %s and DEBUG=%s' %
 MIDDLEWARE = [
     'whitenoise.middleware.WhiteNoiseMiddleware',  # whitenoise middleware
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'project.metrics.MetricsMiddleware',  # per view query and latency metrics
+    'project.compression.CompressionMiddleware',  # API response compression
+    'project.middleware.ReplicaRoutingMiddleware',  # read replica routing
+    # session, csrf, auth, messages and clickjacking middleware are skipped
+    # for token authenticated calls under LEAN_API_PREFIX
+    'project.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',  # django-cors-headers middleware
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'project.middleware.CsrfViewMiddleware',
+    'project.middleware.AuthenticationMiddleware',
+    'users.middleware.OrganizationMiddleware',  # binds the request organization
+    'project.middleware.MessageMiddleware',
+    'project.middleware.XFrameOptionsMiddleware',
 ]
 
+LEAN_API_PREFIX = '/api/'
+
+# Requests running more queries than this are logged as warnings
+METRICS_QUERY_BUDGET = int(os.environ.get('METRICS_QUERY_BUDGET', 30))
+
+# API response compression, encodings by preference with their level, br
+# and zstd need the Brotli and zstandard packages
+COMPRESSION_PREFIX = '/api/'
+COMPRESSION_ENCODINGS = {'br': 4, 'zstd': 3, 'gzip': 6}
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+# responses carrying tokens, never compressed (BREACH)
+COMPRESSION_EXCLUDE_PATHS = [r'^/api/auth/login/$', r'^/api/organizations/\d+/events/ticket/$']
+
+# Queries slower than this go to the slow query log, a share of them is
+# explained on top of the first of each fingerprint
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.05))
+
+# Seconds between keepalives of the organization event streams, when the
+# change feed is also polled for writes of other processes
+EVENTS_KEEPALIVE = int(os.environ.get('EVENTS_KEEPALIVE', 15))
+
+# Seconds a stream ticket opens the event stream for, see users/events.py
+EVENTS_TICKET_SECONDS = int(os.environ.get('EVENTS_TICKET_SECONDS', 30))
+
+# Sub-requests accepted by /api/batch/ and threads running concurrent reads
+BATCH_MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', 20))
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', 4))
+
+# Users moved per transaction by organization jobs and seconds between batches
+ORGANIZATION_JOB_BATCH_SIZE = int(os.environ.get('ORGANIZATION_JOB_BATCH_SIZE', 500))
+ORGANIZATION_JOB_PAUSE = float(os.environ.get('ORGANIZATION_JOB_PAUSE', 0))
+
+# Request profiling, share of requests profiled and stored whatever the
+# user, functions kept in the reports, where they are stored and how many
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_TOP_FUNCTIONS = 30
+PROFILE_DIR = os.environ.get('PROFILE_DIR', BASE_DIR / 'profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 1000))
+
+# Database task queue, see `manage.py run_workers`
+JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 2))
+JOBS_POLL_INTERVAL = float(os.environ.get('JOBS_POLL_INTERVAL', 1))
+JOBS_STALE_SECONDS = int(os.environ.get('JOBS_STALE_SECONDS', 300))
+JOBS_MAX_ATTEMPTS = int(os.environ.get('JOBS_MAX_ATTEMPTS', 3))
+
 ROOT_URLCONF = 'project.urls'
 
+TEST_RUNNER = 'project.test_runner.TestRunner'
+
 AUTH_USER_MODEL = 'users.User'
 
 TEMPLATES = [
@@ -89,6 +143,77 @@ if ENVIRONMENT == 'PROD':
     URL = os.environ.get('DATABASE_URL', None)
     DATABASES['default'] = dj_database_url.config(default=URL, conn_max_age=0)
 
+# Read replicas, space separated database urls. Reads of GET requests are
+# routed to them, writes and the following reads of the same user go to the
+# primary database.
+
+DATABASE_REPLICA_URLS = os.environ.get('DATABASE_REPLICA_URLS', '').split()
+DATABASE_REPLICAS = []
+
+for index, url in enumerate(DATABASE_REPLICA_URLS):
+    alias = 'replica_%d' % index
+    DATABASES[alias] = dj_database_url.parse(url, conn_max_age=0)
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+
+# User shards, space separated database urls. Organizations are placed on a
+# shard by hash with their users, see users/sharding.py. Shards must be
+# migrated like the default database, `manage.py rebalance_shards` moves
+# organizations between them.
+
+USER_SHARD_URLS = os.environ.get('USER_SHARD_URLS', '').split()
+USER_SHARDS = []
+
+for index, url in enumerate(USER_SHARD_URLS):
+    alias = 'shard_%d' % index
+    DATABASES[alias] = dj_database_url.parse(url, conn_max_age=0)
+    USER_SHARDS.append(alias)
+
+# Read replicas of the user shards, space separated `index=url` pairs, e.g.
+# `0=postgres://... 1=postgres://...` for a replica of shard_0 and one of
+# shard_1. Reads of GET requests are routed to them like to the replicas of
+# the default database.
+
+USER_SHARD_REPLICA_URLS = os.environ.get('USER_SHARD_REPLICA_URLS', '').split()
+USER_SHARD_REPLICAS = {}
+
+for entry in USER_SHARD_REPLICA_URLS:
+    index, url = entry.split('=', 1)
+    shard = 'shard_%s' % index
+    replicas = USER_SHARD_REPLICAS.setdefault(shard, [])
+    alias = '%s_replica_%d' % (shard, len(replicas))
+    DATABASES[alias] = dj_database_url.parse(url, conn_max_age=0)
+    DATABASES[alias]['TEST'] = {'MIRROR': shard}
+    replicas.append(alias)
+
+# Seconds a process keeps routing an organization to its previous shard
+SHARD_PLACEMENT_TTL = int(os.environ.get('SHARD_PLACEMENT_TTL', 30))
+
+DATABASE_ROUTERS = ['users.sharding.ShardRouter', 'project.routers.ReplicaRouter']
+
+AUTHENTICATION_BACKENDS = ['users.sharding.ModelBackend']
+
+# Opt-in SQLite performance mode, WAL and tuned pragmas on every connection
+# and write transactions taking the lock up front, see
+# project/sqlite3/base.py. With SQLITE_SINGLE_WRITER the writes of every
+# process wait for their turn on a lock file instead of retrying until the
+# busy timeout.
+SQLITE_PERFORMANCE = bool(int(os.environ.get('SQLITE_PERFORMANCE', 0)))
+SQLITE_SINGLE_WRITER = bool(int(os.environ.get('SQLITE_SINGLE_WRITER', 0)))
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', 20))
+
+for database in DATABASES.values():
+    if SQLITE_PERFORMANCE and database['ENGINE'] == 'django.db.backends.sqlite3':
+        database['ENGINE'] = 'project.sqlite3'
+        database.setdefault('OPTIONS', {}).update(
+            timeout=SQLITE_BUSY_TIMEOUT, single_writer=SQLITE_SINGLE_WRITER)
+
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+# cache shared by every process, process local caches pin with a signed cookie
+REPLICA_PIN_CACHE = os.environ.get('REPLICA_PIN_CACHE', 'default')
+REPLICA_HEALTH_CHECK_INTERVAL = int(
+    os.environ.get('REPLICA_HEALTH_CHECK_INTERVAL', 30))
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -0,0 +1,170 @@
+"""
+SQLite backend tuned for single node deployments.
+
+Every connection applies `pragmas`: write ahead logging so readers never
+block the writer, `synchronous=NORMAL` which only syncs at checkpoints under
+WAL, a memory mapped database and a larger page cache. Transactions start
+with `BEGIN IMMEDIATE` so an `atomic` block takes the write lock before its
+first read, a deferred transaction reading then writing while another one
+writes fails with "database is locked" without waiting on the busy timeout.
+
+With `single_writer` every write transaction and autocommit write of the
+processes using the database file waits for its turn on a lock file next to
+it, writers queue instead of polling in the SQLite busy handler.
+
+    DATABASES['default'] = {
+        'ENGINE': 'project.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {'timeout': 20, 'single_writer': True},
+    }
+"""
+
+import os
+import re
+import threading
+
+from django.db.backends.sqlite3 import base
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # KiB when negative
+    'temp_store': 'memory',
+}
+
+# options of this backend, the rest go to sqlite3.connect
+BACKEND_OPTIONS = ('pragmas', 'transaction_mode', 'single_writer')
+
+WRITE_RE = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.I)
+
+
+class WriterLock:
+    """
+    One writer at a time on a database file, a thread lock within the
+    process and a lock on `<database>-writer` across processes.
+    """
+
+    def __init__(self, path):
+        import fcntl  # Unix only
+        self._fcntl = fcntl
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        self._lock.acquire()
+        try:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def release(self):
+        try:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+_writer_locks = {}
+_writer_locks_lock = threading.Lock()
+
+
+def get_writer_lock(name):
+    path = os.path.realpath(str(name)) + '-writer'
+    with _writer_locks_lock:
+        if path not in _writer_locks:
+            _writer_locks[path] = WriterLock(path)
+        return _writer_locks[path]
+
+
+class SQLiteCursorWrapper(base.SQLiteCursorWrapper):
+    """
+    Takes the writer lock around writes made outside of a transaction.
+    """
+    writer = None
+
+    def execute(self, query, params=None):
+        if self.writer is None or self.connection.in_transaction or not WRITE_RE.match(query):
+            return super().execute(query, params)
+        with self.writer:
+            return super().execute(query, params)
+
+    def executemany(self, query, param_list):
+        if self.writer is None or self.connection.in_transaction or not WRITE_RE.match(query):
+            return super().executemany(query, param_list)
+        with self.writer:
+            return super().executemany(query, param_list)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.writer = None
+        self._holds_writer = False
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        for option in BACKEND_OPTIONS:
+            kwargs.pop(option, None)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        options = self.settings_dict['OPTIONS']
+        for name, value in {**DEFAULT_PRAGMAS, **options.get('pragmas', {})}.items():
+            conn.execute('PRAGMA %s = %s' % (name, value))
+        # in-memory databases have a single connection per process
+        if options.get('single_writer') and not self.is_in_memory_db():
+            self.writer = get_writer_lock(self.settings_dict['NAME'])
+        else:
+            self.writer = None
+        return conn
+
+    def create_cursor(self, name=None):
+        cursor = self.connection.cursor(factory=SQLiteCursorWrapper)
+        cursor.writer = self.writer
+        return cursor
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict['OPTIONS'].get('transaction_mode', 'IMMEDIATE')
+        if self.writer is not None:
+            self.writer.acquire()
+            self._holds_writer = True
+        try:
+            self.cursor().execute('BEGIN %s' % mode)
+        except BaseException:
+            self._release_writer()
+            raise
+
+    def _release_writer(self):
+        if self._holds_writer:
+            self._holds_writer = False
+            self.writer.release()
+
+    def _commit(self):
+        try:
+            super()._commit()
+        finally:
+            if not self.connection.in_transaction:
+                self._release_writer()
+
+    def _rollback(self):
+        try:
+            super()._rollback()
+        finally:
+            self._release_writer()
+
+    def _close(self):
+        try:
+            super()._close()
+        finally:
+            self._release_writer()
@@ -0,0 +1,98 @@
+"""
+Test runner with a fast password hasher and a per-test timing report.
+
+Passwords are hashed with MD5 while tests run, PBKDF2 dominated the runtime of
+the suite. Timings are measured where each test runs, so the report also
+works with ``--parallel``.
+"""
+
+import time
+import unittest
+
+from django.test.runner import DiscoverRunner, ParallelTestSuite, RemoteTestResult, RemoteTestRunner
+from django.test.utils import override_settings
+
+FAST_PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+class TimedRemoteTestResult(RemoteTestResult):
+    """
+    Records the time of each test in a worker process as an `addTiming`
+    event, replayed in the main process.
+    """
+
+    def startTest(self, test):
+        self._started_at = time.perf_counter()
+        super().startTest(test)
+
+    def stopTest(self, test):
+        self.events.append(('addTiming', self.test_index,
+                            time.perf_counter() - self._started_at))
+        super().stopTest(test)
+
+
+class TimedRemoteTestRunner(RemoteTestRunner):
+    resultclass = TimedRemoteTestResult
+
+
+class TimedParallelTestSuite(ParallelTestSuite):
+    runner_class = TimedRemoteTestRunner
+
+
+class TimedTextTestResult(unittest.TextTestResult):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = {}
+        self._started_at = {}
+
+    def startTest(self, test):
+        self._started_at[test.id()] = time.perf_counter()
+        super().startTest(test)
+
+    def addTiming(self, test, elapsed):
+        self.timings[test.id()] = elapsed
+
+    def stopTest(self, test):
+        started_at = self._started_at.pop(test.id(), None)
+        if test.id() not in self.timings and started_at is not None:
+            self.timings[test.id()] = time.perf_counter() - started_at
+        super().stopTest(test)
+
+
+class TestRunner(DiscoverRunner):
+    parallel_test_suite = TimedParallelTestSuite
+
+    def __init__(self, slowest=10, **kwargs):
+        super().__init__(**kwargs)
+        self.slowest = slowest
+
+    @classmethod
+    def add_arguments(cls, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--slowest', type=int, default=10,
+            help='Report the N slowest tests, 0 disables the report.',
+        )
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._hashers = override_settings(PASSWORD_HASHERS=FAST_PASSWORD_HASHERS)
+        self._hashers.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._hashers.disable()
+        super().teardown_test_environment(**kwargs)
+
+    def get_resultclass(self):
+        return super().get_resultclass() or TimedTextTestResult
+
+    def suite_result(self, suite, result, **kwargs):
+        timings = getattr(result, 'timings', None)
+        if self.slowest and timings:
+            print('\nSlowest tests:')
+            slowest = sorted(timings.items(), key=lambda item: item[1], reverse=True)
+            for test_id, elapsed in slowest[:self.slowest]:
+                print('%8.3fs %s' % (elapsed, test_id))
+            print('%8.3fs total' % sum(timings.values()))
+        return super().suite_result(suite, result, **kwargs)
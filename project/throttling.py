@@ -0,0 +1,256 @@
+"""
+Token bucket throttling.
+
+Every request takes a token from the buckets of its scope, `login`, `read` or
+`write`, one bucket per dimension: the user, the client IP, the organization
+and, for logins, the email tried. Buckets refill continuously at the rate
+given in `THROTTLE_BUCKETS` and hold at most as many tokens as the rate
+count, so bursts are allowed up to it. A request is let through only if
+every bucket has a token, the tokens taken before an empty bucket is met are
+given back. Checks only touch the bucket store, never the database. Client
+IPs are the REMOTE_ADDR unless `NUM_PROXIES` trusted proxies set
+X-Forwarded-For. Throttled requests get a 429 with Retry-After.
+"""
+
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    """
+    Return (tokens per second, capacity) of a rate like `10/min`.
+    """
+    count, period = rate.split('/')
+    count = int(count)
+    return count / PERIODS[period[0]], count
+
+
+def take(tokens, stamp, now, rate, capacity):
+    """
+    Refill a bucket and take a token, returns the tokens left, and the
+    seconds to wait for one, 0 when it was taken.
+    """
+    tokens = min(capacity, tokens + (now - stamp) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class LocalBucketStore:
+    """
+    Buckets in the memory of the process, the oldest are dropped past
+    `max_keys`.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, rate, capacity):
+        now = time.time()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (capacity, now))
+            tokens, wait = take(tokens, stamp, now, rate, capacity)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                del self._buckets[next(iter(self._buckets))]
+        return wait
+
+    def refund(self, key, rate, capacity):
+        with self._lock:
+            if key in self._buckets:
+                tokens, stamp = self._buckets[key]
+                self._buckets[key] = (min(capacity, tokens + 1), stamp)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedMemoryBucketStore:
+    """
+    Buckets in a memory mapped file shared by the worker processes of a
+    host, `path` is best on a tmpfs like /dev/shm. Keys are hashed to one of
+    `slots` fixed slots, a key taking the slot of another starts full.
+    """
+    SLOT = struct.Struct('<Qdd')
+
+    def __init__(self, path='/dev/shm/drf-throttle', slots=65536):
+        import fcntl  # Unix only
+        self._fcntl = fcntl
+        self.slots = slots
+        size = slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+
+    def slot(self, key):
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+        return digest, (digest % self.slots) * self.SLOT.size
+
+    def consume(self, key, rate, capacity):
+        digest, offset = self.slot(key)
+        now = time.time()
+        with self._lock:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                owner, tokens, stamp = self.SLOT.unpack_from(self._map, offset)
+                if owner != digest:
+                    tokens, stamp = capacity, now
+                tokens, wait = take(tokens, stamp, now, rate, capacity)
+                self.SLOT.pack_into(self._map, offset, digest, tokens, now)
+            finally:
+                self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN, self.SLOT.size, offset)
+        return wait
+
+    def refund(self, key, rate, capacity):
+        digest, offset = self.slot(key)
+        with self._lock:
+            self._fcntl.lockf(self._fd, self._fcntl.LOCK_EX, self.SLOT.size, offset)
+            try:
+                owner, tokens, stamp = self.SLOT.unpack_from(self._map, offset)
+                if owner == digest:
+                    self.SLOT.pack_into(self._map, offset, digest, min(capacity, tokens + 1), stamp)
+            finally:
+                self._fcntl.lockf(self._fd, self._fcntl.LOCK_UN, self.SLOT.size, offset)
+
+    def clear(self):
+        with self._lock:
+            self._map[:] = bytes(len(self._map))
+
+
+class CacheBucketStore:
+    """
+    Buckets in a Django cache shared by every host. Updates aren't atomic,
+    concurrent requests may take the same token. Use an in-memory cache
+    backend, a database cache would query on every request.
+    """
+
+    def __init__(self, alias='default', prefix='throttle:'):
+        self.cache = caches[alias]
+        self.prefix = prefix
+
+    def consume(self, key, rate, capacity):
+        now = time.time()
+        key = self.prefix + key
+        tokens, stamp = self.cache.get(key, (capacity, now))
+        tokens, wait = take(tokens, stamp, now, rate, capacity)
+        # an expired bucket is a full one
+        self.cache.set(key, (tokens, now), timeout=int(capacity / rate) + 1)
+        return wait
+
+    def refund(self, key, rate, capacity):
+        key = self.prefix + key
+        bucket = self.cache.get(key)
+        if bucket is not None:
+            tokens, stamp = bucket
+            self.cache.set(key, (min(capacity, tokens + 1), stamp),
+                           timeout=int(capacity / rate) + 1)
+
+    def clear(self):
+        self.cache.clear()
+
+
+_store = None
+
+
+def get_store():
+    """
+    Return the bucket store configured by `THROTTLE_STORE`.
+    """
+    global _store
+    if _store is None:
+        options = getattr(settings, 'THROTTLE_STORE_OPTIONS', {})
+        _store = import_string(settings.THROTTLE_STORE)(**options)
+    return _store
+
+
+@receiver(setting_changed)
+def reset_store(setting, **kwargs):
+    global _store
+    if setting in ('THROTTLE_STORE', 'THROTTLE_STORE_OPTIONS'):
+        _store = None
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Takes a token from every bucket of the request scope configured in
+    `THROTTLE_BUCKETS`, or from none of them.
+    """
+    wait_time = None
+
+    def get_scope(self, request, view):
+        return 'read' if request.method in SAFE_METHODS else 'write'
+
+    def get_identities(self, request, view):
+        """
+        Yield (dimension, identity) of the request for the scope buckets.
+        """
+        user = request.user
+        if user and user.is_authenticated:
+            yield 'user', user.pk
+            if getattr(user, 'organization_id', None) is not None:
+                yield 'org', user.organization_id
+        yield 'ip', self.get_ident(request)
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(request, view)
+        buckets = settings.THROTTLE_BUCKETS.get(scope)
+        if not buckets:
+            return True
+
+        store = get_store()
+        taken = []
+        for dimension, identity in self.get_identities(request, view):
+            rate = buckets.get(dimension)
+            if rate is None or identity is None:
+                continue
+            key = '%s:%s:%s' % (scope, dimension, identity)
+            rate, capacity = parse_rate(rate)
+            wait = store.consume(key, rate, capacity)
+            if wait:
+                # a rejected request doesn't spend the other buckets
+                for bucket in taken:
+                    store.refund(*bucket)
+                self.wait_time = wait
+                return False
+            taken.append((key, rate, capacity))
+        return True
+
+    def wait(self):
+        return self.wait_time
+
+
+class LoginThrottle(TokenBucketThrottle):
+    """
+    Throttles login attempts per client IP and per email tried, before the
+    password is hashed.
+    """
+
+    def get_scope(self, request, view):
+        return 'login'
+
+    def get_identities(self, request, view):
+        yield 'ip', self.get_ident(request)
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        if isinstance(email, str):
+            yield 'email', email.lower()
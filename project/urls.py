@@ -26,6 +26,9 @@ from rest_framework_simplejwt.views import TokenObtainPairView
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
+from jobs.views import JobViewSet
+from project.throttling import LoginThrottle
+from project.views import BatchAPIView, MetricsAPIView, ProfileAPIView
 from users.views import (
     UserViewSet,
     GroupList,
@@ -51,9 +54,11 @@ router.register(r'users', UserViewSet)
 router.register(r'organizations', OrganizationViewSet)
 router.register(r'organizations/(?P<org_id>.+)/users',
                 UserOrganizationViewSet, basename='organizations')
+router.register(r'jobs', JobViewSet)
 
 auth_urlpatterns = [
-    path('login/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
+    path('login/', TokenObtainPairView.as_view(throttle_classes=[LoginThrottle]),
+         name='token_obtain_pair'),
     path('groups/', GroupList.as_view(), name='list_auth_groups'),
 ]
 
@@ -68,6 +73,9 @@ api_urlpatterns = [
     path('', include(router.urls)),
     path('auth/', include(auth_urlpatterns)),
     path('info/', InfoAPIView.as_view()),
+    path('batch/', BatchAPIView.as_view()),
+    path('metrics/', MetricsAPIView.as_view()),
+    path('profiles/<str:profile_id>/', ProfileAPIView.as_view()),
     path('docs/', include(apidocs_urlpatterns))
 ]
 
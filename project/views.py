@@ -0,0 +1,51 @@
+from django.http import FileResponse, Http404, HttpResponse
+from rest_framework import permissions, views
+from rest_framework.response import Response
+
+from .batch import BatchSerializer, run_batch
+from .metrics import registry
+from .profiling import get_profile_path
+
+
+class MetricsAPIView(views.APIView):
+    """
+    Request metrics in Prometheus text format, admin users only.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return HttpResponse(registry.render(),
+                            content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class BatchAPIView(views.APIView):
+    """
+    Run several API calls in one round-trip.
+
+    POST `{"requests": [{"method", "url", "body"}], "concurrent": false}`,
+    returns `{"responses": [{"status", "headers", "body"}]}` in order.
+    With `concurrent` consecutive reads run in parallel.
+    """
+
+    def post(self, request):
+        serializer = BatchSerializer(data=request.data, context={'batch_path': request.path})
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        return Response({'responses': run_batch(request, data['requests'], data['concurrent'])})
+
+
+class ProfileAPIView(views.APIView):
+    """
+    Download a stored request profile, admin users only. The JSON report by
+    default, the cProfile stats with `?pstats=1`.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, profile_id):
+        pstats = request.query_params.get('pstats')
+        path = get_profile_path(profile_id, '.prof' if pstats else '.json')
+        if path is None:
+            raise Http404
+        if pstats:
+            return FileResponse(path.open('rb'), as_attachment=True, filename=path.name)
+        return HttpResponse(path.read_bytes(), content_type='application/json')
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
 application = get_wsgi_application()
+
+# load process local caches before serving the first request
+from users.registry import group_registry  # noqa: E402
+
+group_registry.warm_up()
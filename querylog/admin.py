@@ -0,0 +1,24 @@
+from django.contrib import admin
+
+from .models import SlowQuery
+
+
+@admin.register(SlowQuery)
+class SlowQueryAdmin(admin.ModelAdmin):
+    list_display = ('fingerprint', 'view', 'short_sql', 'count', 'total_time',
+                    'avg_time', 'max_time', 'last_seen')
+    list_filter = ('view',)
+    search_fields = ('=fingerprint', 'view')
+    ordering = ('-total_time',)
+    readonly_fields = ('fingerprint', 'view', 'sql', 'count', 'total_time', 'max_time',
+                       'plan', 'explained_at', 'first_seen', 'last_seen')
+
+    def short_sql(self, obj):
+        return obj.sql[:120]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        # the change page shows the full SQL and plan read only
+        return request.method in ('GET', 'HEAD') and super().has_change_permission(request, obj)
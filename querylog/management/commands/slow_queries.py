@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from querylog.models import SlowQuery
+
+ORDERS = {
+    'total': F('total_time').desc(),
+    'count': F('count').desc(),
+    'max': F('max_time').desc(),
+    'avg': (F('total_time') / F('count')).desc(),
+}
+
+
+class Command(BaseCommand):
+    help = 'Report the slowest queries recorded by the slow query log.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--order', choices=sorted(ORDERS), default='total',
+                            help='Sort by total, count, max or average time.')
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--view', help='Only the queries of this view.')
+        parser.add_argument('--explain', action='store_true', help='Print the query plans.')
+        parser.add_argument('--reset', action='store_true', help='Clear the log.')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            count, _ = SlowQuery.objects.all().delete()
+            self.stdout.write('Deleted %d slow queries' % count)
+            return
+
+        queries = SlowQuery.objects.order_by(ORDERS[options['order']])
+        if options['view']:
+            queries = queries.filter(view=options['view'])
+
+        self.stdout.write('%-16s %8s %10s %10s %10s  %s' % (
+            'fingerprint', 'count', 'total ms', 'avg ms', 'max ms', 'view'))
+        for query in queries[:options['limit']]:
+            self.stdout.write('%-16s %8d %10.1f %10.1f %10.1f  %s' % (
+                query.fingerprint, query.count, query.total_time * 1000,
+                query.avg_time * 1000, query.max_time * 1000, query.view or '-'))
+            self.stdout.write('  %s' % query.sql)
+            if options['explain'] and query.plan:
+                for line in query.plan.splitlines():
+                    self.stdout.write('    %s' % line)
@@ -0,0 +1,34 @@
+# Generated by Django 3.1.5 on 2026-10-19 01:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQuery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=16)),
+                ('view', models.CharField(blank=True, max_length=100)),
+                ('sql', models.TextField()),
+                ('count', models.IntegerField(default=0)),
+                ('total_time', models.FloatField(default=0, verbose_name='total seconds')),
+                ('max_time', models.FloatField(default=0, verbose_name='max seconds')),
+                ('plan', models.TextField(blank=True)),
+                ('explained_at', models.DateTimeField(blank=True, null=True)),
+                ('first_seen', models.DateTimeField(auto_now_add=True)),
+                ('last_seen', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'slow queries',
+                'unique_together': {('fingerprint', 'view')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class SlowQuery(models.Model):
+    """
+    Slow queries of a view aggregated by fingerprint, the SQL with its
+    literals and IN lists collapsed. Parameters are never stored.
+    """
+    fingerprint = models.CharField(max_length=16)
+    view = models.CharField(max_length=100, blank=True)
+    sql = models.TextField()
+    count = models.IntegerField(default=0)
+    total_time = models.FloatField(_('total seconds'), default=0)
+    max_time = models.FloatField(_('max seconds'), default=0)
+    plan = models.TextField(blank=True)
+    explained_at = models.DateTimeField(null=True, blank=True)
+    first_seen = models.DateTimeField(auto_now_add=True)
+    last_seen = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = _('slow queries')
+        unique_together = [('fingerprint', 'view')]
+
+    def __str__(self):
+        return '%s %s' % (self.fingerprint, self.view)
+
+    @property
+    def avg_time(self):
+        return self.total_time / self.count if self.count else 0
@@ -0,0 +1,85 @@
+"""
+Slow query log.
+
+`project.metrics.RequestMetrics` collects the queries of a request running
+longer than `SLOW_QUERY_MS` and `record` adds them, once the response is
+ready, to the `SlowQuery` of their fingerprint and view. `EXPLAIN` runs with
+the actual parameters for queries without a plan yet and for a
+`SLOW_QUERY_EXPLAIN_RATE` sample of the others.
+"""
+
+import hashlib
+import logging
+import random
+import re
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import F, FloatField, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+NORMALIZE = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+
+def normalize(sql):
+    """
+    Return `sql` with literals and placeholders as `?` and lists as `(...)`.
+    """
+    for pattern, replacement in NORMALIZE:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def fingerprint(sql):
+    return hashlib.sha1(normalize(sql).encode()).hexdigest()[:16]
+
+
+def explain(alias, sql, params):
+    """
+    Return the plan of a SELECT, None for other statements or on errors.
+    """
+    if not sql.lstrip().upper().startswith('SELECT'):
+        return None
+    connection = connections[alias]
+    prefix = connection.ops.explain_query_prefix()
+    try:
+        with transaction.atomic(using=alias), connection.cursor() as cursor:
+            cursor.execute('%s %s' % (prefix, sql), params)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+    except DatabaseError:
+        logger.warning('Could not explain %s', sql, exc_info=True)
+        return None
+
+
+def record(view, queries):
+    """
+    Add `queries`, a list of (alias, sql, params, seconds), to the slow query
+    log of `view`.
+    """
+    from .models import SlowQuery
+
+    for alias, sql, params, duration in queries:
+        key = {'fingerprint': fingerprint(sql), 'view': view or ''}
+        updated = SlowQuery.objects.filter(**key).update(
+            count=F('count') + 1, total_time=F('total_time') + duration,
+            max_time=Greatest('max_time', Value(duration, output_field=FloatField())), last_seen=timezone.now())
+        if not updated:
+            # a concurrent request may insert the same key, the loser's hit is lost
+            SlowQuery.objects.bulk_create([SlowQuery(
+                sql=normalize(sql), count=1, total_time=duration, max_time=duration, **key)],
+                ignore_conflicts=True)
+
+        explained = SlowQuery.objects.filter(explained_at__isnull=False, **key).exists()
+        if not explained or random.random() < settings.SLOW_QUERY_EXPLAIN_RATE:
+            plan = explain(alias, sql, params)
+            if plan is not None:
+                SlowQuery.objects.filter(**key).update(plan=plan, explained_at=timezone.now())
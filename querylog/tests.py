@@ -0,0 +1,71 @@
+from io import StringIO
+
+from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+
+from users.constants import ADMIN
+from users.models import User, Organization
+
+from .models import SlowQuery
+from .recorder import fingerprint, normalize
+
+
+class FingerprintTests(SimpleTestCase):
+
+    def test_normalize(self):
+        """
+        Literals, placeholders and lists are collapsed
+        """
+        self.assertEqual(
+            normalize('SELECT "t"."id"  FROM "t" WHERE "t"."name" = \'x\'\n AND "t"."id" IN (%s, %s) LIMIT 21'),
+            'SELECT "t"."id" FROM "t" WHERE "t"."name" = ? AND "t"."id" IN (...) LIMIT ?')
+        self.assertEqual(fingerprint('SELECT 1 FROM t WHERE id IN (%s)'),
+                         fingerprint('SELECT 2 FROM t WHERE id IN (%s, %s, %s)'))
+        self.assertNotEqual(fingerprint('SELECT a FROM t'), fingerprint('SELECT b FROM t'))
+
+
+@override_settings(SLOW_QUERY_MS=0, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class SlowQueryLogTests(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        organization = Organization.objects.create(name='AAAIMX')
+        cls.admin = User.objects.create_user('admin@test.org', organization=organization,
+                                             is_staff=True, is_superuser=True)
+        cls.admin.groups.add(Group.objects.get(name=ADMIN))
+
+    def test_slow_query_log(self):
+        """
+        Queries over the threshold are aggregated per fingerprint and view,
+        explained, and reported by the command and the admin
+        """
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(self.admin))
+        self.client.get('/api/users/')
+        queries = SlowQuery.objects.filter(view='UserViewSet.list')
+        self.assertTrue(queries)
+        self.assertEqual({q.count for q in queries}, {1})
+        users = queries.get(sql__contains='FROM "users_user" INNER JOIN "users_organization"')
+        self.assertIn('SEARCH users_user', users.plan)
+        self.assertNotIn('admin@test.org', ''.join(q.sql for q in SlowQuery.objects.all()))
+
+        with override_settings(SLOW_QUERY_EXPLAIN_RATE=0):
+            self.client.get('/api/users/?offset=0')
+        users.refresh_from_db()
+        self.assertEqual(users.count, 2)
+        self.assertEqual(SlowQuery.objects.filter(view='UserViewSet.list').count(), queries.count())
+
+        out = StringIO()
+        call_command('slow_queries', '--explain', '--view', 'UserViewSet.list', stdout=out)
+        self.assertIn(users.fingerprint, out.getvalue())
+
+        self.client.force_login(self.admin)
+        response = self.client.get('/querylog/slowquery/')
+        self.assertContains(response, users.fingerprint)
+        response = self.client.get('/querylog/slowquery/%d/change/' % users.pk)
+        self.assertContains(response, 'users_user')
+
+        call_command('slow_queries', '--reset', stdout=StringIO())
+        self.assertFalse(SlowQuery.objects.exists())
@@ -1,11 +1,133 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR, PAGE_VAR
 from django.contrib.auth import admin as auth_admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
-from .models import User, Organization
+from .jobs import schedule_organization_delete
+from .models import User, Organization, OrganizationJob
 from .forms import UserChangeForm, UserCreationForm
 
-# Register your models here.
-admin.site.register(Organization)
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for tables with millions of rows. Unfiltered tables use the
+    planner estimate on PostgreSQL, other counts stop at `count_limit` rows,
+    records past it are reached with keyset navigation.
+    """
+    count_limit = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if not queryset.query.where and connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                               [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > self.count_limit:
+                return int(row[0])
+        return queryset.order_by()[:self.count_limit].count()
+
+
+class InputFilter(admin.SimpleListFilter):
+    """
+    List filter rendered as a text input instead of one link per value.
+    """
+    template = 'admin/input_filter.html'
+
+    def lookups(self, request, model_admin):
+        return ()
+
+    def has_output(self):
+        return True
+
+    def choices(self, changelist):
+        yield {
+            'query_parts': [(k, v) for k, v in changelist.params.items()
+                            if k not in (self.parameter_name, PAGE_VAR)],
+        }
+
+
+class OrganizationFilter(InputFilter):
+    title = 'organization id'
+    parameter_name = 'organization'
+
+    def queryset(self, request, queryset):
+        value = self.value()
+        if value and value.isdigit():
+            return queryset.filter(organization_id=value)
+
+
+class PhoneFilter(InputFilter):
+    title = 'phone'
+    parameter_name = 'phone'
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(phone=self.value())
+
+
+class KeysetChangeList(ChangeList):
+    """
+    Adds a link to the rows after the last one of the page, using the unique
+    `keyset_field` instead of an OFFSET. Only the default ordering is used.
+    """
+    keyset_field = 'email'
+
+    @property
+    def keyset_next_url(self):
+        if ORDER_VAR in self.params or len(self.result_list) < self.list_per_page:
+            return None
+        last = getattr(self.result_list[len(self.result_list) - 1], self.keyset_field)
+        return self.get_query_string(
+            {'%s__gt' % self.keyset_field: last}, remove=[PAGE_VAR])
+
+
+@admin.register(Organization)
+class OrganizationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'phone')
+    search_fields = ('name',)
+    ordering = ('id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_deleted_objects(self, objs, request):
+        # users are detached by the delete job, don't collect every one of them
+        perms_needed = set()
+        if not self.has_delete_permission(request):
+            perms_needed.add(self.opts.verbose_name)
+        deleted = ['%s: %s' % (self.opts.verbose_name.capitalize(), obj) for obj in objs]
+        return deleted, {self.opts.verbose_name_plural: len(deleted)}, perms_needed, []
+
+    def delete_model(self, request, obj):
+        job = schedule_organization_delete(obj, user=request.user)
+        self.message_user(request, 'Deleting “%s” in the background, %d users to detach.'
+                          % (obj, job.total))
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            self.delete_model(request, obj)
+
+
+@admin.register(OrganizationJob)
+class OrganizationJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'action', 'organization_id', 'target_id', 'status',
+                    'processed', 'total', 'percent', 'updated_at')
+    list_filter = ('status', 'action')
+    ordering = ('-id',)
+
+    def percent(self, obj):
+        return '%.0f%%' % (obj.progress * 100)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
 
 @admin.register(User)
 class AdminUser(auth_admin.UserAdmin):
@@ -32,7 +154,24 @@ class AdminUser(auth_admin.UserAdmin):
     add_form = UserCreationForm
     change_password_form = auth_admin.AdminPasswordChangeForm
     list_display = ('id', 'email', 'name', 'organization', 'is_staff')
-    list_filter = ('phone', 'organization', 'is_staff', 'is_superuser', 'is_active', 'groups')
+    list_select_related = ('organization',)
+    list_filter = (PhoneFilter, OrganizationFilter, 'is_staff', 'is_superuser',
+                   'is_active', 'groups')
     search_fields = ('name', 'email')
     ordering = ('email',)
     readonly_fields = ('last_login', 'date_joined',)
+    # render only the selected related objects, not every row of the table
+    autocomplete_fields = ('organization', 'groups')
+    raw_id_fields = ('user_permissions',)
+    filter_horizontal = ()
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        # a full address is looked up by the email key index, not a LIKE scan
+        if '@' in search_term and ' ' not in search_term.strip():
+            return queryset.filter(email_key=search_term.strip().lower()), False
+        return super().get_search_results(request, queryset, search_term)
@@ -0,0 +1,501 @@
+"""
+API benchmark against synthetic organizations.
+
+`generate_tenants` bulk inserts organizations with a realistic group mix and
+`run_benchmark` exercises every endpoint as the organization administrator,
+reporting throughput, latency percentiles and queries per request.
+`measure_formats` compares JSON and MessagePack payloads of the users,
+`measure_compression` the CPU time of each response encoding against the
+bytes it saves, `measure_password_validation` the cost per user of the
+password checks of an account import, and
+`measure_sqlite_concurrency` compares concurrent reads and writes of several
+processes on a SQLite file with the default backend and the performance one.
+Used by `manage.py bench`.
+"""
+
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import msgpack
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.password_validation import (
+    get_default_password_validators, get_password_validators,
+    validate_password as django_validate_password
+)
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import F
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from project.compression import get_codecs
+from project.renderers import JSONRenderer, MessagePackRenderer
+
+from .constants import ADMIN, VIEWER
+from .models import User, Organization, SyncCounter
+from .passwords import PasswordPolicy
+from .registry import group_registry
+from .stats import rebuild as rebuild_stats
+
+BENCH_PASSWORD = 'bench-password'
+
+# share of users in each group, the rest have no role
+GROUP_MIX = ((ADMIN, 0.02), (VIEWER, 0.18))
+
+
+def generate_tenants(orgs=1, users=1000, batch_size=5000, seed=0):
+    """
+    Create `orgs` organizations of `users` users each with bulk inserts.
+    The first user of each organization is an administrator and the second
+    a viewer, the rest follow `GROUP_MIX`. Returns the organizations.
+    """
+    rng = random.Random(seed)
+    password = make_password(BENCH_PASSWORD)
+    Through = User.groups.through
+    group_ids = {name: group_registry.id_for(name) for name, _ in GROUP_MIX}
+    born = datetime(1960, 1, 1)
+    organizations = []
+
+    for n in range(orgs):
+        org = Organization.objects.create(
+            name='Bench %d' % n, phone='%07d' % n, address='Bench st. %d' % n)
+        organizations.append(org)
+
+        for start in range(0, users, batch_size):
+            User.objects.bulk_create([
+                User(email='user%d@org%d.bench.org' % (i, n),
+                     name='User %d' % i,
+                     phone='%010d' % rng.randrange(10 ** 10),
+                     birthdate=born + timedelta(days=rng.randrange(365 * 45)),
+                     password=password,
+                     organization=org)
+                for i in range(start, min(start + batch_size, users))
+            ], batch_size=batch_size)
+
+        user_ids = list(User.objects.filter(organization=org)
+                        .order_by('id').values_list('id', flat=True))
+        memberships = []
+        for i, user_id in enumerate(user_ids):
+            if i < len(GROUP_MIX):
+                name = GROUP_MIX[i][0]
+            else:
+                name, roll = None, rng.random()
+                for group, share in GROUP_MIX:
+                    if roll < share:
+                        name = group
+                        break
+                    roll -= share
+            if name is not None:
+                memberships.append(Through(user_id=user_id, group_id=group_ids[name]))
+        Through.objects.bulk_create(memberships, batch_size=batch_size)
+        # bulk inserts skip the signals maintaining the statistics
+        rebuild_stats(org.pk)
+
+    return organizations
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of sorted `values`.
+    """
+    index = max(int(round(p / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def get_scenarios(org, admin, victims):
+    """
+    Return (name, method, path factory, data) for every endpoint.
+    """
+    users = list(User.objects.filter(organization=org)
+                 .order_by('id').values_list('id', flat=True)[:100])
+    deep_offset = max(User.objects.filter(organization=org).count() - 10, 0)
+    sample = User.objects.filter(pk=users[-1]).first()
+    pick = iter(victims)
+
+    return [
+        ('login', 'post', lambda i: '/api/auth/login/',
+         {'email': admin.email, 'password': BENCH_PASSWORD}),
+        ('users_list', 'get', lambda i: '/api/users/', None),
+        ('users_search', 'get', lambda i: '/api/users/?search=%s' % sample.name, None),
+        ('users_filter', 'get', lambda i: '/api/users/?phone=%s' % sample.phone, None),
+        ('users_deep_page', 'get',
+         lambda i: '/api/users/?limit=10&offset=%d' % deep_offset, None),
+        ('users_retrieve', 'get',
+         lambda i: '/api/users/%d/' % users[i % len(users)], None),
+        ('org_retrieve', 'get', lambda i: '/api/organizations/%d/' % org.id, None),
+        ('org_stats', 'get', lambda i: '/api/organizations/%d/stats/' % org.id, None),
+        ('org_users_list', 'get',
+         lambda i: '/api/organizations/%d/users/' % org.id, None),
+        ('org_users_retrieve', 'get',
+         lambda i: '/api/organizations/%d/users/%d/' % (org.id, users[i % len(users)]), None),
+        ('info', 'get', lambda i: '/api/info/', None),
+        ('groups', 'get', lambda i: '/api/auth/groups/', None),
+        ('users_patch', 'patch',
+         lambda i: '/api/users/%d/' % users[i % len(users)], {'phone': '5555555'}),
+        ('users_delete', 'delete', lambda i: '/api/users/%d/' % next(pick), None),
+    ]
+
+
+def run_benchmark(org, requests=50):
+    """
+    Run `requests` timed requests per endpoint, plus one untimed request to
+    count queries. Returns a report by endpoint.
+    """
+    admin = User.objects.filter(organization=org).order_by('id').first()
+
+    # dedicated users for the DELETE endpoint
+    User.objects.bulk_create([
+        User(email='victim%d@org%d.bench.org' % (i, org.id), name='Victim %d' % i,
+             password=admin.password, organization=org)
+        for i in range(requests + 1)
+    ])
+    victims = list(User.objects.filter(email__startswith='victim', organization=org)
+                   .values_list('id', flat=True))
+
+    client = Client()
+    client.defaults['HTTP_AUTHORIZATION'] = 'Bearer %s' % AccessToken.for_user(admin)
+    report = {}
+
+    for name, method, path, data in get_scenarios(org, admin, victims):
+        send = getattr(client, method)
+        kwargs = {'content_type': 'application/json'} if data is not None else {}
+        args = (data,) if data is not None else ()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = send(path(0), *args, **kwargs)
+        # read it now, every request resets the connection query log
+        query_count = len(queries)
+
+        latencies = []
+        started = time.perf_counter()
+        for i in range(1, requests + 1):
+            start = time.perf_counter()
+            send(path(i), *args, **kwargs)
+            latencies.append(time.perf_counter() - start)
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        report[name] = {
+            'status': response.status_code,
+            'requests': requests,
+            'throughput_rps': round(requests / elapsed, 2) if elapsed else None,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'queries': query_count,
+        }
+    return report
+
+
+def measure_lean_api(org, requests=200, rounds=5):
+    """
+    Compare the per-request time of `/api/info/` with the lean API middleware
+    stack against the full stack, interleaving rounds to reduce noise.
+    """
+    admin = User.objects.filter(organization=org).order_by('id').first()
+    client = Client(HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(admin))
+    results = {'full': [], 'lean': []}
+
+    for _ in range(rounds):
+        # an unmatched prefix sends every request through the full stack
+        for mode, prefix in (('full', '/-/'), ('lean', '/api/')):
+            with override_settings(LEAN_API_PREFIX=prefix):
+                start = time.perf_counter()
+                for _ in range(requests):
+                    client.get('/api/info/')
+                results[mode].append((time.perf_counter() - start) / requests)
+
+    full = sorted(results['full'])[rounds // 2] * 1000
+    lean = sorted(results['lean'])[rounds // 2] * 1000
+    return {'full_ms': round(full, 3), 'lean_ms': round(lean, 3),
+            'saved_ms': round(full - lean, 3)}
+
+
+def measure_event_stream(org, requests=100):
+    """
+    Compare the load of a client polling the organization users and details
+    against an event stream: the idle change feed check of each keepalive
+    and the formatting of one change event.
+    """
+    from .events import fetch_changes, format_event
+    from .sync import get_changes
+
+    admin = User.objects.filter(organization=org).order_by('id').first()
+    client = Client(HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(admin))
+    urls = ('/api/users/', '/api/organizations/%d/' % org.id)
+
+    def cycle():
+        return sum(len(client.get(url).content) for url in urls)
+
+    with CaptureQueriesContext(connection) as queries:
+        poll_bytes = cycle()
+    poll_queries = len(queries)
+    start = time.perf_counter()
+    for _ in range(requests):
+        cycle()
+    poll = (time.perf_counter() - start) / requests
+
+    changes, _, _ = get_changes(org, limit=1)
+    since = SyncCounter.objects.get(pk=1).value
+    with CaptureQueriesContext(connection) as queries:
+        fetch_changes(org.pk, since)
+    idle_queries = len(queries)
+    start = time.perf_counter()
+    for _ in range(requests):
+        fetch_changes(org.pk, since)
+    idle = (time.perf_counter() - start) / requests
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        event = format_event(changes[0])
+    event_time = (time.perf_counter() - start) / requests
+
+    return {
+        'poll_ms': round(poll * 1000, 3), 'poll_queries': poll_queries,
+        'poll_bytes': poll_bytes,
+        'stream_idle_ms': round(idle * 1000, 3), 'stream_idle_queries': idle_queries,
+        'event_ms': round(event_time * 1000, 3), 'event_bytes': len(event),
+    }
+
+
+def measure_formats(org, rounds=5):
+    """
+    Compare JSON and MessagePack on the users of the organization: payload
+    size, encode and decode time of the serialized users, and the time to
+    download the streamed export. Median of `rounds`.
+    """
+    admin = User.objects.filter(organization=org).order_by('id').first()
+    client = Client(HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(admin))
+    export_url = '/api/organizations/%d/users/export/' % org.id
+    response = client.get(export_url)
+    users = json.loads(b''.join(response.streaming_content))
+    formats = (
+        ('json', JSONRenderer(), json.loads, 'application/json'),
+        ('msgpack', MessagePackRenderer(), lambda body: msgpack.unpackb(body, raw=False),
+         'application/msgpack'),
+    )
+
+    def median(measure):
+        times = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            measure()
+            times.append(time.perf_counter() - start)
+        return round(sorted(times)[rounds // 2] * 1000, 3)
+
+    report = {'users': len(users)}
+    for name, renderer, decode, accept in formats:
+        body = renderer.render(users)
+        report[name] = {
+            'bytes': len(body),
+            'encode_ms': median(lambda: renderer.render(users)),
+            'decode_ms': median(lambda: decode(body)),
+            'export_ms': median(lambda: b''.join(
+                client.get(export_url, HTTP_ACCEPT=accept).streaming_content)),
+        }
+    return report
+
+
+def measure_compression(org, rounds=5):
+    """
+    Compress a page of 1000 users, in JSON and MessagePack, and the swagger
+    schema with every available encoding. Reports the bytes saved and the
+    median compression time, also per KiB saved.
+    """
+    admin = User.objects.filter(organization=org).order_by('id').first()
+    client = Client(HTTP_AUTHORIZATION='Bearer %s' % AccessToken.for_user(admin))
+    payloads = {
+        'users_json': client.get('/api/users/?limit=1000').content,
+        'users_msgpack': client.get('/api/users/?limit=1000',
+                                    HTTP_ACCEPT='application/msgpack').content,
+        'swagger': client.get('/api/docs/swagger.json').content,
+    }
+    report = {}
+    for payload, body in payloads.items():
+        report[payload] = {'bytes': len(body)}
+        for name, codec in get_codecs().items():
+            times = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                compressed = codec.compress(body)
+                times.append(time.perf_counter() - start)
+            elapsed = sorted(times)[rounds // 2]
+            saved = len(body) - len(compressed)
+            report[payload][name] = {
+                'bytes': len(compressed),
+                'ratio': round(len(body) / len(compressed), 2),
+                'compress_ms': round(elapsed * 1000, 3),
+                'us_per_saved_kib': round(elapsed * 1e6 / (saved / 1024), 2) if saved > 0 else None,
+            }
+    return report
+
+
+def measure_password_validation(users=100000, seed=0):
+    """
+    Validate the passwords of an import of `users` accounts, a tenth of them
+    weak, with Django's `validate_password` and the compiled
+    `PasswordPolicy`. Reports the cost per user and the one time cost of
+    compiling the policy, which loads the common password list.
+    """
+    rng = random.Random(seed)
+    accounts = []
+    for i in range(users):
+        user = User(email='user%d@org%d.import.org' % (i, i % 50), name='Imported User %d' % i)
+        roll = rng.random()
+        if roll < 0.04:
+            password = str(rng.randrange(10 ** 8))
+        elif roll < 0.07:
+            password = user.email.split('@')[0] + '!'
+        elif roll < 0.1:
+            password = 'pass%d' % i
+        else:
+            password = '%x-%s-%d' % (rng.getrandbits(32), 'horse', i)
+        accounts.append((password, user))
+
+    start = time.perf_counter()
+    policy = PasswordPolicy(get_password_validators(settings.AUTH_PASSWORD_VALIDATORS))
+    compile_ms = (time.perf_counter() - start) * 1000
+    validators = get_default_password_validators()
+
+    report = {'users': users, 'compile_ms': round(compile_ms, 3)}
+    for name, validate in (('django', lambda p, u: django_validate_password(p, u, validators)),
+                           ('policy', policy.validate)):
+        rejected = 0
+        start = time.perf_counter()
+        for password, user in accounts:
+            try:
+                validate(password, user)
+            except ValidationError:
+                rejected += 1
+        elapsed = time.perf_counter() - start
+        report[name] = {
+            'seconds': round(elapsed, 3),
+            'us_per_user': round(elapsed * 1e6 / users, 2),
+            'rejected': rejected,
+        }
+    return report
+
+
+SQLITE_ALIAS = 'sqlite_bench'
+
+# sqlite3 waits 5 seconds on a locked database by default
+SQLITE_MODES = (
+    ('default', 'django.db.backends.sqlite3', {'timeout': 5}),
+    ('performance', 'project.sqlite3', {'timeout': 5}),
+    ('single_writer', 'project.sqlite3', {'timeout': 5, 'single_writer': True}),
+)
+
+
+def use_sqlite_database(path, engine='django.db.backends.sqlite3', options=None):
+    """
+    Point `SQLITE_ALIAS` to the SQLite file `path`, None removes the alias.
+    """
+    if hasattr(connections._connections, SQLITE_ALIAS):
+        connections[SQLITE_ALIAS].close()
+        del connections[SQLITE_ALIAS]
+    if path is None:
+        connections.databases.pop(SQLITE_ALIAS, None)
+    else:
+        connections.databases[SQLITE_ALIAS] = {
+            'ENGINE': engine, 'NAME': path, 'OPTIONS': dict(options or {}),
+        }
+
+
+def sqlite_worker(org_id, user_ids, seconds, write_ratio, seed, results):
+    """
+    Read pages of users and, for `write_ratio` of the operations, rename a
+    user and take a sync token in a transaction reading before writing,
+    like the API does. Puts the counts and latencies on `results`.
+    """
+    rng = random.Random(seed)
+    users = User.objects.using(SQLITE_ALIAS)
+    counter = SyncCounter.objects.using(SQLITE_ALIAS)
+    report = {'reads': [], 'writes': [], 'errors': 0}
+    deadline = time.perf_counter() + seconds
+
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            if rng.random() < write_ratio:
+                pk = rng.choice(user_ids)
+                with transaction.atomic(using=SQLITE_ALIAS):
+                    name = users.values_list('name', flat=True).get(pk=pk)
+                    users.filter(pk=pk).update(name=name.split('#')[0] + '#%d' % rng.randrange(1000))
+                    counter.filter(pk=1).update(value=F('value') + 1)
+                report['writes'].append(time.perf_counter() - start)
+            else:
+                offset = rng.randrange(max(len(user_ids) - 50, 1))
+                list(users.filter(organization_id=org_id).order_by('id')
+                     .values('id', 'email', 'name', 'phone')[offset:offset + 50])
+                report['reads'].append(time.perf_counter() - start)
+        except OperationalError:
+            report['errors'] += 1
+    connections[SQLITE_ALIAS].close()
+    results.put(report)
+
+
+def measure_sqlite_concurrency(processes=4, seconds=2, users=2000, write_ratio=0.2):
+    """
+    Run `processes` forked workers for `seconds` against a migrated SQLite
+    file in each of `SQLITE_MODES`, every mode starting from a copy of the
+    same database. Errors are operations failing with "database is locked".
+    """
+    directory = tempfile.mkdtemp(prefix='sqlite-bench-')
+    template = os.path.join(directory, 'template.sqlite3')
+    fork = multiprocessing.get_context('fork')
+    report = {'processes': processes, 'seconds': seconds, 'write_ratio': write_ratio}
+
+    try:
+        use_sqlite_database(template)
+        call_command('migrate', database=SQLITE_ALIAS, verbosity=0, interactive=False)
+        Organization.objects.using(SQLITE_ALIAS).bulk_create([Organization(name='SQLite bench')])
+        org_id = Organization.objects.using(SQLITE_ALIAS).get(name='SQLite bench').pk
+        User.objects.using(SQLITE_ALIAS).bulk_create([
+            User(email='user%d@sqlite.bench.org' % i, name='User %d' % i,
+                 phone='%010d' % i, organization_id=org_id)
+            for i in range(users)
+        ], batch_size=5000)
+        user_ids = list(User.objects.using(SQLITE_ALIAS).values_list('id', flat=True))
+
+        for mode, engine, options in SQLITE_MODES:
+            path = os.path.join(directory, '%s.sqlite3' % mode)
+            use_sqlite_database(None)
+            shutil.copyfile(template, path)
+            # configured before forking, no connection is open yet
+            use_sqlite_database(path, engine, options)
+            results = fork.Queue()
+            workers = [
+                fork.Process(target=sqlite_worker,
+                             args=(org_id, user_ids, seconds, write_ratio, seed, results))
+                for seed in range(processes)
+            ]
+            for worker in workers:
+                worker.start()
+            reports = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+
+            reads = sorted(t for r in reports for t in r['reads'])
+            writes = sorted(t for r in reports for t in r['writes'])
+            report[mode] = {
+                'reads_per_second': round(len(reads) / seconds, 1),
+                'writes_per_second': round(len(writes) / seconds, 1),
+                'errors': sum(r['errors'] for r in reports),
+                'read_p50_ms': round(percentile(reads, 50) * 1000, 3) if reads else None,
+                'read_p99_ms': round(percentile(reads, 99) * 1000, 3) if reads else None,
+                'write_p50_ms': round(percentile(writes, 50) * 1000, 3) if writes else None,
+                'write_p99_ms': round(percentile(writes, 99) * 1000, 3) if writes else None,
+            }
+    finally:
+        use_sqlite_database(None)
+        shutil.rmtree(directory, ignore_errors=True)
+    return report
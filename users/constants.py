@@ -4,8 +4,8 @@ Constant used in tests and serializers definition
 
 USER_MODEL_FIELDS = (
     'id', 'organization', 'groups', 'password', 'last_login', 'is_superuser',
-    'email', 'name', 'birthdate', 'phone', 'date_joined', 'is_staff',
-    'is_active', 'user_permissions'
+    'updated_at', 'email', 'name', 'birthdate', 'phone', 'date_joined',
+    'is_staff', 'is_active', 'user_permissions'
 )
 
 USER_INFO_FIELDS = (
@@ -23,4 +23,11 @@ ORG_INFO_FIELDS = (
 )
 
 ADMIN = 'Administrator'
-VIEWER = 'Viewer'
\ No newline at end of file
+VIEWER = 'Viewer'
+
+# change feed page size
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_PAGE_SIZE = 1000
+
+# users per query of the streamed export
+EXPORT_BATCH_SIZE = 1000
@@ -0,0 +1,262 @@
+"""
+Server-sent events of organization changes.
+
+Model signals publish user and organization changes to `broker`, an in-process
+fan-out to the streams of each organization. `EventStreamApp` serves them at
+``/api/organizations/{id}/events/`` from the ASGI entry point, each event id
+is the sync token of the change feed, so clients reconnecting with
+`Last-Event-ID` get the changes they missed, replayed a page at a time.
+Writes made by other processes are picked from the change feed every
+`EVENTS_KEEPALIVE` seconds.
+
+Streams are opened with the access token in the Authorization header or, for
+EventSource clients which can't send one, a `StreamTicket` in ``?ticket=``
+from ``POST /api/organizations/{id}/events/ticket/``. Tickets only open the
+stream of their organization for `EVENTS_TICKET_SECONDS`, access tokens are
+kept out of URLs and logs.
+"""
+
+import asyncio
+import json
+import re
+import threading
+from datetime import timedelta
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed, TokenError
+from rest_framework_simplejwt.tokens import Token
+
+from .constants import CHANGES_PAGE_SIZE
+from .models import Organization
+from .permissions import UserOrgPermissions
+from .sharding import JWTAuthentication, organization_shard, use_shard
+from .sync import get_changes
+
+EVENTS_PATH = re.compile(r'^/api/organizations/(?P<org_id>\d+)/events/$')
+
+
+class Subscriber:
+    """
+    Event queue of a stream, `overflow` is set when the client falls behind.
+    """
+
+    def __init__(self, queue_size):
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(queue_size)
+        self.overflow = False
+
+
+class EventBroker:
+    """
+    Fans out events to the subscribers of an organization. Publishing is
+    thread safe, events are handed to the event loop of each subscriber.
+    """
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def has_subscribers(self, org_id):
+        return bool(self._subscribers.get(org_id))
+
+    def subscribe(self, org_id):
+        subscriber = Subscriber(self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(org_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, org_id, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(org_id, set())
+            subscribers.discard(subscriber)
+            if not subscribers:
+                self._subscribers.pop(org_id, None)
+
+    def publish(self, org_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(org_id, ()))
+        for subscriber in subscribers:
+            subscriber.loop.call_soon_threadsafe(self._put, subscriber, event)
+
+    @staticmethod
+    def _put(subscriber, event):
+        try:
+            subscriber.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # the client reconnects with Last-Event-ID and replays the feed
+            subscriber.overflow = True
+
+
+broker = EventBroker()
+
+
+def format_event(change):
+    return ('id: %d\nevent: %s.%s\ndata: %s\n\n' % (
+        change['token'], change['type'], change['action'],
+        json.dumps(change, cls=JSONEncoder))).encode()
+
+
+class StreamTicket(Token):
+    """
+    Short lived token opening the event stream of one organization, not
+    accepted as an access token.
+    """
+    token_type = 'stream'
+
+    @property
+    def lifetime(self):
+        return timedelta(seconds=settings.EVENTS_TICKET_SECONDS)
+
+    @classmethod
+    def for_organization(cls, user, org_id):
+        ticket = cls.for_user(user)
+        ticket['org_id'] = int(org_id)
+        return ticket
+
+
+def authorize(headers, query, org_id):
+    """
+    Return the status code for the stream, 200 if the user of the access
+    token or stream ticket passes `UserOrgPermissions` for the organization.
+    """
+    raw = headers.get(b'authorization', b'').decode()
+    ticket = query.get('ticket', [None])[0]
+    authentication = JWTAuthentication()
+    try:
+        if raw.startswith('Bearer '):
+            token = authentication.get_validated_token(raw[len('Bearer '):])
+        elif ticket:
+            token = StreamTicket(ticket)
+            if token.get('org_id') != int(org_id):
+                return 403
+        else:
+            return 401
+        user = authentication.get_user(token)
+    except (InvalidToken, AuthenticationFailed, TokenError):
+        return 401
+    request = SimpleNamespace(method='GET', user=user)
+    view = SimpleNamespace(kwargs={'org_id': org_id})
+    with use_shard(user._state.db):
+        allowed = UserOrgPermissions().has_permission(request, view)
+    return 200 if allowed else 403
+
+
+def fetch_changes(org_id, since):
+    """
+    The next page of changes of the organization after `since`, as
+    (changes, has more).
+    """
+    organization = Organization(pk=org_id)
+    with use_shard(organization_shard(org_id)):
+        changes, _, has_more = get_changes(organization, since, CHANGES_PAGE_SIZE)
+    return changes, has_more
+
+
+class EventStreamApp:
+    """
+    ASGI application serving the organization event streams, every other
+    request is passed to `application`.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        match = EVENTS_PATH.match(scope.get('path', '')) if scope['type'] == 'http' else None
+        if match is None:
+            return await self.application(scope, receive, send)
+
+        org_id = match.group('org_id')
+        headers = dict(scope.get('headers', ()))
+        query = parse_qs(scope.get('query_string', b'').decode())
+        code = await sync_to_async(self.authorize, thread_sensitive=True)(headers, query, org_id)
+        if code != 200:
+            await send({'type': 'http.response.start', 'status': code,
+                        'headers': [(b'content-type', b'application/json')]})
+            detail = b'Not authenticated' if code == 401 else b'Forbidden'
+            await send({'type': 'http.response.body', 'body': b'{"detail": "%s"}' % detail})
+            return
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        await self.stream(int(org_id), headers, query, receive, send)
+
+    def authorize(self, headers, query, org_id):
+        close_old_connections()
+        try:
+            return authorize(headers, query, org_id)
+        finally:
+            close_old_connections()
+
+    def fetch(self, org_id, since):
+        close_old_connections()
+        try:
+            return fetch_changes(org_id, since)
+        finally:
+            close_old_connections()
+
+    async def stream(self, org_id, headers, query, receive, send):
+        keepalive = getattr(settings, 'EVENTS_KEEPALIVE', 15)
+        last = headers.get(b'last-event-id', b'').decode() or query.get('since', [None])[0]
+        subscriber = broker.subscribe(org_id)
+        disconnect = asyncio.ensure_future(self.disconnected(receive))
+        try:
+            since = int(last) if last and last.isdigit() else None
+            if since is not None:
+                changes, has_more = await sync_to_async(self.fetch, thread_sensitive=True)(
+                    org_id, since)
+            else:
+                changes, has_more = [], False
+                since = await sync_to_async(self.current_token, thread_sensitive=True)()
+
+            while not subscriber.overflow:
+                for change in changes:
+                    if change['token'] > since:
+                        await send({'type': 'http.response.body',
+                                    'body': format_event(change), 'more_body': True})
+                        since = change['token']
+                if has_more:
+                    # replay the feed a page at a time
+                    changes, has_more = await sync_to_async(self.fetch, thread_sensitive=True)(
+                        org_id, since)
+                    continue
+
+                getter = asyncio.ensure_future(subscriber.queue.get())
+                done, _ = await asyncio.wait({getter, disconnect}, timeout=keepalive,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnect in done:
+                    getter.cancel()
+                    break
+                if getter in done:
+                    changes, has_more = [getter.result()], False
+                    continue
+                getter.cancel()
+                # catch up with writes of other processes
+                changes, has_more = await sync_to_async(self.fetch, thread_sensitive=True)(
+                    org_id, since)
+                if not changes:
+                    await send({'type': 'http.response.body',
+                                'body': b': keepalive\n\n', 'more_body': True})
+        finally:
+            broker.unsubscribe(org_id, subscriber)
+            disconnect.cancel()
+        if subscriber.overflow:
+            await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    async def disconnected(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    def current_token(self):
+        from .models import SyncCounter
+        return SyncCounter.objects.filter(pk=1).values_list('value', flat=True).first() or 0
@@ -0,0 +1,25 @@
+from django.db import models
+
+
+class LowercaseKeyField(models.CharField):
+    """
+    Lowercase copy of the `source` field, set on every save and bulk insert,
+    for case insensitive lookups through a plain index.
+    """
+
+    def __init__(self, *args, source=None, **kwargs):
+        self.source = source
+        kwargs.setdefault('editable', False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        kwargs.pop('editable', None)
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.source)
+        value = value.lower() if value else value
+        setattr(model_instance, self.attname, value)
+        return value
@@ -1,6 +1,8 @@
 from django import forms
 from django.contrib.auth import forms as auth_forms
 from .models import User
+from .passwords import validate_password
+from .sharding import validate_unique_email
 
 
 class UserCreationForm(forms.ModelForm):
@@ -15,6 +17,9 @@ class UserCreationForm(forms.ModelForm):
         model = User
         fields = ('email', 'name')
 
+    def clean_email(self):
+        return validate_unique_email(self.cleaned_data['email'], self.instance.pk)
+
     def clean_password2(self):
         password1 = self.cleaned_data.get("password1")
         password2 = self.cleaned_data.get("password2")
@@ -25,6 +30,16 @@ class UserCreationForm(forms.ModelForm):
             )
         return password2
 
+    def _post_clean(self):
+        super()._post_clean()
+        # validated once the instance carries the email and name
+        password = self.cleaned_data.get('password2')
+        if password:
+            try:
+                validate_password(password, self.instance)
+            except forms.ValidationError as error:
+                self.add_error('password2', error)
+
     def save(self, commit=True):
         user = super(UserCreationForm, self).save(commit=False)
         user.set_password(self.cleaned_data["password1"])
@@ -49,5 +64,8 @@ class UserChangeForm(forms.ModelForm):
         if f is not None:
             f.queryset = f.queryset.select_related('content_type')
 
+    def clean_email(self):
+        return validate_unique_email(self.cleaned_data['email'], self.instance.pk)
+
     def clean_password(self):
         return self.initial["password"]
\ No newline at end of file
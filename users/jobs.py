@@ -0,0 +1,177 @@
+"""
+Chunked deletion of organizations and moves of their users.
+
+Detaching the users of a large organization in a single UPDATE locks the
+users table for the whole statement. These jobs move at most
+`ORGANIZATION_JOB_BATCH_SIZE` users per short transaction, giving every
+moved user a new sync token and a tombstone in the change feed of the
+organization it left. Jobs run on the task queue once scheduled, and
+`manage.py organization_jobs` resumes the ones interrupted by a crash. The
+admin delete view and action, `Organization.delete()` and the delete of an
+organization queryset queue a delete job. Group assignments to many users run as queue tasks too,
+a batch of users per transaction.
+
+With `USER_SHARDS` jobs run on the shard of the organization, users moved
+to an organization placed on another shard are copied there batch by batch.
+"""
+
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.utils import timezone
+
+from jobs.queue import enqueue
+
+from .models import User, Organization, OrganizationJob, SyncCounter, Tombstone
+from .sharding import (
+    copy_users, delete_users, organization_shard, point_directory, use_shard
+)
+from .stats import rebuild as rebuild_stats
+
+
+def schedule_organization_delete(organization, user=None, background=True):
+    """
+    Delete `organization` in the background, returns the job.
+    """
+    return schedule(OrganizationJob.DELETE, organization, None, user, background)
+
+
+def schedule_users_move(organization, target, user=None, background=True):
+    """
+    Move every user of `organization` to `target` in the background,
+    returns the job.
+    """
+    return schedule(OrganizationJob.MOVE, organization, target, user, background)
+
+
+def schedule(action, organization, target=None, user=None, background=True):
+    """
+    Create the job, and with `background` queue the task running it for
+    `user`, available as `job.task`.
+    """
+    with transaction.atomic(), use_shard(organization_shard(organization.pk)):
+        job = OrganizationJob.objects.create(
+            action=action, organization_id=organization.pk,
+            target_id=target.pk if target is not None else None,
+            total=User.objects.filter(organization_id=organization.pk).count())
+        if background:
+            job.task = enqueue('users.organization_job', user=user,
+                               organization_id=organization.pk, total=job.total,
+                               organization_job=job.pk)
+            job.save(update_fields=['task'])
+    return job
+
+
+def move_batch(job, batch_size):
+    """
+    Move the next batch of users of the job organization, returns the number
+    of users moved.
+    """
+    source = organization_shard(job.organization_id)
+    target = organization_shard(job.target_id) if job.target_id is not None else source
+    # reserved in a short transaction of their own, the counter lock would
+    # hold every other write back for the whole batch otherwise. Unused
+    # tokens of the last batch are just skipped by the change feed.
+    token = SyncCounter.reserve_tokens(2 * batch_size)
+    with transaction.atomic(), transaction.atomic(using=source), use_shard(source):
+        # write first, SQLite can't upgrade a read transaction to a write
+        # one while other writers wait
+        OrganizationJob.objects.filter(pk=job.pk).update(updated_at=timezone.now())
+        users = list(User.objects.filter(organization_id=job.organization_id)
+                     .order_by('id').only('id', 'organization_id')[:batch_size])
+        if not users:
+            return 0
+
+        now = timezone.now()
+        tombstones = []
+        for user in users:
+            tombstones.append(Tombstone(
+                organization_id=job.organization_id, model=Tombstone.USER,
+                object_id=user.pk, sync_token=token))
+            user.organization_id = job.target_id
+            user.sync_token = token + 1
+            user.updated_at = now
+            token += 2
+        Tombstone.objects.bulk_create(tombstones)
+        User.objects.bulk_update(users, ['organization', 'sync_token', 'updated_at'])
+        if target != source:
+            ids = [user.pk for user in users]
+            copy_users(ids, source, target)
+            point_directory(ids, target)
+            delete_users(ids, source)
+
+        job.processed += len(users)
+        job.save(update_fields=['processed', 'updated_at'])
+    return len(users)
+
+
+def run_job(job_id, batch_size=None, progress=None):
+    """
+    Run the job until every user is moved, then delete the organization of a
+    delete job. `progress` is called with the job after every batch.
+    """
+    batch_size = batch_size or settings.ORGANIZATION_JOB_BATCH_SIZE
+    pause = settings.ORGANIZATION_JOB_PAUSE
+    job = OrganizationJob.objects.get(pk=job_id)
+    if job.status == OrganizationJob.DONE:
+        return job
+
+    job.status = OrganizationJob.RUNNING
+    job.error = ''
+    job.save(update_fields=['status', 'error', 'updated_at'])
+    try:
+        while move_batch(job, batch_size):
+            if progress is not None:
+                progress(job)
+            if pause:
+                # let the writes of the requests through
+                time.sleep(pause)
+
+        if job.action == OrganizationJob.MOVE:
+            # bulk updates skip the signals maintaining the statistics
+            rebuild_stats(job.organization_id)
+            rebuild_stats(job.target_id)
+        if job.action == OrganizationJob.DELETE:
+            shard = organization_shard(job.organization_id)
+            # no users are left to detach, this is a single row delete
+            Organization.objects.filter(pk=job.organization_id).delete_now()
+            if shard not in (None, DEFAULT_DB_ALIAS):
+                Organization.objects.using(shard).filter(pk=job.organization_id)._raw_delete(shard)
+        job.status = OrganizationJob.DONE
+        job.save(update_fields=['status', 'updated_at'])
+    except Exception as e:
+        job.status = OrganizationJob.FAILED
+        job.error = str(e)
+        job.save(update_fields=['status', 'error', 'updated_at'])
+        raise
+    return job
+
+
+def assign_groups(organization_id, user_ids, group_ids, batch_size=None, progress=None):
+    """
+    Set the groups of the users of the organization among `user_ids` to
+    `group_ids`, returns the number of users updated. `progress` is called
+    with that number after every batch. Running it again is harmless.
+    """
+    batch_size = batch_size or settings.ORGANIZATION_JOB_BATCH_SIZE
+    shard = organization_shard(organization_id)
+    done = 0
+    for start in range(0, len(user_ids), batch_size):
+        with transaction.atomic(using=shard), use_shard(shard):
+            users = User.objects.filter(
+                organization_id=organization_id, pk__in=user_ids[start:start + batch_size])
+            for user in users:
+                # one user at a time, the role statistics follow the memberships
+                user.groups.set(group_ids)
+                done += 1
+        if progress is not None:
+            progress(done)
+    return done
+
+
+def pending_jobs():
+    """
+    Return the jobs left unfinished, oldest first.
+    """
+    return OrganizationJob.objects.exclude(status=OrganizationJob.DONE).order_by('id')
@@ -0,0 +1,98 @@
+import json
+import platform
+import subprocess
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import (
+    override_settings,
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment
+)
+
+from users.benchmark import (
+    generate_tenants, measure_compression, measure_event_stream, measure_formats,
+    measure_lean_api, measure_password_validation, measure_sqlite_concurrency, run_benchmark
+)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ('Benchmark every API endpoint against synthetic organizations '
+            'created in a throwaway test database, reports JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orgs', type=int, default=1,
+                            help='Number of organizations to create.')
+        parser.add_argument('--users', type=int, default=1000,
+                            help='Users per organization.')
+        parser.add_argument('--requests', type=int, default=50,
+                            help='Timed requests per endpoint.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows per bulk insert.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--sqlite-processes', type=int, default=4,
+                            help='Processes of the SQLite concurrency benchmark.')
+        parser.add_argument('--sqlite-seconds', type=float, default=2,
+                            help='Seconds per SQLite mode, 0 skips the benchmark.')
+        parser.add_argument('--password-users', type=int, default=100000,
+                            help='Accounts of the password validation benchmark, 0 skips it.')
+        parser.add_argument('--output', help='Write the report to this file.')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        # keep the throttle checks in the measurements without limiting the load
+        unthrottled = override_settings(THROTTLE_BUCKETS={
+            scope: {dimension: '%d/s' % 10 ** 9 for dimension in buckets}
+            for scope, buckets in settings.THROTTLE_BUCKETS.items()
+        })
+        unthrottled.enable()
+        try:
+            start = time.perf_counter()
+            organizations = generate_tenants(
+                orgs=options['orgs'], users=options['users'],
+                batch_size=options['batch_size'], seed=options['seed'])
+            generation = time.perf_counter() - start
+
+            report = {
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'machine': platform.platform(),
+                'orgs': options['orgs'],
+                'users_per_org': options['users'],
+                'generation_seconds': round(generation, 3),
+                'endpoints': run_benchmark(organizations[0], options['requests']),
+                'lean_api_middleware': measure_lean_api(organizations[0]),
+                'event_stream': measure_event_stream(organizations[0]),
+                'formats': measure_formats(organizations[0]),
+                'compression': measure_compression(organizations[0]),
+            }
+            if options['sqlite_seconds']:
+                report['sqlite_concurrency'] = measure_sqlite_concurrency(
+                    processes=options['sqlite_processes'], seconds=options['sqlite_seconds'])
+            if options['password_users']:
+                report['password_validation'] = measure_password_validation(
+                    users=options['password_users'], seed=options['seed'])
+        finally:
+            unthrottled.disable()
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
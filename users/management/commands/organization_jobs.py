@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.jobs import (
+    pending_jobs, run_job, schedule_organization_delete, schedule_users_move
+)
+from users.models import Organization
+
+
+class Command(BaseCommand):
+    help = ('Delete an organization or move its users in batches, without '
+            'arguments resume the unfinished organization jobs.')
+
+    def add_arguments(self, parser):
+        action = parser.add_mutually_exclusive_group()
+        action.add_argument('--delete', type=int, metavar='ORG_ID',
+                            help='Delete the organization.')
+        action.add_argument('--move', type=int, nargs=2, metavar=('ORG_ID', 'TARGET_ID'),
+                            help='Move the users of an organization to the target one.')
+        parser.add_argument('--batch-size', type=int,
+                            help='Users moved per transaction.')
+
+    def get_organization(self, pk):
+        try:
+            return Organization.objects.get(pk=pk)
+        except Organization.DoesNotExist:
+            raise CommandError('Organization %s does not exist' % pk)
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            jobs = [schedule_organization_delete(
+                self.get_organization(options['delete']), background=False)]
+        elif options['move']:
+            source, target = (self.get_organization(pk) for pk in options['move'])
+            jobs = [schedule_users_move(source, target, background=False)]
+        else:
+            jobs = list(pending_jobs())
+
+        for job in jobs:
+            self.stdout.write('%s: %d users' % (job, job.total))
+            job = run_job(job.pk, options['batch_size'], progress=self.report)
+            self.stdout.write(self.style.SUCCESS('%s: %d users' % (job, job.processed)))
+
+    def report(self, job):
+        self.stdout.write('  %d/%d users (%.0f%%)' % (
+            job.processed, job.total, job.progress * 100))
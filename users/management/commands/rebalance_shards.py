@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from users.models import Organization
+from users.sharding import get_shards, hash_shard, move_organization
+
+
+class Command(BaseCommand):
+    help = ('Move organizations to the shard their id hashes to, after shards '
+            'are added or for organizations created before sharding was enabled.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization', type=int, metavar='ORG_ID',
+                            help='Move only this organization.')
+        parser.add_argument('--to', metavar='SHARD',
+                            help='Shard to move the organization to, by default the one '
+                                 'its id hashes to.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Users copied per batch.')
+        parser.add_argument('--wait', type=float,
+                            help='Seconds to wait before deleting the moved rows from the '
+                                 'previous shard, by default SHARD_PLACEMENT_TTL.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='List the moves without making them.')
+
+    def handle(self, *args, **options):
+        shards = get_shards()
+        if not shards:
+            raise CommandError('Sharding is disabled, USER_SHARDS is empty')
+        if options['to'] is not None and options['to'] not in shards:
+            raise CommandError('Unknown shard %s, expected one of %s' % (
+                options['to'], ', '.join(shards)))
+
+        organizations = Organization.objects.order_by('pk')
+        if options['organization'] is not None:
+            organizations = organizations.filter(pk=options['organization'])
+            if not organizations.exists():
+                raise CommandError('Organization %s does not exist' % options['organization'])
+        elif options['to'] is not None:
+            raise CommandError('--to needs --organization')
+
+        for organization in organizations.iterator():
+            target = options['to'] or hash_shard(organization.pk)
+            source = organization.shard or DEFAULT_DB_ALIAS
+            if source == target:
+                continue
+            self.stdout.write('%s (%s): %s -> %s' % (organization, organization.pk, source, target))
+            if options['dry_run']:
+                continue
+            moved = move_organization(
+                organization, target, options['batch_size'], options['wait'],
+                progress=lambda count: self.stdout.write('  %d users copied' % count))
+            self.stdout.write(self.style.SUCCESS('  %d users moved' % moved))
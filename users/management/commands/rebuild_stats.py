@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.models import Organization
+from users.stats import rebuild
+
+
+class Command(BaseCommand):
+    help = ('Recount the statistics rollups of the organizations from their users, '
+            'after bulk imports or to repair drifted counts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--organization', type=int, metavar='ORG_ID',
+                            help='Rebuild only this organization.')
+
+    def handle(self, *args, **options):
+        organizations = Organization.objects.order_by('pk')
+        if options['organization'] is not None:
+            organizations = organizations.filter(pk=options['organization'])
+            if not organizations.exists():
+                raise CommandError('Organization %s does not exist' % options['organization'])
+
+        for organization in organizations.iterator():
+            buckets = rebuild(organization.pk)
+            self.stdout.write('%s (%s): %d buckets' % (organization, organization.pk, buckets))
@@ -1,5 +1,9 @@
+from django.db import models
 from django.contrib.auth.base_user import BaseUserManager
 
+from .tenancy import get_binding
+
+
 class UserManager(BaseUserManager):
     use_in_migrations = True
 
@@ -15,6 +19,19 @@ class UserManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def filter_email(self, email):
+        """
+        Users with `email` in any case, an index probe of `email_key`.
+        """
+        return self.filter(email_key=email.lower())
+
+    def get_by_natural_key(self, email):
+        from .sharding import get_user_by_email, is_sharded
+
+        if self._db is None and is_sharded():
+            return get_user_by_email(email)
+        return self.filter_email(email).get()
+
     def create_user(self, email, password=None, **extra_fields):
         extra_fields.setdefault('is_superuser', False)
         return self._create_user(email, password, **extra_fields)
@@ -26,4 +43,59 @@ class UserManager(BaseUserManager):
         if extra_fields.get('is_superuser') is not True:
             raise ValueError('Superuser must have is_superuser=True.')
 
-        return self._create_user(email, password, **extra_fields)
\ No newline at end of file
+        return self._create_user(email, password, **extra_fields)
+
+
+class OrganizationQuerySet(models.QuerySet):
+
+    def delete(self):
+        """
+        Queue a delete job per organization, which detaches the users in
+        batches rather than in a single UPDATE, see `users.jobs`. Returns the
+        jobs, the organizations are gone once they are done.
+        """
+        from .jobs import schedule_organization_delete
+
+        return [schedule_organization_delete(organization) for organization in self.order_by('pk')]
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def delete_now(self):
+        """
+        Delete the organizations in place, as `QuerySet.delete`. Left to the
+        delete jobs, once no users are left to detach.
+        """
+        return super().delete()
+
+    delete_now.alters_data = True
+    delete_now.queryset_only = True
+
+
+class OrganizationScopedMixin:
+    """
+    Scopes querysets by the organization bound to the current request.
+    Outside of a request (shell, commands, migrations) querysets are not
+    scoped, inside one a user without organization sees nothing.
+    """
+    use_in_migrations = False
+    organization_lookup = 'organization_id'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        binding = get_binding()
+        if binding is None:
+            return queryset
+        org_id = binding.organization_id
+        if org_id is None:
+            return queryset.none()
+        return queryset.filter(**{self.organization_lookup: org_id})
+
+
+class TenantUserManager(OrganizationScopedMixin, UserManager):
+    pass
+
+
+class TenantOrganizationManager(OrganizationScopedMixin,
+                                models.Manager.from_queryset(OrganizationQuerySet)):
+    organization_lookup = 'pk'
@@ -0,0 +1,18 @@
+from .tenancy import bind_organization, unbind_organization
+
+
+class OrganizationMiddleware:
+    """
+    Binds the organization of the request user once per request, so the
+    tenant-aware managers scope every query by `organization_id`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = bind_organization(request)
+        try:
+            return self.get_response(request)
+        finally:
+            unbind_organization(token)
@@ -0,0 +1,87 @@
+# Generated by Django 3.1.5 on 2026-10-19 01:24
+
+from django.db import migrations, models
+
+
+def create_sync_counter(apps, schema_editor):
+    """
+    Give existing rows unique tokens, organizations first, and start the
+    counter after them.
+    """
+    SyncCounter = apps.get_model('users', 'SyncCounter')
+    Organization = apps.get_model('users', 'Organization')
+    User = apps.get_model('users', 'User')
+
+    last_org = Organization.objects.aggregate(last=models.Max('id'))['last'] or 0
+    last_user = User.objects.aggregate(last=models.Max('id'))['last'] or 0
+    Organization.objects.update(sync_token=models.F('id'), created_token=models.F('id'))
+    User.objects.update(sync_token=models.F('id') + last_org,
+                        created_token=models.F('id') + last_org)
+    SyncCounter.objects.update_or_create(pk=1, defaults={'value': last_org + last_user})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_auto_20210126_2343'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('organization_id', models.IntegerField()),
+                ('model', models.CharField(max_length=20)),
+                ('object_id', models.IntegerField()),
+                ('sync_token', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='created_token',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='sync_token',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='updated at'),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='created_token',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='sync_token',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='updated at'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['organization', 'sync_token'], name='users_user_organiz_ec8d0c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['organization_id', 'sync_token'], name='users_tombs_organiz_bb371e_idx'),
+        ),
+        migrations.RunPython(create_sync_counter, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.5 on 2026-10-19 01:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_sync_tokens'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrganizationJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('delete', 'delete organization'), ('move', 'move users')], max_length=10)),
+                ('organization_id', models.IntegerField()),
+                ('target_id', models.IntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='pending', max_length=10)),
+                ('total', models.IntegerField(default=0)),
+                ('processed', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='organizationjob',
+            index=models.Index(fields=['status'], name='users_organ_status_c7a890_idx'),
+        ),
+    ]
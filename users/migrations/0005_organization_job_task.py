@@ -0,0 +1,20 @@
+# Generated by Django 3.1.5 on 2026-10-19 01:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jobs', '0001_initial'),
+        ('users', '0004_organization_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='organizationjob',
+            name='task',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='jobs.job'),
+        ),
+    ]
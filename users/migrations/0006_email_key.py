@@ -0,0 +1,41 @@
+from django.db import migrations, models
+
+import users.fields
+
+
+def backfill_email_key(apps, schema_editor):
+    """
+    Fill the key in batches, emails differing only in case must be merged
+    by hand before the unique index is created.
+    """
+    User = apps.get_model('users', 'User')
+    batch = []
+    for user in User.objects.only('id', 'email').order_by('id').iterator(chunk_size=2000):
+        user.email_key = user.email.lower()
+        batch.append(user)
+        if len(batch) == 2000:
+            User.objects.bulk_update(batch, ['email_key'])
+            batch = []
+    User.objects.bulk_update(batch, ['email_key'])
+
+    duplicates = list(User.objects.values('email_key').annotate(count=models.Count('id'))
+                      .filter(count__gt=1).values_list('email_key', flat=True)[:10])
+    if duplicates:
+        raise RuntimeError('Emails registered more than once in different case: %s'
+                           % ', '.join(duplicates))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_organization_job_task'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='email_key',
+            field=users.fields.LowercaseKeyField(max_length=254, null=True, source='email'),
+        ),
+        migrations.RunPython(backfill_email_key, migrations.RunPython.noop),
+    ]
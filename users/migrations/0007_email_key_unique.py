@@ -0,0 +1,22 @@
+from django.db import migrations
+
+import users.fields
+
+
+class Migration(migrations.Migration):
+    """
+    Separate from the backfill, PostgreSQL can't alter a table with pending
+    updates in the same transaction.
+    """
+
+    dependencies = [
+        ('users', '0006_email_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='email_key',
+            field=users.fields.LowercaseKeyField(max_length=254, unique=True, source='email'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.1.5 on 2026-10-19 02:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_email_key_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserDirectory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email_key', models.CharField(max_length=254, unique=True)),
+                ('shard', models.CharField(max_length=30)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='organization',
+            name='shard',
+            field=models.CharField(blank=True, default='', editable=False, max_length=30),
+        ),
+    ]
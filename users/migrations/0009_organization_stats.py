@@ -0,0 +1,27 @@
+# Generated by Django 3.1.5 on 2026-10-19 02:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_sharding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrganizationStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('organization_id', models.IntegerField()),
+                ('dimension', models.CharField(max_length=20)),
+                ('bucket', models.CharField(max_length=20)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='organizationstat',
+            constraint=models.UniqueConstraint(fields=('organization_id', 'dimension', 'bucket'), name='unique_organization_stat'),
+        ),
+    ]
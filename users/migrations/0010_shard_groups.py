@@ -0,0 +1,38 @@
+from django.db import DEFAULT_DB_ALIAS, migrations
+
+# copied in order, every table refers to the previous ones
+MODELS = [
+    ('contenttypes', 'ContentType'),
+    ('auth', 'Permission'),
+    ('auth', 'Group'),
+]
+
+
+def copy_groups(apps, schema_editor):
+    """
+    Copy the groups and permissions of the default database to a user shard,
+    with their ids, which the memberships and the group registry refer to.
+    Rows already on the shard are kept, the default database is migrated
+    first.
+    """
+    alias = schema_editor.connection.alias
+    if alias == DEFAULT_DB_ALIAS:
+        return
+    models = [apps.get_model(app_label, name) for app_label, name in MODELS]
+    models.append(apps.get_model('auth', 'Group').permissions.through)
+    for model in models:
+        model.objects.using(alias).bulk_create(
+            model.objects.using(DEFAULT_DB_ALIAS).order_by('pk'), ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('users', '0009_organization_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_groups, migrations.RunPython.noop),
+    ]
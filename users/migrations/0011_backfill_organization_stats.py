@@ -0,0 +1,63 @@
+from django.db import DEFAULT_DB_ALIAS, migrations
+from django.db.models import Count
+from django.db.models.functions import TruncMonth
+
+# buckets as `users.stats` names them when this migration was written
+UNKNOWN = 'unknown'
+
+
+def month_bucket(value):
+    return value.strftime('%Y-%m') if value is not None else UNKNOWN
+
+
+def count_buckets(apps, organization):
+    User = apps.get_model('users', 'User')
+    Group = apps.get_model('auth', 'Group')
+    # users of sharded organizations live on their shard
+    users = User.objects.using(organization.shard or DEFAULT_DB_ALIAS).filter(
+        organization_id=organization.pk)
+    counts = {}
+    for field, dimension in (('date_joined', 'signups'), ('birthdate', 'birth_month')):
+        for month, count in (users.annotate(month=TruncMonth(field)).order_by()
+                             .values_list('month').annotate(n=Count('pk'))):
+            counts[dimension, month_bucket(month)] = count
+    for is_active, count in users.order_by().values_list('is_active').annotate(n=Count('pk')):
+        counts['status', 'active' if is_active else 'inactive'] = count
+
+    group_ids = dict(Group.objects.filter(name__in=['Administrator', 'Viewer'])
+                     .values_list('name', 'pk'))
+    admins = users.filter(groups=group_ids.get('Administrator'))
+    viewers = users.filter(groups=group_ids.get('Viewer')).exclude(pk__in=admins)
+    total = users.count()
+    counts['role', 'administrator'] = admins.count()
+    counts['role', 'viewer'] = viewers.count()
+    counts['role', 'none'] = total - counts['role', 'administrator'] - counts['role', 'viewer']
+    return {key: count for key, count in counts.items() if count}
+
+
+def backfill_stats(apps, schema_editor):
+    """
+    Count the users of the organizations created before the rollups.
+    """
+    if schema_editor.connection.alias != DEFAULT_DB_ALIAS:
+        return
+    Organization = apps.get_model('users', 'Organization')
+    OrganizationStat = apps.get_model('users', 'OrganizationStat')
+    for organization in Organization.objects.using(DEFAULT_DB_ALIAS).order_by('pk').iterator():
+        OrganizationStat.objects.filter(organization_id=organization.pk).delete()
+        OrganizationStat.objects.bulk_create([
+            OrganizationStat(organization_id=organization.pk, dimension=dimension,
+                             bucket=bucket, count=count)
+            for (dimension, bucket), count in count_buckets(apps, organization).items()
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_shard_groups'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,88 @@
+from functools import lru_cache
+
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import SAFE_METHODS
+
+
+@lru_cache(maxsize=None)
+def serializer_field_names(serializer_class):
+    """
+    Names of the fields of `serializer_class`, built once per class.
+    """
+    return tuple(serializer_class().fields)
+
+
+class SparseFieldsetMixin:
+    """
+    Supports `?fields=id,name` to trim the response and `?expand=organization`
+    to nest relations, on safe methods. Fields must be fields of the view
+    serializer. The selection is pushed down to SQL: only the requested
+    columns are loaded and only the requested relations are joined or
+    prefetched.
+    """
+    expandable_fields = ()
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    def _parse_param(self, name, allowed):
+        request = getattr(self, 'request', None)
+        if request is None or request.method not in SAFE_METHODS:
+            return None
+        value = request.query_params.get(name)
+        if value is None:
+            return None
+        selected = [f.strip() for f in value.split(',') if f.strip()]
+        unknown = set(selected) - set(allowed)
+        if unknown:
+            raise ValidationError({name: 'Unknown fields: %s' % ', '.join(sorted(unknown))})
+        return selected
+
+    def get_fields_param(self):
+        if not hasattr(self, '_fields_param'):
+            self._fields_param = self._parse_param(
+                'fields', serializer_field_names(self.get_serializer_class()))
+        return self._fields_param
+
+    def get_expand_param(self):
+        if not hasattr(self, '_expand_param'):
+            self._expand_param = self._parse_param('expand', self.expandable_fields)
+        return self._expand_param
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_fields_param()
+        if fields is not None:
+            kwargs['fields'] = fields
+            kwargs['expand'] = self.get_expand_param()
+        return super().get_serializer(*args, **kwargs)
+
+    def get_serialized_fields(self):
+        """
+        Names of the fields the response will contain.
+        """
+        fields = self.get_fields_param()
+        if fields is None:
+            return list(serializer_field_names(self.get_serializer_class()))
+        return fields
+
+    def sparse_queryset(self, queryset):
+        if self.request.method not in SAFE_METHODS:
+            return queryset
+        fields = self.get_serialized_fields()
+        expand = self.get_expand_param() or ()
+        if self.get_fields_param() is None:
+            expand = self.expandable_fields
+
+        opts = queryset.model._meta
+        columns = []
+        for name in fields:
+            field = opts.get_field(name)
+            if field.many_to_many:
+                if name in self.prefetch_related_fields:
+                    queryset = queryset.prefetch_related(name)
+            elif field.concrete:
+                columns.append(name)
+                if name in expand and name in self.select_related_fields:
+                    queryset = queryset.select_related(name)
+                    columns.extend('%s__%s' % (name, f)
+                                   for f in self.select_related_fields[name])
+        return queryset.only(*columns)
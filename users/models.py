@@ -1,24 +1,140 @@
-from django.db import models
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models, transaction
 from django.contrib.auth.models import PermissionsMixin
 from django.contrib.auth.base_user import AbstractBaseUser
 from django.utils.translation import ugettext_lazy as _
 
-from .managers import UserManager
+from .fields import LowercaseKeyField
+from .managers import (
+    OrganizationQuerySet, UserManager, TenantUserManager, TenantOrganizationManager
+)
+
+# user fields counted by the organization statistics, see `users.stats`
+STAT_FIELDS = ('organization_id', 'date_joined', 'birthdate', 'is_active')
 
 # Create your models here.
 
 
-class Organization(models.Model):
+class SyncCounter(models.Model):
+    """
+    Single row counter issuing the sync tokens of the change feed. The row
+    stays locked until the transaction of the write commits, so tokens become
+    visible in increasing order.
+    """
+    value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def next_token(cls):
+        return cls.reserve_tokens(1)
+
+    @classmethod
+    def reserve_tokens(cls, count):
+        """
+        Issue `count` consecutive tokens at once, returns the first one.
+        """
+        with transaction.atomic():
+            if not cls.objects.filter(pk=1).update(value=models.F('value') + count):
+                # flushed or restored database, tokens restart above the
+                # ones already stamped
+                cls.objects.bulk_create([cls(pk=1, value=cls.last_stamped())],
+                                        ignore_conflicts=True)
+                cls.objects.filter(pk=1).update(value=models.F('value') + count)
+            return cls.objects.values_list('value', flat=True).get(pk=1) - count + 1
+
+    @staticmethod
+    def last_stamped():
+        tokens = [0]
+        for alias in (DEFAULT_DB_ALIAS, *getattr(settings, 'USER_SHARDS', [])):
+            for model in (User, Organization, Tombstone):
+                tokens.append(model.objects.using(alias).aggregate(
+                    token=models.Max('sync_token'))['token'] or 0)
+        return max(tokens)
+
+
+class SyncTokenMixin(models.Model):
+    """
+    Stamps every save with a new sync token of the change feed, except the
+    saves of `unsynced_fields` only, which the feed doesn't expose.
+    """
+    unsynced_fields = frozenset()
+
+    updated_at = models.DateTimeField(_('updated at'), auto_now=True)
+    sync_token = models.BigIntegerField(default=0, editable=False)
+    created_token = models.BigIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and set(update_fields) <= self.unsynced_fields:
+            # no token, the save doesn't queue behind the counter row lock
+            return super().save(*args, **kwargs)
+        with transaction.atomic(using=kwargs.get('using')):
+            self.sync_token = SyncCounter.next_token()
+            if self._state.adding:
+                self.created_token = self.sync_token
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'updated_at', 'sync_token'}
+            super().save(*args, **kwargs)
+
+
+class Tombstone(models.Model):
+    """
+    Deleted users and organizations, and users moved out of an organization,
+    as seen by the change feed of the organization.
+    """
+    USER = 'user'
+    ORGANIZATION = 'organization'
+
+    organization_id = models.IntegerField()
+    model = models.CharField(max_length=20)
+    object_id = models.IntegerField()
+    sync_token = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['organization_id', 'sync_token'])]
+
+    @classmethod
+    def record(cls, organization_id, model, object_id):
+        with transaction.atomic():
+            # saved through the instance, routed to the organization shard
+            tombstone = cls(organization_id=organization_id, model=model, object_id=object_id,
+                            sync_token=SyncCounter.next_token())
+            tombstone.save(force_insert=True)
+            return tombstone
+
+
+class Organization(SyncTokenMixin, models.Model):
     name = models.CharField(default='', max_length=30, blank=True)
     phone = models.CharField(default='', max_length=20, blank=True)
     address = models.CharField(default='', max_length=100, blank=True)
+    # database of its users with USER_SHARDS, empty for the default one
+    shard = models.CharField(default='', max_length=30, blank=True, editable=False)
+
+    objects = OrganizationQuerySet.as_manager()
+    tenant_objects = TenantOrganizationManager()
 
     def __str__(self):
         return self.name
 
+    def delete(self, using=None, keep_parents=False):
+        """
+        Queue a delete job for the organization and return it, see
+        `OrganizationQuerySet.delete`.
+        """
+        from .jobs import schedule_organization_delete
+
+        return schedule_organization_delete(self)
 
-class User(AbstractBaseUser, PermissionsMixin):
+
+class User(SyncTokenMixin, AbstractBaseUser, PermissionsMixin):
     email = models.EmailField(_('email address'), unique=True)
+    # lookups by email go through this key, see `UserManager.filter_email`
+    email_key = LowercaseKeyField(max_length=254, unique=True, source='email')
     name = models.CharField(_('full name'), max_length=30, blank=True)
     birthdate = models.DateTimeField(_('birthdate'), null=True, blank=True)
     phone = models.CharField(_('phone'), max_length=20, null=True, blank=True)
@@ -31,6 +147,10 @@ class User(AbstractBaseUser, PermissionsMixin):
         Organization, null=True, blank=True, on_delete=models.SET_NULL)
 
     objects = UserManager()
+    tenant_objects = TenantUserManager()
+
+    # login updates, `update_last_login` saves `last_login` alone
+    unsynced_fields = frozenset({'last_login'})
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['name', ]
@@ -38,3 +158,96 @@ class User(AbstractBaseUser, PermissionsMixin):
     class Meta:
         verbose_name = _('user')
         verbose_name_plural = _('users')
+        indexes = [models.Index(fields=['organization', 'sync_token'])]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        # organization as loaded, users moving out leave a tombstone behind
+        user._loaded_organization_id = user.__dict__.get('organization_id')
+        # previous buckets of the organization statistics, see `users.stats`
+        user._loaded_stats = {name: user.__dict__.get(name, models.DEFERRED)
+                              for name in STAT_FIELDS}
+        return user
+
+    def save(self, *args, **kwargs):
+        from . import sharding
+
+        loaded = getattr(self, '_loaded_organization_id', None)
+        with ExitStack() as stack:
+            if sharding.is_sharded():
+                stack.enter_context(sharding.sharded_save(self, kwargs))
+            with transaction.atomic(using=kwargs.get('using')):
+                if loaded is not None and loaded != self.organization_id:
+                    Tombstone.record(loaded, Tombstone.USER, self.pk)
+                super().save(*args, **kwargs)
+        self._loaded_organization_id = self.organization_id
+        self._loaded_stats = {name: getattr(self, name) for name in STAT_FIELDS}
+
+
+class UserDirectory(models.Model):
+    """
+    Shard of every user with USER_SHARDS, see `users.sharding`. The ids of
+    new users are allocated here and the unique `email_key` keeps emails
+    unique across shards.
+    """
+    email_key = models.CharField(max_length=254, unique=True)
+    shard = models.CharField(max_length=30)
+
+
+class OrganizationStat(models.Model):
+    """
+    Users of an organization in a bucket of a statistic, maintained by
+    `users.stats`.
+    """
+    organization_id = models.IntegerField()
+    dimension = models.CharField(max_length=20)
+    bucket = models.CharField(max_length=20)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(
+            fields=['organization_id', 'dimension', 'bucket'], name='unique_organization_stat')]
+
+
+class OrganizationJob(models.Model):
+    """
+    Deletion of an organization or move of all its users to another one,
+    processed in batches by `users.jobs`. `processed` is saved with every
+    batch, so an interrupted job resumes where it stopped.
+    """
+    DELETE = 'delete'
+    MOVE = 'move'
+    ACTIONS = ((DELETE, _('delete organization')), (MOVE, _('move users')))
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = ((PENDING, _('pending')), (RUNNING, _('running')),
+                (DONE, _('done')), (FAILED, _('failed')))
+
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    # plain ids, the job outlives the deleted organization
+    organization_id = models.IntegerField()
+    target_id = models.IntegerField(null=True, blank=True)
+    task = models.ForeignKey('jobs.Job', null=True, blank=True, on_delete=models.SET_NULL,
+                             related_name='+')
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    total = models.IntegerField(default=0)
+    processed = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status'])]
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.get_action_display(), self.organization_id, self.status)
+
+    @property
+    def progress(self):
+        if self.status == self.DONE:
+            return 1.0
+        return min(self.processed / self.total, 1.0) if self.total else 0.0
@@ -0,0 +1,117 @@
+"""
+Password validation of new users.
+
+`get_password_policy` compiles `AUTH_PASSWORD_VALIDATORS` once per process
+into a `PasswordPolicy`, which runs a fast check for each of the Django
+validators and only calls the validator itself to raise its error once its
+check failed, so messages and codes are Django's:
+
+- the common password list is loaded once, as the frozenset of the
+  `CommonPasswordValidator` of the cached default validators,
+- attribute similarity skips the parts of the user attributes too short or
+  too long to reach `max_similarity`, 2 * min(a, b) / (a + b) bounds the
+  ratio, and computes the ratio of the others from character counts, the
+  `quick_ratio` of Django's `SequenceMatcher` without building one.
+
+Other validators run as they are.
+"""
+
+import re
+from collections import Counter
+from functools import lru_cache
+
+from django.contrib.auth import password_validation
+from django.core.exceptions import ValidationError
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+SPLIT_RE = re.compile(r'\W+')
+
+
+def similarity(counts, length, value):
+    """
+    `SequenceMatcher.quick_ratio` of a password, by its character `counts`
+    and `length`, and `value`.
+    """
+    total = length + len(value)
+    if not total:
+        return 1.0
+    matches = sum((counts & Counter(value)).values())
+    return 2.0 * matches / total
+
+
+class PasswordPolicy:
+
+    def __init__(self, validators):
+        self.validators = validators
+        self.checks = [self.compile(validator) for validator in validators]
+
+    def compile(self, validator):
+        """
+        A check(password, lowered, user) returning True when `validator`
+        accepts the password, or None to always run the validator.
+        """
+        if isinstance(validator, password_validation.MinimumLengthValidator):
+            min_length = validator.min_length
+            return lambda password, lowered, user: len(password) >= min_length
+        if isinstance(validator, password_validation.CommonPasswordValidator):
+            passwords = frozenset(validator.passwords)
+            return lambda password, lowered, user: lowered.strip() not in passwords
+        if isinstance(validator, password_validation.NumericPasswordValidator):
+            return lambda password, lowered, user: not password.isdigit()
+        if isinstance(validator, password_validation.UserAttributeSimilarityValidator):
+            return self.similarity_check(validator.user_attributes, validator.max_similarity)
+        return None
+
+    @staticmethod
+    def similarity_check(attributes, max_similarity):
+        def check(password, lowered, user):
+            if not user:
+                return True
+            counts, length = None, len(lowered)
+            for name in attributes:
+                value = getattr(user, name, None)
+                if not value or not isinstance(value, str):
+                    continue
+                value = value.lower()
+                for part in SPLIT_RE.split(value) + [value]:
+                    if 2 * min(length, len(part)) < max_similarity * (length + len(part)):
+                        continue
+                    if counts is None:
+                        counts = Counter(lowered)
+                    if similarity(counts, length, part) >= max_similarity:
+                        return False
+            return True
+        return check
+
+    def validate(self, password, user=None):
+        """
+        Raise a ValidationError with the errors of every validator the
+        password fails, like `validate_password`.
+        """
+        errors = []
+        lowered = password.lower()
+        for validator, check in zip(self.validators, self.checks):
+            if check is not None and check(password, lowered, user):
+                continue
+            try:
+                validator.validate(password, user)
+            except ValidationError as error:
+                errors.append(error)
+        if errors:
+            raise ValidationError(errors)
+
+
+@lru_cache(maxsize=None)
+def get_password_policy():
+    return PasswordPolicy(password_validation.get_default_password_validators())
+
+
+@receiver(setting_changed)
+def reset_password_policy(setting, **kwargs):
+    if setting == 'AUTH_PASSWORD_VALIDATORS':
+        get_password_policy.cache_clear()
+
+
+def validate_password(password, user=None):
+    get_password_policy().validate(password, user)
@@ -3,22 +3,50 @@ Application have:
 - Administrator: Full access to CRUD Any User in his org and RU Organization
 - Viewer: List and Retrieve and User in his org.
 - User: CRU his own user
+
+Tenancy is resolved from ``user.organization_id`` (already loaded with the
+user) and the tenant-aware managers, roles from a single query on the user
+groups table cached on the user instance, compared by id against the group
+registry. Every request makes at most one authorization query.
 """
 
 from rest_framework.permissions import SAFE_METHODS, BasePermission
 from .constants import ADMIN, VIEWER
+from .registry import group_registry
+
+
+def get_roles(user):
+    """
+    Return the role group ids of the user. The lookup runs once per user
+    instance, which DRF loads once per request.
+    """
+    roles = getattr(user, '_role_cache', None)
+    if roles is None:
+        roles = frozenset()
+        if user.is_authenticated:
+            role_ids = group_registry.ids_for([ADMIN, VIEWER])
+            roles = frozenset(user.groups.through.objects.filter(
+                user_id=user.id, group_id__in=role_ids
+            ).values_list('group_id', flat=True))
+        user._role_cache = roles
+    return roles
 
 
 def is_admin(user):
-    return bool(user.groups.filter(name__in=[ADMIN]))
+    return group_registry.id_for(ADMIN) in get_roles(user)
 
 
 def is_viewer(user):
-    return bool(user.groups.filter(name__in=[VIEWER]))
+    return group_registry.id_for(VIEWER) in get_roles(user)
 
 
 def is_admin_or_viewer(user):
-    return bool(user.groups.filter(name__in=[ADMIN, VIEWER]))
+    return bool(get_roles(user))
+
+
+def is_his_org(user, org_id):
+    org = getattr(user, 'organization_id', None)
+    return org is not None and org == org_id
 
 
 class OrgPermissions(BasePermission):
@@ -29,17 +57,23 @@ class OrgPermissions(BasePermission):
     if request user is `Administrator` or `Viewer`.
 
     - PATCH /api/organizations /{id} Update organization if request user is `Administrator`.
+
+    - POST /api/organizations/{id}/events/ticket/ Ticket for the event stream
+    if request user is `Administrator` or `Viewer`.
     """
 
-    def has_object_permission(self, request, view, obj):
+    def has_permission(self, request, view):
         user = request.user
-        is_his_org = user.organization.id == obj.id
 
-        if request.method in SAFE_METHODS:
+        if request.method in SAFE_METHODS or request.method == 'POST':
             return is_admin_or_viewer(user)
 
         if request.method == 'PATCH':
-            return is_admin(user) and is_his_org
+            return is_admin(user)
+
+    def has_object_permission(self, request, view, obj):
+        # the queryset is already scoped to the user organization
+        return is_his_org(request.user, obj.id)
 
 
 class UserPermissions(BasePermission):
@@ -53,6 +87,9 @@ class UserPermissions(BasePermission):
 
     - POST /api/users/ Request user must be Administrator
 
+    - POST /api/users/groups/ Set the groups of users in the background,
+    request user must be Administrator
+
     - PATCH /api/users/{id} Update user information for the user_id 
     if request user is `Administrator` of his organization. Or request user is user_id
 
@@ -77,10 +114,10 @@ class UserPermissions(BasePermission):
         is_owner = user.id == obj.id
 
         if request.method in SAFE_METHODS:
-            return is_admin_or_viewer(user) or is_owner
+            return is_owner or is_admin_or_viewer(user)
 
         if request.method == 'PATCH':
-            return is_admin(user) or is_owner
+            return is_owner or is_admin(user)
 
         if request.method == 'DELETE':
             return is_admin(user)
@@ -100,7 +137,6 @@ class UserOrgPermissions(BasePermission):
     def has_permission(self, request, view):
         user = request.user
         org_id = int(view.kwargs['org_id'])
-        is_his_org = user.organization.id == org_id
 
         if request.method == 'GET':
-            return is_admin_or_viewer(user) and is_his_org
+            return is_his_org(user, org_id) and is_admin_or_viewer(user)
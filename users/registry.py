@@ -0,0 +1,91 @@
+"""
+Process local registry of the authentication groups.
+
+Groups and their permissions almost never change, so they are loaded once
+per process and invalidated by the signals in `users.signals`. Other
+processes pick up changes after `GROUP_REGISTRY_TTL` seconds.
+"""
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.db import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+
+class GroupRegistry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = None
+        self._ids = None
+        self._loaded_at = 0
+
+    def ttl(self):
+        return getattr(settings, 'GROUP_REGISTRY_TTL', 300)
+
+    def load(self):
+        """
+        Load groups and their permission codenames with two queries.
+        """
+        groups = []
+        ids = {}
+        for group in Group.objects.prefetch_related('permissions').order_by('id'):
+            groups.append({
+                'id': group.id,
+                'name': group.name,
+                'permissions': [p.codename for p in group.permissions.all()]
+            })
+            ids[group.name] = group.id
+
+        with self._lock:
+            self._groups = groups
+            self._ids = ids
+            self._loaded_at = time.monotonic()
+        return groups, ids
+
+    def warm_up(self):
+        """
+        Load the registry at startup, the database may not be migrated yet.
+        """
+        try:
+            self.load()
+        except DatabaseError as e:
+            logger.warning('Group registry not loaded: %s', e)
+
+    def invalidate(self):
+        with self._lock:
+            self._groups = None
+            self._ids = None
+
+    def _ensure_loaded(self):
+        """
+        Return the groups and ids as loaded together, a concurrent
+        `invalidate` can't clear them between the check and the lookup.
+        """
+        with self._lock:
+            groups, ids = self._groups, self._ids
+            fresh = time.monotonic() - self._loaded_at <= self.ttl()
+        if groups is None or not fresh:
+            groups, ids = self.load()
+        return groups, ids
+
+    def groups(self):
+        """
+        Return the groups as serialized by `GroupSerializer`.
+        """
+        return self._ensure_loaded()[0]
+
+    def id_for(self, name):
+        return self._ensure_loaded()[1].get(name)
+
+    def ids_for(self, names):
+        ids = self._ensure_loaded()[1]
+        return [ids[name] for name in names if name in ids]
+
+
+group_registry = GroupRegistry()
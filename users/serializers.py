@@ -1,8 +1,47 @@
 from django.contrib.auth.models import Group
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
 
 from .models import User, Organization
 from .constants import USER_INFO_FIELDS, ORG_INFO_FIELDS, USER_CREATE_FIELDS
+from .passwords import validate_password
+from .sharding import validate_unique_email
+
+
+class SparseFieldsMixin:
+    """
+    Keeps only the `fields` given to the serializer, relations not listed in
+    `expand` are rendered as primary keys.
+    """
+    expandable_fields = {
+        'organization': lambda: serializers.PrimaryKeyRelatedField(read_only=True),
+    }
+
+    def __init__(self, *args, fields=None, expand=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is None:
+            return
+        for name in set(self.fields) - set(fields):
+            self.fields.pop(name)
+        for name, collapsed in self.expandable_fields.items():
+            if name in self.fields and name not in (expand or ()):
+                self.fields[name] = collapsed()
+
+
+class UniqueEmailMixin:
+    """
+    Checks the email with `validate_unique_email`, like the admin forms, in
+    place of the exact match `UniqueValidator`.
+    """
+
+    def get_extra_kwargs(self):
+        extra_kwargs = super().get_extra_kwargs()
+        extra_kwargs['email'] = {**extra_kwargs.get('email', {}), 'validators': []}
+        return extra_kwargs
+
+    def validate_email(self, value):
+        return validate_unique_email(value, self.instance.pk if self.instance is not None else None)
+
 
 class GroupSerializer(serializers.ModelSerializer):
     permissions = serializers.SlugRelatedField(
@@ -16,7 +55,7 @@ class GroupSerializer(serializers.ModelSerializer):
         exclude = []
 
 
-class OrganizationSerializer(serializers.ModelSerializer):
+class OrganizationSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Organization
         fields = ORG_INFO_FIELDS
@@ -28,13 +67,13 @@ class OrganizationRelatedField(serializers.ModelSerializer):
         fields = ['id', 'name']
 
 
-class UserOrgSerializer(serializers.ModelSerializer):
+class UserOrgSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'name']
 
 
-class UserDefaultSerializer(serializers.ModelSerializer):
+class UserDefaultSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     organization = OrganizationRelatedField(read_only=True)
 
     groups = serializers.SlugRelatedField(
@@ -45,10 +84,10 @@ class UserDefaultSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = User
-        exclude = []
+        exclude = ['sync_token', 'created_token', 'email_key']
 
 
-class UserInfoSerializer(serializers.ModelSerializer):
+class UserInfoSerializer(SparseFieldsMixin, UniqueEmailMixin, serializers.ModelSerializer):
     organization = OrganizationRelatedField(read_only=True)
 
     class Meta:
@@ -56,12 +95,22 @@ class UserInfoSerializer(serializers.ModelSerializer):
         fields = USER_INFO_FIELDS
 
 
-class UserCreateSerializer(serializers.ModelSerializer):
+class UserCreateSerializer(UniqueEmailMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = USER_CREATE_FIELDS
         extra_kwargs = {'password': {'write_only': True}}
 
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        # the attributes the similarity check compares the password to
+        user = User(email=attrs.get('email'), name=attrs.get('name'), phone=attrs.get('phone'))
+        try:
+            validate_password(attrs['password'], user)
+        except DjangoValidationError as error:
+            raise serializers.ValidationError({'password': list(error.messages)})
+        return attrs
+
     def create(self, validated_data):
         user = User(name=validated_data.get('name'),
                     phone=validated_data.get('phone'),
@@ -74,3 +123,19 @@ class UserCreateSerializer(serializers.ModelSerializer):
         groups = validated_data.get('groups', [])
         user.groups.set(groups)
         return user
+
+
+class UserGroupsSerializer(serializers.Serializer):
+    """
+    Users of the request organization and the groups to set them.
+    """
+    users = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+    groups = serializers.PrimaryKeyRelatedField(many=True, queryset=Group.objects.all())
+
+    def validate_users(self, value):
+        value = sorted(set(value))
+        found = set(User.tenant_objects.filter(pk__in=value).values_list('pk', flat=True))
+        missing = [pk for pk in value if pk not in found]
+        if missing:
+            raise serializers.ValidationError('Unknown users: %s' % ', '.join(map(str, missing)))
+        return value
@@ -0,0 +1,496 @@
+"""
+Hash partitioned sharding of the users by organization.
+
+With `USER_SHARDS` set, every new organization is placed on the shard its id
+hashes to, where its users, their group memberships and its tombstones live.
+`ShardRouter` sends the queries of these models to the shard of, in order:
+
+- the enclosing `use_shard` block, for commands and jobs,
+- the instance they are about, a user or a tombstone by its organization,
+- the request user, whose organization is the only one a request can reach.
+
+Every other table stays on the default database. Organization rows are also
+copied to their shard to back the foreign keys of the users. Groups and
+permissions exist on every database with the same ids, copied from the
+default database when a shard is migrated. `UserDirectory` maps the id and the email of every user to its
+shard: ids are allocated there so they are unique across shards, and logins
+and email uniqueness checks go through it.
+
+Reads of safe requests go to a replica of the shard when it has some in
+`USER_SHARD_REPLICAS`, as `project.routers.ReplicaRouter` does for the
+default database. Instances read from a replica are written to its shard.
+
+Organizations created before sharding was enabled keep their users on the
+default database until `manage.py rebalance_shards` moves them, which also
+moves organizations to another shard after shards are added.
+"""
+
+import threading
+import time
+import zlib
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth import backends
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+from rest_framework_simplejwt import authentication
+from rest_framework_simplejwt.settings import api_settings
+
+from project.routers import read_replica
+
+from .models import Organization, SyncCounter, Tombstone, User, UserDirectory
+from .tenancy import get_binding
+
+_shard = ContextVar('shard', default=None)
+
+
+def get_shards():
+    return getattr(settings, 'USER_SHARDS', [])
+
+
+def is_sharded():
+    return bool(get_shards())
+
+
+def shard_primary(alias):
+    """
+    The shard `alias` is a replica of, `alias` itself for any other database.
+    """
+    for shard, replicas in getattr(settings, 'USER_SHARD_REPLICAS', {}).items():
+        if alias in replicas:
+            return shard
+    return alias
+
+
+def hash_shard(key):
+    """
+    The shard `key` hashes to, stable across processes.
+    """
+    shards = get_shards()
+    return shards[zlib.crc32(str(key).encode()) % len(shards)]
+
+
+@contextmanager
+def use_shard(alias):
+    """
+    Send the queries of the sharded models in the block to `alias`, None
+    leaves the routing as it is.
+    """
+    token = _shard.set(alias)
+    try:
+        yield alias
+    finally:
+        _shard.reset(token)
+
+
+class ShardPlacements:
+    """
+    Process local cache of the shard of each organization. Entries expire
+    after `SHARD_PLACEMENT_TTL` seconds, so the moves of a rebalance made by
+    another process are picked up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shards = {}
+
+    def ttl(self):
+        return getattr(settings, 'SHARD_PLACEMENT_TTL', 30)
+
+    def get(self, organization_id):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._shards.get(organization_id)
+        if cached is not None and now - cached[1] < self.ttl():
+            return cached[0]
+        shard = (Organization.objects.using(DEFAULT_DB_ALIAS).filter(pk=organization_id)
+                 .values_list('shard', flat=True).first())
+        # placed before sharding was enabled
+        shard = shard or DEFAULT_DB_ALIAS
+        with self._lock:
+            self._shards[organization_id] = (shard, now)
+        return shard
+
+    def invalidate(self, organization_id=None):
+        with self._lock:
+            if organization_id is None:
+                self._shards.clear()
+            else:
+                self._shards.pop(organization_id, None)
+
+
+placements = ShardPlacements()
+
+
+def organization_shard(organization_id):
+    """
+    The database holding the users of the organization, None when sharding
+    is disabled.
+    """
+    if not is_sharded():
+        return None
+    return placements.get(organization_id)
+
+
+def user_shard(user_id):
+    """
+    The database holding the user, None when sharding is disabled.
+    """
+    if not is_sharded() or user_id is None:
+        return None
+    shard = UserDirectory.objects.filter(pk=user_id).values_list('shard', flat=True).first()
+    # users of organizations placed before sharding was enabled
+    return shard or DEFAULT_DB_ALIAS
+
+
+def copy_organization(organization_id, shard):
+    """
+    Copy the organization row to `shard`, for the foreign keys of its users.
+    """
+    organization = Organization.objects.using(DEFAULT_DB_ALIAS).get(pk=organization_id)
+    Organization.objects.using(shard).bulk_create([organization], ignore_conflicts=True)
+
+
+def place_organization(organization):
+    """
+    Place a new organization on the shard its id hashes to.
+    """
+    shard = hash_shard(organization.pk)
+    Organization.objects.using(DEFAULT_DB_ALIAS).filter(pk=organization.pk).update(shard=shard)
+    organization.shard = shard
+    copy_organization(organization.pk, shard)
+    placements.invalidate(organization.pk)
+    return shard
+
+
+def register_user(user, using):
+    """
+    Allocate the id of a new user in the directory, or update the email and
+    shard of an existing one. The unique email key of the directory rejects
+    an email taken on any shard.
+    """
+    if user.pk is None:
+        user.pk = UserDirectory.objects.create(email_key=user.email.lower(), shard=using).pk
+    elif not UserDirectory.objects.filter(pk=user.pk).update(email_key=user.email.lower(),
+                                                              shard=using):
+        # users of organizations placed before sharding was enabled
+        UserDirectory.objects.create(pk=user.pk, email_key=user.email.lower(), shard=using)
+
+
+def forget_user(user_id):
+    UserDirectory.objects.filter(pk=user_id).delete()
+
+
+@contextmanager
+def sharded_save(user, kwargs):
+    """
+    Resolve the shard of a user save into the `using` of its `kwargs`. New
+    users get their id from the directory, users moved to an organization
+    on another shard are moved there first.
+
+    The block runs in a transaction on the default database and on every
+    shard the save writes to, so the directory entry, the move and the save
+    in the block are rolled back together.
+    """
+    adding, db = user._state.adding, user._state.db
+    try:
+        with ExitStack() as stack:
+            stack.enter_context(transaction.atomic(using=DEFAULT_DB_ALIAS))
+            using = kwargs.get('using') or router.db_for_write(User, instance=user)
+            stack.enter_context(transaction.atomic(using=using))
+            if adding:
+                register_user(user, using)
+                if not kwargs.get('force_update'):
+                    kwargs['force_insert'] = True
+            else:
+                moved = user.organization_id != getattr(user, '_loaded_organization_id', None)
+                if moved and user.organization_id is not None and _shard.get() is None:
+                    target = placements.get(user.organization_id)
+                    if target != using:
+                        stack.enter_context(transaction.atomic(using=target))
+                        copy_users([user.pk], using, target)
+                        point_directory([user.pk], target)
+                        delete_users([user.pk], using)
+                        using = user._state.db = target
+                update_fields = kwargs.get('update_fields')
+                if update_fields is None or 'email' in update_fields:
+                    register_user(user, using)
+            kwargs['using'] = using
+            yield using
+    except BaseException:
+        # the id allocated and the shard moved to were rolled back
+        if adding:
+            user.pk = None
+        user._state.db = db
+        raise
+
+
+def email_in_use(email, exclude_pk=None):
+    """
+    Whether a user other than `exclude_pk` has `email` in any case.
+    """
+    users = User.objects.filter_email(email)
+    if is_sharded():
+        directory = UserDirectory.objects.filter(email_key=email.lower())
+        if exclude_pk is not None:
+            directory = directory.exclude(pk=exclude_pk)
+        if directory.exists():
+            return True
+        # users of organizations placed before sharding was enabled
+        users = users.using(DEFAULT_DB_ALIAS)
+    if exclude_pk is not None:
+        users = users.exclude(pk=exclude_pk)
+    return users.exists()
+
+
+def validate_unique_email(email, exclude_pk=None):
+    """
+    Return `email`, or raise a ValidationError when `email_in_use`. Checks
+    emails in any case, in place of the exact match unique validation of
+    forms and serializers.
+    """
+    if email_in_use(email, exclude_pk):
+        raise ValidationError('User with this email address already exists.', code='unique')
+    return email
+
+
+def get_user_by_email(email):
+    """
+    The user with `email` in any case, from its shard.
+    """
+    manager = User.objects
+    if is_sharded():
+        shard = (UserDirectory.objects.filter(email_key=email.lower())
+                 .values_list('shard', flat=True).first())
+        manager = manager.db_manager(shard or DEFAULT_DB_ALIAS)
+    return manager.filter_email(email).get()
+
+
+def copy_users(user_ids, source, target):
+    """
+    Copy the users, their group memberships and permissions from `source`
+    to `target`, keeping their ids. Copies left on `target` by an interrupted
+    move are replaced, so copies can be made again.
+    """
+    users = list(User.objects.using(source).filter(pk__in=user_ids))
+    for organization_id in {user.organization_id for user in users} - {None}:
+        copy_organization(organization_id, target)
+    delete_users(user_ids, target)
+    User.objects.using(target).bulk_create(users)
+    for through in (User.groups.through, User.user_permissions.through):
+        rows = list(through.objects.using(source).filter(user_id__in=user_ids))
+        for row in rows:
+            row.pk = None
+        through.objects.using(target).bulk_create(rows)
+    return users
+
+
+def point_directory(user_ids, shard):
+    """
+    Point the directory entries of the users to `shard`, where they are.
+    """
+    UserDirectory.objects.bulk_create([
+        UserDirectory(pk=pk, email_key=email_key, shard=shard)
+        for pk, email_key in User.objects.using(shard).filter(pk__in=user_ids)
+        .values_list('pk', 'email_key')
+    ], ignore_conflicts=True)
+    UserDirectory.objects.filter(pk__in=user_ids).update(shard=shard)
+
+
+def delete_users(user_ids, alias):
+    """
+    Delete copied users from `alias`. Raw deletes, the users aren't gone
+    and must leave no tombstones behind.
+    """
+    for through in (User.groups.through, User.user_permissions.through):
+        through.objects.using(alias).filter(user_id__in=user_ids)._raw_delete(alias)
+    User.objects.using(alias).filter(pk__in=user_ids)._raw_delete(alias)
+
+
+def current_token():
+    """
+    The last sync token issued.
+    """
+    return SyncCounter.objects.values_list('value', flat=True).filter(pk=1).first() or 0
+
+
+def catch_up(organization_id, source, target, since, user_ids):
+    """
+    Copy the users and tombstones of the organization written on `source`
+    after the `since` token to `target`, unless the copy on `target` was
+    written later, and remove the users who left the organization from
+    `target` and `user_ids`. Returns the ids of the users copied or removed.
+    """
+    tombstones = list(Tombstone.objects.using(source).filter(
+        organization_id=organization_id, sync_token__gt=since))
+    copied = set(Tombstone.objects.using(target).filter(
+        organization_id=organization_id, sync_token__gt=since).values_list('sync_token', flat=True))
+    for tombstone in tombstones:
+        tombstone.pk = None
+    Tombstone.objects.using(target).bulk_create(
+        [tombstone for tombstone in tombstones if tombstone.sync_token not in copied])
+
+    written = dict(User.objects.using(source).filter(
+        organization_id=organization_id, sync_token__gt=since).values_list('pk', 'sync_token'))
+    copies = dict(User.objects.using(target).filter(pk__in=written)
+                  .values_list('pk', 'sync_token'))
+    changed = [pk for pk, token in written.items() if token > copies.get(pk, 0)]
+    if changed:
+        copy_users(changed, source, target)
+        user_ids.update(changed)
+
+    left = ({tombstone.object_id for tombstone in tombstones if tombstone.model == Tombstone.USER}
+            - written.keys()) & user_ids
+    if left:
+        delete_users(left, target)
+        user_ids -= left
+    return set(changed) | left
+
+
+def move_organization(organization, target, batch_size=500, wait=None, progress=None,
+                      max_passes=10):
+    """
+    Move the users and tombstones of `organization` to the `target` shard.
+
+    Users are copied in batches by id, then the users and tombstones written
+    meanwhile are copied by sync token, pass after pass until one finds
+    nothing or `max_passes`, and the organization is placed on `target`.
+    After `wait` seconds, when no process routes to the source anymore, the
+    writes made there until then are copied in a last pass and the users
+    are deleted from the source. Copies replace the ones left by an
+    interrupted move, so a failed move can be run again. Group membership
+    changes alone don't give users a new sync token and aren't caught up.
+    Returns the number of users moved.
+    """
+    source = organization.shard or DEFAULT_DB_ALIAS
+    if source == target:
+        return 0
+    wait = placements.ttl() if wait is None else wait
+    copy_organization(organization.pk, target)
+    since = current_token()
+    # tombstones left by an interrupted move, copied again below
+    Tombstone.objects.using(target).filter(organization_id=organization.pk)._raw_delete(target)
+
+    user_ids, last = set(), 0
+    while True:
+        batch = list(User.objects.using(source).filter(organization_id=organization.pk, pk__gt=last)
+                     .order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            break
+        copy_users(batch, source, target)
+        user_ids.update(batch)
+        last = batch[-1]
+        if progress is not None:
+            progress(len(user_ids))
+
+    tombstones = list(Tombstone.objects.using(source).filter(
+        organization_id=organization.pk, sync_token__lte=since))
+    for tombstone in tombstones:
+        tombstone.pk = None
+    Tombstone.objects.using(target).bulk_create(tombstones, batch_size=batch_size)
+    for _ in range(max_passes):
+        if not catch_up(organization.pk, source, target, since, user_ids):
+            break
+
+    Organization.objects.using(DEFAULT_DB_ALIAS).filter(pk=organization.pk).update(shard=target)
+    organization.shard = target
+    placements.invalidate(organization.pk)
+    ordered = sorted(user_ids)
+    for start in range(0, len(ordered), batch_size):
+        point_directory(ordered[start:start + batch_size], target)
+    time.sleep(wait)
+
+    # writes of the processes still routing to the source until now
+    point_directory(catch_up(organization.pk, source, target, since, user_ids) & user_ids, target)
+    ordered = sorted(user_ids)
+    for start in range(0, len(ordered), batch_size):
+        delete_users(ordered[start:start + batch_size], source)
+    Tombstone.objects.using(source).filter(organization_id=organization.pk)._raw_delete(source)
+    return len(user_ids)
+
+
+def request_shard():
+    binding = get_binding()
+    if binding is None:
+        return None
+    user = getattr(binding.request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return None
+    return shard_primary(user._state.db)
+
+
+class ShardRouter:
+    """
+    Routes the users, their memberships and the tombstones to their shard.
+    """
+    sharded_models = {User, User.groups.through, User.user_permissions.through, Tombstone}
+
+    def route(self, model, hints):
+        if not is_sharded():
+            return None
+        instance = hints.get('instance')
+        if model not in self.sharded_models:
+            if instance is not None and shard_primary(instance._state.db) in get_shards():
+                # organizations from the default database, the copies on the
+                # shards only back foreign keys. Groups and permissions of a
+                # user are joined to memberships on its shard.
+                return DEFAULT_DB_ALIAS if model is Organization else shard_primary(instance._state.db)
+            return None
+
+        shard = _shard.get()
+        if shard is not None:
+            return shard_primary(shard)
+        if isinstance(instance, Organization):
+            return placements.get(instance.pk)
+        if instance is not None:
+            if instance._state.db is not None:
+                return shard_primary(instance._state.db)
+            organization_id = getattr(instance, 'organization_id', None)
+            if organization_id is not None:
+                return placements.get(organization_id)
+            if isinstance(instance, User):
+                return hash_shard(instance.email.lower())
+        return request_shard()
+
+    def db_for_read(self, model, **hints):
+        alias = self.route(model, hints)
+        if alias in get_shards():
+            return read_replica(alias) or alias
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return self.route(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        shards = get_shards()
+        if shard_primary(obj1._state.db) in shards or shard_primary(obj2._state.db) in shards:
+            return True
+        return None
+
+
+class ModelBackend(backends.ModelBackend):
+    """
+    Session users loaded from their shard, email logins go through
+    `UserManager.get_by_natural_key`.
+    """
+
+    def get_user(self, user_id):
+        with use_shard(user_shard(user_id)):
+            return super().get_user(user_id)
+
+
+class JWTAuthentication(authentication.JWTAuthentication):
+    """
+    Token users loaded from their shard.
+    """
+
+    def authenticate_header(self, request):
+        # first of the authentication classes, unauthenticated calls stay
+        # 403s as when the session authentication came first
+        return None
+
+    def get_user(self, validated_token):
+        with use_shard(user_shard(validated_token.get(api_settings.USER_ID_CLAIM))):
+            return super().get_user(validated_token)
@@ -0,0 +1,126 @@
+from django.contrib.auth.models import Group, Permission
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import (
+    post_save, pre_delete, post_delete, m2m_changed, post_migrate
+)
+from django.dispatch import receiver
+
+from .constants import USER_INFO_FIELDS
+from .events import broker
+from . import stats
+from .models import User, Organization, OrganizationStat, Tombstone
+from .registry import group_registry
+from .serializers import UserInfoSerializer, OrganizationSerializer
+from .sharding import forget_user, is_sharded, place_organization
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(m2m_changed, sender=Group.permissions.through)
+@receiver(post_migrate)
+def invalidate_group_registry(sender, **kwargs):
+    group_registry.invalidate()
+
+
+@receiver(post_delete, sender=User)
+def record_user_tombstone(sender, instance, **kwargs):
+    if instance.organization_id is not None:
+        Tombstone.record(instance.organization_id, Tombstone.USER, instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def remove_user_directory_entry(sender, instance, **kwargs):
+    if is_sharded():
+        forget_user(instance.pk)
+
+
+@receiver(post_save, sender=Organization)
+def place_new_organization(sender, instance, created, raw=False, using=None, **kwargs):
+    # copies made on the shards by `users.sharding` aren't new organizations
+    if created and not raw and using == DEFAULT_DB_ALIAS and is_sharded():
+        place_organization(instance)
+
+
+@receiver(post_delete, sender=Organization)
+def record_organization_tombstone(sender, instance, **kwargs):
+    Tombstone.record(instance.pk, Tombstone.ORGANIZATION, instance.pk)
+
+
+def publish_change(org_id, change):
+    if broker.has_subscribers(org_id):
+        transaction.on_commit(lambda: broker.publish(org_id, change))
+
+
+@receiver(post_save, sender=User)
+def publish_user_change(sender, instance, created, **kwargs):
+    if instance.organization_id is None or not broker.has_subscribers(instance.organization_id):
+        return
+    data = UserInfoSerializer(instance, fields=USER_INFO_FIELDS).data
+    publish_change(instance.organization_id, {
+        'token': instance.sync_token, 'type': 'user',
+        'action': 'created' if created else 'updated', 'id': instance.pk, 'data': data})
+
+
+@receiver(post_save, sender=Organization)
+def publish_organization_change(sender, instance, created, **kwargs):
+    if not broker.has_subscribers(instance.pk):
+        return
+    publish_change(instance.pk, {
+        'token': instance.sync_token, 'type': 'organization',
+        'action': 'created' if created else 'updated', 'id': instance.pk,
+        'data': OrganizationSerializer(instance).data})
+
+
+@receiver(post_save, sender=Tombstone)
+def publish_deletion(sender, instance, **kwargs):
+    publish_change(instance.organization_id, {
+        'token': instance.sync_token, 'type': instance.model,
+        'action': 'deleted', 'id': instance.object_id, 'data': None})
+
+
+@receiver(post_save, sender=User)
+def update_user_stats(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        stats.record_user_save(instance, created)
+
+
+@receiver(pre_delete, sender=User)
+def load_deleted_user_role(sender, instance, **kwargs):
+    # memberships are gone by post_delete
+    if instance.organization_id is not None:
+        instance._stats_role = stats.get_role(instance)
+
+
+@receiver(post_delete, sender=User)
+def update_deleted_user_stats(sender, instance, **kwargs):
+    role = getattr(instance, '_stats_role', None)
+    if role is not None:
+        stats.record_user_delete(instance, role)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def update_role_stats(sender, instance, action, reverse, pk_set, **kwargs):
+    # changes made from the group side are left to `stats.rebuild`
+    if reverse or instance.organization_id is None:
+        return
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        instance._stats_role_ids = stats.get_role_ids(instance)
+        return
+    role_ids = instance.__dict__.pop('_stats_role_ids', None)
+    if role_ids is None:
+        return
+    if action == 'post_add':
+        new_ids = role_ids | pk_set
+    elif action == 'post_remove':
+        new_ids = role_ids - pk_set
+    else:
+        new_ids = set()
+    stats.record_role_change(instance, stats.role_bucket(role_ids), stats.role_bucket(new_ids))
+
+
+@receiver(post_delete, sender=Organization)
+def delete_organization_stats(sender, instance, using=None, **kwargs):
+    if using == DEFAULT_DB_ALIAS:
+        OrganizationStat.objects.filter(organization_id=instance.pk).delete()
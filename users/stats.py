@@ -0,0 +1,271 @@
+"""
+Incremental rollups of the organization statistics.
+
+`OrganizationStat` keeps a user count per organization, dimension and bucket:
+signups by month of `date_joined`, birth month, active or inactive, and role
+(the administrators, the viewers who aren't administrators, and the rest).
+The signals in `users.signals` apply the difference between the buckets a
+user leaves and the ones it enters on every save, delete and change of its
+groups, so `get_stats` reads a few dozen rows whatever the organization size.
+Age bands are derived from the birth months when read, a user counts in the
+band of the age it reaches by the end of the current month.
+
+The differences are applied once the write commits, in a short transaction
+of their own, so writers never wait on the rollups. `rebuild` locks the
+organization row from its count to the swap of the rollups and the
+differences take the same lock, so the ones of writes committed after the
+count apply to the new rollups. A write committed before the count whose
+difference is applied after the rebuild is counted twice, until the next
+rebuild.
+
+Bulk inserts and updates, group changes made from the group side and users
+saved with the stat fields deferred skip the signals or the loaded values,
+`rebuild` recounts an organization from its users, see
+`manage.py rebuild_stats`.
+"""
+
+from django.db import transaction
+from django.db.models import DEFERRED, Count, F
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .constants import ADMIN, VIEWER
+from .models import STAT_FIELDS, Organization, OrganizationStat, User
+from .registry import group_registry
+from .sharding import organization_shard, use_shard
+
+SIGNUPS = 'signups'
+BIRTH_MONTH = 'birth_month'
+STATUS = 'status'
+ROLE = 'role'
+
+ACTIVE = 'active'
+INACTIVE = 'inactive'
+UNKNOWN = 'unknown'
+ADMINISTRATOR = 'administrator'
+VIEWER_ONLY = 'viewer'
+NO_ROLE = 'none'
+
+# lower bound of each age band, the last one is open
+AGE_BANDS = ((0, '<18'), (18, '18-24'), (25, '25-34'), (35, '35-44'), (45, '45-54'),
+             (55, '55-64'), (65, '65+'))
+
+
+def month_bucket(value):
+    return value.strftime('%Y-%m') if value is not None else UNKNOWN
+
+
+def role_bucket(group_ids):
+    if group_registry.id_for(ADMIN) in group_ids:
+        return ADMINISTRATOR
+    if group_registry.id_for(VIEWER) in group_ids:
+        return VIEWER_ONLY
+    return NO_ROLE
+
+
+def get_role_ids(user):
+    """
+    The role groups of a user, from its database.
+    """
+    role_ids = group_registry.ids_for([ADMIN, VIEWER])
+    return set(User.groups.through.objects.using(user._state.db).filter(
+        user_id=user.pk, group_id__in=role_ids).values_list('group_id', flat=True))
+
+
+def get_role(user):
+    return role_bucket(get_role_ids(user))
+
+
+def user_buckets(values, role):
+    """
+    The (dimension, bucket) pairs counting a user with the `STAT_FIELDS`
+    `values`.
+    """
+    return {
+        (SIGNUPS, month_bucket(values['date_joined'])),
+        (BIRTH_MONTH, month_bucket(values['birthdate'])),
+        (STATUS, ACTIVE if values['is_active'] else INACTIVE),
+        (ROLE, role),
+    }
+
+
+def stat_values(user):
+    return {name: getattr(user, name) for name in STAT_FIELDS}
+
+
+def lock(*organization_ids):
+    """
+    Lock the organizations against a concurrent `rebuild` until the
+    transaction commits, in order of id.
+    """
+    ids = sorted(set(organization_ids) - {None})
+    list(Organization.objects.select_for_update().filter(pk__in=ids).order_by('pk')
+         .values_list('pk', flat=True))
+
+
+def apply(organization_id, buckets, delta):
+    """
+    Add `delta` to the counts of `buckets` of the organization, locked by
+    the caller.
+    """
+    for dimension, bucket in buckets:
+        counts = OrganizationStat.objects.filter(
+            organization_id=organization_id, dimension=dimension, bucket=bucket)
+        if counts.update(count=F('count') + delta) or delta < 0:
+            continue
+        # first user in the bucket, another writer may create it meanwhile
+        OrganizationStat.objects.bulk_create([OrganizationStat(
+            organization_id=organization_id, dimension=dimension, bucket=bucket)],
+            ignore_conflicts=True)
+        counts.update(count=F('count') + delta)
+
+
+def apply_changes(changes):
+    """
+    Apply the (organization id, buckets, delta) `changes` in a transaction
+    of their own.
+    """
+    with transaction.atomic():
+        lock(*(organization_id for organization_id, _, _ in changes))
+        for organization_id, buckets, delta in changes:
+            apply(organization_id, buckets, delta)
+
+
+def on_commit(user, func):
+    """
+    Run `func` once the transaction writing `user` commits, out of it.
+    """
+    transaction.on_commit(func, using=user._state.db)
+
+
+def record_user_save(user, created):
+    """
+    Move the counts of a saved user from the buckets it was loaded with to
+    its current ones, once the save commits.
+    """
+    values = stat_values(user)
+    if created:
+        if values['organization_id'] is not None:
+            # groups are added once the user exists
+            changes = [(values['organization_id'], user_buckets(values, NO_ROLE), 1)]
+            on_commit(user, lambda: apply_changes(changes))
+        return
+    loaded = getattr(user, '_loaded_stats', None)
+    if loaded == values:
+        return
+    if loaded is None or DEFERRED in loaded.values():
+        # the previous values are unknown, recount once committed
+        loaded_organization_id = (loaded or {}).get('organization_id')
+        for organization_id in {values['organization_id'], loaded_organization_id} - {None, DEFERRED}:
+            transaction.on_commit(lambda pk=organization_id: rebuild(pk))
+        return
+
+    def move():
+        role = get_role(user)
+        old = user_buckets(loaded, role) if loaded['organization_id'] is not None else set()
+        new = user_buckets(values, role) if values['organization_id'] is not None else set()
+        if loaded['organization_id'] != values['organization_id']:
+            changes = [(loaded['organization_id'], old, -1), (values['organization_id'], new, 1)]
+        else:
+            changes = [(values['organization_id'], old - new, -1),
+                       (values['organization_id'], new - old, 1)]
+        apply_changes(changes)
+    on_commit(user, move)
+
+
+def record_user_delete(user, role):
+    if user.organization_id is not None:
+        changes = [(user.organization_id, user_buckets(stat_values(user), role), -1)]
+        on_commit(user, lambda: apply_changes(changes))
+
+
+def record_role_change(user, old, new):
+    if user.organization_id is not None and old != new:
+        changes = [(user.organization_id, {(ROLE, old)}, -1),
+                   (user.organization_id, {(ROLE, new)}, 1)]
+        on_commit(user, lambda: apply_changes(changes))
+
+
+def count_buckets(organization_id):
+    """
+    Count the buckets of the organization from its users.
+    """
+    users = User.objects.filter(organization_id=organization_id)
+    counts = {}
+    for month, count in (users.annotate(month=TruncMonth('date_joined')).order_by()
+                         .values_list('month').annotate(n=Count('pk'))):
+        counts[SIGNUPS, month_bucket(month)] = count
+    for month, count in (users.annotate(month=TruncMonth('birthdate')).order_by()
+                         .values_list('month').annotate(n=Count('pk'))):
+        counts[BIRTH_MONTH, month_bucket(month)] = count
+    for is_active, count in users.order_by().values_list('is_active').annotate(n=Count('pk')):
+        counts[STATUS, ACTIVE if is_active else INACTIVE] = count
+
+    admins = users.filter(groups=group_registry.id_for(ADMIN))
+    viewers = users.filter(groups=group_registry.id_for(VIEWER)).exclude(pk__in=admins)
+    total = sum(count for (dimension, _), count in counts.items() if dimension == STATUS)
+    counts[ROLE, ADMINISTRATOR] = admins.count()
+    counts[ROLE, VIEWER_ONLY] = viewers.count()
+    counts[ROLE, NO_ROLE] = total - counts[ROLE, ADMINISTRATOR] - counts[ROLE, VIEWER_ONLY]
+    return {key: count for key, count in counts.items() if count}
+
+
+def rebuild(organization_id):
+    """
+    Replace the rollups of the organization with counts of its users, one
+    scan of them. Returns the number of buckets.
+    """
+    with transaction.atomic():
+        lock(organization_id)
+        # deleted first, SQLite takes the write lock before the count
+        OrganizationStat.objects.filter(organization_id=organization_id).delete()
+        with use_shard(organization_shard(organization_id)):
+            counts = count_buckets(organization_id)
+        OrganizationStat.objects.bulk_create([
+            OrganizationStat(organization_id=organization_id, dimension=dimension,
+                             bucket=bucket, count=count)
+            for (dimension, bucket), count in counts.items()
+        ])
+    return len(counts)
+
+
+def age_band(birth_month, today):
+    """
+    The band of the age reached by the end of the month of `today`, by the
+    'YYYY-MM' birth month.
+    """
+    year, month = map(int, birth_month.split('-'))
+    age = today.year - year - (month > today.month)
+    band = AGE_BANDS[0][1]
+    for lower, name in AGE_BANDS:
+        if age >= lower:
+            band = name
+    return band
+
+
+def get_stats(organization_id):
+    """
+    The statistics of the organization from its rollups.
+    """
+    rows = OrganizationStat.objects.filter(organization_id=organization_id, count__gt=0)
+    signups, ages, status, roles = {}, {name: 0 for _, name in AGE_BANDS}, {}, {}
+    ages[UNKNOWN] = 0
+    today = timezone.now()
+    for dimension, bucket, count in rows.values_list('dimension', 'bucket', 'count'):
+        if dimension == SIGNUPS:
+            signups[bucket] = count
+        elif dimension == BIRTH_MONTH:
+            ages[UNKNOWN if bucket == UNKNOWN else age_band(bucket, today)] += count
+        elif dimension == STATUS:
+            status[bucket] = count
+        elif dimension == ROLE:
+            roles[bucket] = count
+
+    return {
+        'users': status.get(ACTIVE, 0) + status.get(INACTIVE, 0),
+        'active': status.get(ACTIVE, 0),
+        'inactive': status.get(INACTIVE, 0),
+        'signups': [{'month': month, 'count': signups[month]} for month in sorted(signups)],
+        'age_bands': ages,
+        'roles': {name: roles.get(name, 0) for name in (ADMINISTRATOR, VIEWER_ONLY, NO_ROLE)},
+    }
@@ -0,0 +1,51 @@
+"""
+Change feed of an organization for delta sync clients.
+
+Users and organizations carry the sync token of their last write and
+deletions leave a `Tombstone`, all indexed by organization and token, so a
+page of changes costs a few index range scans whatever the tenant size.
+"""
+
+import heapq
+from itertools import islice
+
+from .constants import USER_INFO_FIELDS
+from .models import User, Organization, Tombstone
+from .serializers import UserInfoSerializer, OrganizationSerializer
+
+
+def _entry(kind, obj, since, data):
+    return {
+        'token': obj.sync_token,
+        'type': kind,
+        'action': 'created' if obj.created_token > since else 'updated',
+        'id': obj.pk,
+        'data': data,
+    }
+
+
+def get_changes(organization, since=0, limit=100):
+    """
+    Return the changes of `organization` after the `since` token, oldest
+    first, as (changes, next token, has more).
+    """
+    users = list(User.objects.filter(organization_id=organization.pk, sync_token__gt=since)
+                 .order_by('sync_token')[:limit + 1])
+    organizations = list(Organization.objects.filter(pk=organization.pk, sync_token__gt=since))
+    tombstones = list(Tombstone.objects.filter(organization_id=organization.pk, sync_token__gt=since)
+                      .order_by('sync_token')[:limit + 1])
+
+    user_data = UserInfoSerializer(users, many=True, fields=USER_INFO_FIELDS).data
+    organization_data = OrganizationSerializer(organizations, many=True).data
+
+    streams = [
+        [_entry('user', u, since, d) for u, d in zip(users, user_data)],
+        [_entry('organization', o, since, d) for o, d in zip(organizations, organization_data)],
+        [{'token': t.sync_token, 'type': t.model, 'action': 'deleted',
+          'id': t.object_id, 'data': None} for t in tombstones],
+    ]
+    changes = list(islice(heapq.merge(*streams, key=lambda c: c['token']), limit + 1))
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    next_token = changes[-1]['token'] if changes else since
+    return changes, next_token, has_more
@@ -0,0 +1,23 @@
+from jobs.queue import task
+
+from . import jobs
+
+
+@task('users.organization_job')
+def organization_job(job, organization_job):
+    """
+    Run an `OrganizationJob`, reporting its progress on the queue job.
+    """
+    organization_job = jobs.run_job(
+        organization_job, progress=lambda o: job.report(o.processed, o.total))
+    return {'processed': organization_job.processed}
+
+
+@task('users.assign_groups')
+def assign_groups(job, users, groups):
+    """
+    Set the groups of the users of the job organization.
+    """
+    processed = jobs.assign_groups(
+        job.organization_id, users, groups, progress=lambda done: job.report(done, len(users)))
+    return {'processed': processed}
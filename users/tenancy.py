@@ -0,0 +1,49 @@
+"""
+Request scoped organization binding used by the tenant-aware managers.
+"""
+
+from contextvars import ContextVar
+
+_binding = ContextVar('organization_binding', default=None)
+
+
+class OrganizationBinding:
+    """
+    Resolves the organization of the request user on first use and caches it
+    for the rest of the request. DRF authenticates inside the view, so the id
+    is only cached once an authenticated user is set on the request.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._organization_id = None
+        self._resolved = False
+
+    @property
+    def organization_id(self):
+        if not self._resolved:
+            user = getattr(self.request, 'user', None)
+            if user is None or not user.is_authenticated:
+                return None
+            self._organization_id = user.organization_id
+            self._resolved = True
+        return self._organization_id
+
+
+def bind_organization(request):
+    """
+    Bind the organization of `request` to the current context, returns a token
+    for `unbind_organization`.
+    """
+    return _binding.set(OrganizationBinding(request))
+
+
+def unbind_organization(token):
+    _binding.reset(token)
+
+
+def get_binding():
+    """
+    Return the current `OrganizationBinding` or None outside of a request.
+    """
+    return _binding.get()
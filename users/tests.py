@@ -1,10 +1,67 @@
 
+import gzip
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 from datetime import datetime
-from django.contrib.auth.models import Group
+from importlib import import_module
+from io import StringIO
+from types import SimpleNamespace
+import zlib
+from unittest import mock
+import msgpack
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.contrib.auth.models import Group, Permission
+from django.contrib.auth.password_validation import (
+    get_default_password_validators, validate_password as django_validate_password
+)
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.db import OperationalError, connection, connections, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
-from rest_framework.test import APIRequestFactory, APITestCase
+from rest_framework.serializers import ListSerializer
+from rest_framework.test import APIRequestFactory, APITestCase, force_authenticate
+from rest_framework.views import APIView
+from rest_framework_simplejwt.tokens import AccessToken
 
-from .models import User, Organization
+from jobs.queue import run_worker
+from project.compression import GzipCodec, choose_codec, get_codecs
+from project.metrics import registry as metrics_registry
+from project.profiling import ProfilingMixin
+from project.routers import (
+    PIN_COOKIE, ReplicaRouter, bind_state, unbind_state, pin_user, replica_health
+)
+from project.throttling import (
+    CacheBucketStore, LocalBucketStore, SharedMemoryBucketStore, TokenBucketThrottle,
+    get_store
+)
+from .benchmark import generate_tenants, measure_password_validation, run_benchmark
+from .events import EventStreamApp, StreamTicket, broker
+from .forms import UserCreationForm
+from .jobs import move_batch, run_job
+from .models import (
+    SyncCounter, User, Organization, OrganizationJob, OrganizationStat, Tombstone,
+    UserDirectory
+)
+from .permissions import OrgPermissions, UserPermissions, UserOrgPermissions
+from .passwords import get_password_policy
+from .registry import group_registry
+from .sharding import (
+    ShardRouter, copy_users, hash_shard, move_organization, placements, point_directory, use_shard
+)
+from .stats import age_band, get_stats
+from .sync import get_changes
+from .tenancy import bind_organization, unbind_organization
 from .constants import (
     USER_INFO_FIELDS,
     USER_MODEL_FIELDS, ORG_INFO_FIELDS
@@ -48,9 +105,27 @@ TEST_USERS = {
 }
 
 
+def get_token(user):
+    """
+    Mint an access token for `user`
+    """
+    return str(AccessToken.for_user(user))
+
+
+def run_on_commit(using='default'):
+    """
+    Run the callbacks waiting for the test transaction to commit
+    """
+    connection = connections[using]
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for _, callback in callbacks:
+        callback()
+
+
 class APITests(APITestCase):
 
-    def setUp(self):
+    @classmethod
+    def setUpTestData(cls):
         # get groups
         admin_group = Group.objects.get(name='Administrator')
         viewer_group = Group.objects.get(name='Viewer')
@@ -76,6 +151,17 @@ class APITests(APITestCase):
         viewer_user.organization = lht
         viewer_user.save()
 
+    def setUp(self):
+        # buckets outlive the test transaction
+        get_store().clear()
+
+    def authenticate(self, email):
+        """
+        Use a JWT minted for the user, without going through the login view
+        """
+        user = User.objects.get(email=email)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer %s' % get_token(user))
+
     def test_auth_login(self):
         """
         API must support JWT authentication.
@@ -109,10 +195,7 @@ class APITests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
         # get access token
-        data = {'email': 'admin@test.org', 'password': '12345'}
-        response = self.client.post('/api/auth/login/', data, format='json')
-        token = response.json()['access']
-        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+        self.authenticate('admin@test.org')
 
         # sucess access to groups
         response = self.client.get('/api/auth/groups/')
@@ -172,13 +255,17 @@ class APITests(APITestCase):
         data = {
             'email': 'example@example.org',
             'name': 'Example User',
-            'password': '54321'
+            'password': 'Example-pass-54321'
         }
         self.client.login(email='viewer@test.org', password='12345')
         response = self.client.post('/api/users/', data, format='json')
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
         self.client.login(email='admin@test.org', password='12345')
+        response = self.client.post('/api/users/', {**data, 'password': 'example1'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('too similar to the email address', response.json()['password'][0])
+
         response = self.client.post('/api/users/', data, format='json')
         data = response.json()
         user_created = User.objects.get(pk=data['id'])
@@ -332,10 +419,7 @@ class APITests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
         # get access token
-        data = {'email': 'admin@test.org', 'password': '12345'}
-        response = self.client.post('/api/auth/login/', data, format='json')
-        token = response.json()['access']
-        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+        self.authenticate('admin@test.org')
 
         response = self.client.get('/api/info/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -345,7 +429,8 @@ class APITests(APITestCase):
             response.json()['organization_name'], TEST_ORGS['AAAIMX']['name'])
         self.assertEqual(response.json()['public_ip'], '127.0.0.1')
 
-        # login with viewer account
+        # login with viewer account, tokens come before the session
+        self.client.credentials()
         self.client.login(email='viewer@test.org', password='12345')
 
         response = self.client.get('/api/info/')
@@ -355,3 +440,1323 @@ class APITests(APITestCase):
         self.assertEqual(
             response.json()['organization_name'], TEST_ORGS['AAAIMX']['name'])
         self.assertEqual(response.json()['public_ip'], '127.0.0.1')
+
+    def test_permissions_query_count(self):
+        """
+        Each request should resolve tenancy and role with at most one
+        authorization query.
+        """
+        factory = APIRequestFactory()
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        viewer = User.objects.get(email='viewer@test.org')
+        group_registry.load()
+        cases = [
+            (OrgPermissions, 'get', {'pk': aaaimx.id}, aaaimx),
+            (OrgPermissions, 'patch', {'pk': aaaimx.id}, aaaimx),
+            (UserPermissions, 'get', {}, None),
+            (UserPermissions, 'post', {}, None),
+            (UserPermissions, 'get', {'pk': viewer.id}, viewer),
+            (UserPermissions, 'patch', {'pk': viewer.id}, viewer),
+            (UserPermissions, 'delete', {'pk': viewer.id}, viewer),
+            (UserOrgPermissions, 'get', {'org_id': str(aaaimx.id)}, None),
+        ]
+        for email in ('admin@test.org', 'viewer@test.org', 'guest@test.org'):
+            for permission_class, method, kwargs, obj in cases:
+                user = User.objects.get(email=email)
+                request = getattr(factory, method)('/api/')
+                request.user = user
+                view = SimpleNamespace(kwargs=kwargs)
+                permission = permission_class()
+
+                with CaptureQueriesContext(connection) as queries:
+                    allowed = permission.has_permission(request, view)
+                    if allowed and obj is not None:
+                        permission.has_object_permission(request, view, obj)
+                self.assertLessEqual(len(queries), 1, (email, method, kwargs))
+
+    def test_tenant_managers(self):
+        """
+        Tenant managers scope queries by the organization bound to the request
+        and are not scoped outside of one.
+        """
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        lht = Organization.objects.get(name='Lighthouse Tech')
+        self.assertEqual(User.tenant_objects.count(), 3)
+
+        request = APIRequestFactory().get('/api/users/')
+        request.user = User.objects.get(email='admin@test.org')
+        token = bind_organization(request)
+        try:
+            self.assertEqual(User.tenant_objects.count(), 2)
+            self.assertEqual(list(Organization.tenant_objects.all()), [aaaimx])
+        finally:
+            unbind_organization(token)
+
+        # organizations of other tenants are not visible
+        self.client.login(email='admin@test.org', password='12345')
+        response = self.client.get('/api/organizations/%d/' % lht.id)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_group_registry(self):
+        """
+        Groups are served from the registry and invalidated on changes
+        """
+        group_registry.load()
+        self.client.login(email='admin@test.org', password='12345')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/auth/groups/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse([q for q in queries if 'auth_group' in q['sql']
+                          or 'auth_permission' in q['sql']])
+        admin = response.json()['results'][0]
+        self.assertEqual(admin['name'], 'Administrator')
+        self.assertIn('add_user', admin['permissions'])
+
+        group = Group.objects.create(name='Auditor')
+        self.assertEqual(group_registry.id_for('Auditor'), group.id)
+        group.delete()
+        self.assertIsNone(group_registry.id_for('Auditor'))
+
+        # invalidated by another thread right after loading
+        load = group_registry.load
+
+        def load_then_invalidate():
+            loaded = load()
+            group_registry.invalidate()
+            return loaded
+
+        admin_id = Group.objects.get(name='Administrator').id
+        with mock.patch.object(group_registry, 'load', side_effect=load_then_invalidate):
+            group_registry.invalidate()
+            self.assertEqual(group_registry.id_for('Administrator'), admin_id)
+            self.assertEqual(group_registry.ids_for(['Administrator']), [admin_id])
+
+    def test_metrics(self):
+        """
+        Per view metrics in Prometheus format, admin users only
+        """
+        metrics_registry.reset()
+        self.client.login(email='admin@test.org', password='12345')
+        with override_settings(METRICS_QUERY_BUDGET=0):
+            with self.assertLogs('project.metrics', 'WARNING'):
+                self.client.get('/api/users/')
+
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        User.objects.filter(email='admin@test.org').update(is_staff=True)
+        response = self.client.get('/api/metrics/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn('# TYPE api_db_queries histogram', body)
+        self.assertIn('api_db_queries_count{view="UserViewSet.list"} 1', body)
+        self.assertIn('api_serialize_duration_seconds_bucket{view="UserViewSet.list",le="+Inf"} 1', body)
+
+        # serializer time counts, not only rendering
+        to_representation = ListSerializer.to_representation
+
+        def slow_to_representation(serializer, data):
+            time.sleep(0.05)
+            return to_representation(serializer, data)
+
+        metrics_registry.reset()
+        with mock.patch.object(ListSerializer, 'to_representation', slow_to_representation):
+            self.client.get('/api/users/')
+        body = self.client.get('/api/metrics/').content.decode()
+        serialize_sum = re.search(
+            r'^api_serialize_duration_seconds_sum\{view="UserViewSet.list"\} (\S+)$', body, re.M)
+        self.assertGreaterEqual(float(serialize_sum.group(1)), 0.05)
+
+    def test_benchmark(self):
+        """
+        Synthetic tenants are bulk created and every endpoint is benchmarked
+        """
+        org, = generate_tenants(orgs=1, users=40, batch_size=15)
+        self.assertEqual(User.objects.filter(organization=org).count(), 40)
+        self.assertTrue(User.objects.filter(
+            organization=org, groups__name='Administrator').exists())
+
+        report = run_benchmark(org, requests=2)
+        self.assertEqual(report['users_list']['status'], status.HTTP_200_OK)
+        self.assertEqual(report['users_delete']['status'], status.HTTP_204_NO_CONTENT)
+        for result in report.values():
+            self.assertGreater(result['queries'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_lean_api_middleware(self):
+        """
+        Token authenticated API calls skip session, csrf, messages and
+        clickjacking middleware, other requests keep the full stack
+        """
+        self.authenticate('admin@test.org')
+        response = self.client.get('/api/info/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+        self.assertNotIn('X-Frame-Options', response)
+
+        self.client.login(email='admin@test.org', password='12345')
+        # the token is used before the session cookie
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/info/')
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+
+        self.client.credentials()
+        response = self.client.get('/api/info/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(hasattr(response.wsgi_request, 'session'))
+        self.assertIn('X-Frame-Options', response)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_user_changelist(self):
+        """
+        User changelist runs a constant number of queries, filters by typed
+        values and links the next page by keyset
+        """
+        admin = User.objects.get(email='admin@test.org')
+        User.objects.filter(pk=admin.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(admin)
+        aaaimx = Organization.objects.get(name='AAAIMX')
+
+        with CaptureQueriesContext(connection) as before:
+            response = self.client.get('/users/user/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        User.objects.bulk_create([
+            User(email='bulk%02d@test.org' % i, organization=aaaimx) for i in range(120)
+        ])
+        with CaptureQueriesContext(connection) as after:
+            response = self.client.get('/users/user/')
+        self.assertEqual(len(before), len(after))
+        self.assertContains(response, 'email__gt=bulk')
+
+        response = self.client.get('/users/user/?organization=%d&email__gt=bulk50@test.org' % aaaimx.id)
+        self.assertContains(response, 'field-email">bulk51@test.org<')
+        self.assertNotContains(response, 'field-email">bulk50@test.org<')
+        self.assertNotContains(response, 'field-email">guest@test.org<')
+
+        response = self.client.get('/users/user/%d/change/' % admin.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_organization_jobs(self):
+        """
+        Organization deletion and user moves run as resumable batched jobs
+        leaving tombstones for the change feed
+        """
+        admin = User.objects.get(email='admin@test.org')
+        User.objects.filter(pk=admin.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(admin)
+        doomed = Organization.objects.create(name='Doomed')
+        User.objects.bulk_create([
+            User(email='doomed%d@test.org' % i, organization=doomed) for i in range(5)
+        ])
+
+        response = self.client.post('/users/organization/%d/delete/' % doomed.id, {'post': 'yes'},
+                                    format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_302_FOUND)
+        job = OrganizationJob.objects.get(organization_id=doomed.id)
+        self.assertEqual((job.action, job.status, job.total), (OrganizationJob.DELETE, 'pending', 5))
+        self.assertTrue(Organization.objects.filter(pk=doomed.id).exists())
+
+        # resumes after an interrupted batch
+        move_batch(job, 2)
+        self.assertEqual(OrganizationJob.objects.get(pk=job.pk).processed, 2)
+        progress = []
+        job = run_job(job.pk, batch_size=2, progress=lambda j: progress.append(j.processed))
+        self.assertEqual(progress, [4, 5])
+        self.assertEqual((job.status, job.processed, job.progress), ('done', 5, 1.0))
+        self.assertFalse(Organization.objects.filter(pk=doomed.id).exists())
+        self.assertFalse(User.objects.filter(email__startswith='doomed', organization__isnull=False))
+        self.assertEqual(Tombstone.objects.filter(organization_id=doomed.id).count(), 6)
+
+        # deletes from code queue the job, for instances and querysets
+        doomed = Organization.objects.create(name='Doomed')
+        User.objects.bulk_create([User(email='gone@test.org', organization=doomed)])
+        job = doomed.delete()
+        self.assertEqual((job.action, job.status), (OrganizationJob.DELETE, 'pending'))
+        others = [Organization.objects.create(name='Doomed %d' % i) for i in range(2)]
+        jobs = Organization.objects.filter(name__startswith='Doomed ').delete()
+        self.assertEqual([job.organization_id for job in jobs], [other.pk for other in others])
+        self.assertEqual(Organization.objects.filter(name__startswith='Doomed').count(), 3)
+        self.assertEqual(User.objects.get(email='gone@test.org').organization_id, doomed.pk)
+        with self.settings(ORGANIZATION_JOB_BATCH_SIZE=1):
+            run_worker(burst=True)
+        self.assertEqual(OrganizationJob.objects.get(pk=job.pk).processed, 1)
+        self.assertFalse(Organization.objects.filter(name__startswith='Doomed').exists())
+        self.assertIsNone(User.objects.get(email='gone@test.org').organization_id)
+
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        lht = Organization.objects.get(name='Lighthouse Tech')
+        out = StringIO()
+        call_command('organization_jobs', move=[lht.id, aaaimx.id], stdout=out)
+        self.assertIn('1/1 users (100%)', out.getvalue())
+        self.assertFalse(User.objects.filter(organization=lht).exists())
+        changes, _, _ = get_changes(aaaimx, since=0)
+        guest = User.objects.get(email='guest@test.org')
+        self.assertEqual((changes[-1]['type'], changes[-1]['id']), ('user', guest.id))
+
+    def test_organization_stats(self):
+        """
+        Organization statistics follow the user writes and match a rebuild
+        """
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        url = '/api/organizations/%d/stats/' % aaaimx.id
+        self.authenticate('admin@test.org')
+        # rollups are updated once the writes commit
+        run_on_commit()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual((data['users'], data['active'], data['inactive']), (2, 2, 0))
+        self.assertEqual(data['signups'], [{'month': datetime.now().strftime('%Y-%m'), 'count': 2}])
+        self.assertEqual(data['age_bands']['<18'], 2)
+        self.assertEqual(data['roles'], {'administrator': 1, 'viewer': 1, 'none': 0})
+
+        response = self.client.post('/api/users/', {
+            'email': 'stats@test.org', 'name': 'Stats', 'password': 'Stats-pass-2024',
+            'birthdate': '1990-01-31T08:30:00'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        user = User.objects.get(email='stats@test.org')
+        user.is_active = False
+        with CaptureQueriesContext(connection) as queries:
+            user.save()
+        # nothing but the user write in its transaction
+        self.assertFalse([query for query in queries
+                          if 'organizationstat' in query['sql'] or 'FOR UPDATE' in query['sql']])
+        User.objects.get(email='viewer@test.org').groups.add(Group.objects.get(name='Administrator'))
+        guest = User.objects.get(email='guest@test.org')
+        guest.organization = aaaimx
+        guest.save()
+
+        run_on_commit()
+        data = self.client.get(url).json()
+        self.assertEqual((data['users'], data['active'], data['inactive']), (4, 3, 1))
+        self.assertEqual(data['age_bands'][age_band('1990-01', datetime.now())], 1)
+        self.assertEqual(age_band('2000-06', datetime(2018, 5, 31)), '<18')
+        self.assertEqual(age_band('2000-06', datetime(2018, 6, 1)), '18-24')
+        self.assertEqual(data['roles'], {'administrator': 2, 'viewer': 0, 'none': 2})
+        lht = Organization.objects.get(name='Lighthouse Tech')
+        self.assertEqual(get_stats(lht.id)['users'], 0)
+
+        response = self.client.delete('/api/users/%d/' % guest.id)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        run_on_commit()
+        data = self.client.get(url).json()
+        self.assertEqual((data['users'], data['roles']['none']), (3, 1))
+
+        call_command('rebuild_stats', stdout=StringIO())
+        self.assertEqual(self.client.get(url).json(), data)
+        self.assertGreater(OrganizationStat.objects.filter(organization_id=aaaimx.id).count(), 0)
+
+        # organizations created before the rollups are counted by the migration
+        OrganizationStat.objects.all().delete()
+        migration = import_module('users.migrations.0011_backfill_organization_stats')
+        state = MigrationLoader(connection).project_state(('users', '0011_backfill_organization_stats'))
+        migration.backfill_stats(state.apps, SimpleNamespace(connection=connection))
+        self.assertEqual(self.client.get(url).json(), data)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_email_key(self):
+        """
+        Emails are matched in any case through the indexed email key
+        """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/auth/login/', {
+                'email': 'Admin@Test.ORG', 'password': TEST_USERS['ADMIN']['password']})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('"email_key" = \'admin@test.org\'', queries[0]['sql'])
+
+        self.authenticate('admin@test.org')
+        response = self.client.post('/api/users/', {
+            'email': 'VIEWER@test.org', 'name': 'Viewer', 'password': 'Viewer-pass-2024'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('email', response.json())
+        form = UserCreationForm({'email': 'VIEWER@test.org', 'name': 'Viewer',
+                                 'password1': 'Viewer-pass-2024', 'password2': 'Viewer-pass-2024'})
+        self.assertEqual(form.errors['email'], response.json()['email'])
+        response = self.client.post('/api/users/', {
+            'email': 'New.User@test.org', 'name': 'New', 'password': 'New-pass-2024'})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(User.objects.get(email='New.User@test.org').email_key, 'new.user@test.org')
+
+        admin = User.objects.get(email='admin@test.org')
+        User.objects.filter(pk=admin.pk).update(is_staff=True, is_superuser=True)
+        self.client.force_login(admin)
+        response = self.client.get('/users/user/?q=NEW.user@TEST.org')
+        self.assertContains(response, 'field-email">New.User@test.org<')
+        self.assertNotContains(response, 'field-email">admin@test.org<')
+
+    @override_settings(THROTTLE_BUCKETS={
+        'login': {'ip': '10/min', 'email': '2/min'},
+        'write': {'user': '1/min'},
+        'read': {'org': '3/min'},
+    })
+    def test_throttling(self):
+        """
+        Requests take tokens from the buckets of their scope and get 429
+        with Retry-After once one is empty
+        """
+        for _ in range(2):
+            response = self.client.post('/api/auth/login/', {'email': 'Admin@test.org', 'password': 'x'})
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post('/api/auth/login/', {'email': 'admin@test.org', 'password': 'x'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '30')
+        response = self.client.post('/api/auth/login/', {'email': 'viewer@test.org', 'password': 'x'})
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        # the rejected attempt gave its IP token back, forwarded IPs aren't trusted
+        for i in range(6):
+            self.client.post('/api/auth/login/', {'email': 'viewer@test.org', 'password': 'x'},
+                             HTTP_X_FORWARDED_FOR='10.0.0.%d' % i)
+        for i in range(6):
+            response = self.client.post('/api/auth/login/', {'email': 'u%d@test.org' % i, 'password': 'x'})
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.post('/api/auth/login/', {'email': 'other@test.org', 'password': 'x'})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        url = '/api/organizations/%d/' % aaaimx.id
+        self.authenticate('admin@test.org')
+        self.assertEqual(self.client.patch(url, {'phone': '1'}).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.patch(url, {'phone': '2'}).status_code,
+                         status.HTTP_429_TOO_MANY_REQUESTS)
+
+        # the organization bucket is shared by its users
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self.authenticate('viewer@test.org')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '20')
+
+        request = APIRequestFactory().get(url)
+        request.user = User.objects.get(email='guest@test.org')
+        with self.assertNumQueries(0):
+            self.assertTrue(TokenBucketThrottle().allow_request(request, None))
+
+    def test_profiling(self):
+        """
+        Staff users profile a request inline or stored, a sample of other
+        requests is stored
+        """
+        self.authenticate('admin@test.org')
+        response = self.client.get('/api/users/?_profile=1')
+        self.assertIn('results', response.json())
+        self.assertNotIn('X-Profile-Id', response)
+
+        User.objects.filter(email='admin@test.org').update(is_staff=True)
+        report = self.client.get('/api/users/?_profile=1').json()
+        self.assertEqual((report['status'], report['path']), (200, '/api/users/?_profile=1'))
+        self.assertTrue(report['queries'])
+        self.assertTrue(report['functions'])
+        self.assertGreater(report['serializer_ms'], 0)
+
+        with tempfile.TemporaryDirectory() as tmp, override_settings(PROFILE_DIR=tmp):
+            response = self.client.get('/api/info/', HTTP_X_PROFILE='store')
+            self.assertEqual(response.json()['user_name'], 'Raul Novelo')
+            url = '/api/profiles/%s/' % response['X-Profile-Id']
+            self.assertEqual(self.client.get(url).json()['path'], '/api/info/')
+            self.assertIn('attachment', self.client.get(url + '?pstats=1')['Content-Disposition'])
+            self.assertEqual(self.client.get('/api/profiles/../').status_code, status.HTTP_404_NOT_FOUND)
+            self.assertEqual(self.client.get('/api/profiles/%s/' % ('0' * 32)).status_code,
+                             status.HTTP_404_NOT_FOUND)
+
+            self.authenticate('viewer@test.org')
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+            with override_settings(PROFILE_SAMPLE_RATE=1):
+                response = self.client.get('/api/info/')
+            self.assertEqual(len(os.listdir(tmp)), 4)
+            self.assertIn('X-Profile-Id', response)
+            # the oldest profiles are dropped
+            with override_settings(PROFILE_SAMPLE_RATE=1, PROFILE_MAX_FILES=1):
+                response = self.client.get('/api/info/')
+            self.assertEqual(sorted(os.listdir(tmp)), [
+                '%s.%s' % (response['X-Profile-Id'], suffix) for suffix in ('json', 'prof')])
+
+        class FailingView(ProfilingMixin, APIView):
+            def get(self, request):
+                raise RuntimeError
+
+        request = APIRequestFactory().get('/', HTTP_X_PROFILE='inline')
+        force_authenticate(request, User.objects.get(email='admin@test.org'))
+        with self.assertRaises(RuntimeError):
+            FailingView.as_view()(request)
+        self.assertIsNone(sys.getprofile())
+        self.assertEqual(connection.execute_wrappers, [])
+
+    def test_sparse_fieldsets(self):
+        """
+        `?fields=` trims the response and the selected columns, `?expand=`
+        nests relations
+        """
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        self.authenticate('admin@test.org')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/users/?fields=id,name')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.json()['results'][0].keys()), ['id', 'name'])
+        select = [q['sql'] for q in queries if 'FROM "users_user"' in q['sql']][-1]
+        self.assertNotIn('"password"', select)
+        self.assertNotIn('users_organization', select)
+        self.assertFalse([q for q in queries if 'auth_group' in q['sql']])
+
+        response = self.client.get('/api/users/?fields=id,organization')
+        self.assertEqual(response.json()['results'][0]['organization'], aaaimx.id)
+
+        response = self.client.get('/api/users/?fields=id,organization&expand=organization')
+        self.assertEqual(response.json()['results'][0]['organization'],
+                         {'id': aaaimx.id, 'name': aaaimx.name})
+
+        response = self.client.get('/api/organizations/%d/?fields=name' % aaaimx.id)
+        self.assertEqual(response.json(), {'name': aaaimx.name})
+
+        response = self.client.get('/api/organizations/%d/users/?fields=name' % aaaimx.id)
+        self.assertEqual(list(response.json()['results'][0].keys()), ['name'])
+
+        response = self.client.get('/api/users/?fields=id,secret')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        # model fields the serializer of the view doesn't render
+        response = self.client.get('/api/organizations/%d/users/?fields=name,email' % aaaimx.id)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {'fields': 'Unknown fields: email'})
+        user = User.objects.get(email='admin@test.org')
+        response = self.client.get('/api/users/%d/?fields=id,is_staff' % user.pk)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sync_counter(self):
+        """
+        A missing counter row is recreated above the stamped tokens, and
+        logins don't take a token
+        """
+        last = User.objects.order_by('-sync_token').first().sync_token
+        SyncCounter.objects.all().delete()
+        user = User.objects.create_superuser(email='root@test.org', password='12345', name='Root')
+        self.assertEqual(user.sync_token, last + 1)
+
+        response = self.client.post('/api/auth/login/', {'email': 'root@test.org', 'password': '12345'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        user.refresh_from_db()
+        self.assertIsNotNone(user.last_login)
+        self.assertEqual(user.sync_token, last + 1)
+        self.assertEqual(SyncCounter.objects.get(pk=1).value, last + 1)
+
+    def test_changes_feed(self):
+        """
+        Organization change feed returns created, updated and deleted
+        records after a sync token, paginated by token
+        """
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        lht = Organization.objects.get(name='Lighthouse Tech')
+        url = '/api/organizations/%d/changes/' % aaaimx.id
+
+        self.authenticate('guest@test.org')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.authenticate('viewer@test.org')
+        data = self.client.get(url).json()
+        self.assertEqual([(c['type'], c['action']) for c in data['results']],
+                         [('organization', 'created'), ('user', 'created'), ('user', 'created')])
+        self.assertFalse(data['has_more'])
+        since = data['next']
+
+        self.assertEqual(self.client.get(url + '?since=%d' % since).json()['results'], [])
+
+        admin = User.objects.get(email='admin@test.org')
+        viewer = User.objects.get(email='viewer@test.org')
+        admin.phone = '000'
+        admin.save()
+        new_user = User.objects.create_user('new@test.org', organization=aaaimx)
+        new_user_id = new_user.id
+        viewer.organization = lht
+        viewer.save()
+        new_user.delete()
+
+        self.authenticate('admin@test.org')
+        data = self.client.get(url + '?since=%d&limit=2' % since).json()
+        self.assertTrue(data['has_more'])
+        changes = data['results']
+        data = self.client.get(url + '?since=%d&limit=2' % data['next']).json()
+        self.assertFalse(data['has_more'])
+        changes += data['results']
+        self.assertEqual([(c['id'], c['action']) for c in changes], [
+            (admin.id, 'updated'),
+            (viewer.id, 'deleted'),
+            (new_user_id, 'deleted'),
+        ])
+        self.assertEqual(changes[0]['data']['phone'], '000')
+
+    def test_batch(self):
+        """
+        Batch endpoint runs sub-requests with a single authentication and
+        returns their status and body in order
+        """
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        admin = User.objects.get(email='admin@test.org')
+        org_url = '/api/organizations/%d/' % aaaimx.id
+        requests = [
+            {'url': '/api/info/'},
+            {'url': org_url},
+            {'url': '/api/auth/groups/'},
+            {'url': '/api/users/%d/?fields=id,email' % admin.id},
+            {'url': '/api/unknown/'},
+            {'method': 'PATCH', 'url': org_url, 'body': {'phone': '123'}},
+        ]
+
+        self.authenticate('admin@test.org')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/batch/', {'requests': requests})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # the user and its roles are loaded once for every sub-request
+        self.assertEqual(len([q for q in queries
+                              if 'WHERE "users_user"."id" = %d' % admin.id in q['sql']]), 1)
+        self.assertEqual(len([q for q in queries if 'FROM "users_user_groups"' in q['sql']]), 1)
+
+        responses = response.json()['responses']
+        self.assertEqual([r['status'] for r in responses], [200, 200, 200, 200, 404, 200])
+        self.assertEqual(responses[0]['body']['organization_name'], 'AAAIMX')
+        self.assertEqual(responses[3]['body'], {'id': admin.id, 'email': 'admin@test.org'})
+        self.assertEqual(responses[5]['body']['phone'], '123')
+        self.assertEqual(Organization.objects.get(pk=aaaimx.id).phone, '123')
+
+        # reads of the registry run in worker threads
+        group_registry.load()
+        response = self.client.post('/api/batch/', {'concurrent': True, 'requests': [
+            {'url': '/api/auth/groups/'}, {'url': '/api/auth/groups/?offset=1'}]})
+        first, second = response.json()['responses']
+        self.assertEqual(first['body']['results'][1:], second['body']['results'])
+
+        self.authenticate('guest@test.org')
+        response = self.client.post('/api/batch/', {'requests': requests[1:2]})
+        self.assertEqual(response.json()['responses'][0]['status'], status.HTTP_403_FORBIDDEN)
+
+        for invalid in ([{'url': '/api/batch/'}], [{'url': '/admin/'}], [{'url': '/api/info/'}] * 21):
+            response = self.client.post('/api/batch/', {'requests': invalid})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(COMPRESSION_ENCODINGS={'gzip': 6}, COMPRESSION_MIN_SIZE=200)
+    def test_compression(self):
+        """
+        API responses over the threshold are compressed with an accepted
+        encoding, streamed ones chunk by chunk
+        """
+        self.authenticate('admin@test.org')
+        plain = self.client.get('/api/users/')
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', plain['Vary'])
+
+        response = self.client.get('/api/users/', HTTP_ACCEPT_ENCODING='br;q=1, gzip;q=0.5')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+
+        response = self.client.get('/api/users/', HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        # under the threshold
+        response = self.client.get('/api/info/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        url = '/api/organizations/%d/users/export/' % aaaimx.id
+        with mock.patch('users.views.EXPORT_BATCH_SIZE', 1):
+            plain = b''.join(self.client.get(url).streaming_content)
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            decompressor = zlib.decompressobj(31)
+            chunks = [decompressor.decompress(chunk) for chunk in response.streaming_content]
+        # every chunk is flushed and decodes on its own
+        first, second = json.loads(plain)
+        self.assertEqual(chunks[:4], [b'[', json.dumps(first, separators=(',', ':')).encode(),
+                                      b',' + json.dumps(second, separators=(',', ':')).encode(), b']'])
+        self.assertEqual(b''.join(chunks), plain)
+
+        # streams are timed as they are compressed
+        stream = GzipCodec.stream
+
+        def slow_stream(codec, chunks):
+            for chunk in stream(codec, chunks):
+                time.sleep(0.02)
+                yield chunk
+
+        metrics_registry.reset()
+        with mock.patch.object(GzipCodec, 'stream', slow_stream):
+            response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertNotIn('UserOrganizationViewSet.export', metrics_registry.render())
+            b''.join(response.streaming_content)
+        compress_sum = re.search(r'^api_compress_duration_seconds_sum'
+                                 r'\{view="UserOrganizationViewSet.export"\} (\S+)$',
+                                 metrics_registry.render(), re.M)
+        self.assertGreaterEqual(float(compress_sum.group(1)), 0.02 * 3)
+
+        # token responses aren't compressed
+        response = self.client.post('/api/auth/login/', {'email': 'admin@test.org', 'password': '12345'},
+                                    HTTP_ACCEPT_ENCODING='gzip')
+        self.assertIn('access', response.json())
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_message_pack(self):
+        """
+        MessagePack is negotiated by Accept and Content-Type, with the same
+        values, dates included, as JSON
+        """
+        self.authenticate('admin@test.org')
+        as_json = self.client.get('/api/users/').json()
+        response = self.client.get('/api/users/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content, raw=False), as_json)
+        self.assertIsInstance(as_json['results'][0]['birthdate'], str)
+
+        data = {'email': 'packed@example.org', 'name': 'Packed User',
+                'password': 'Packed-pass-54321', 'birthdate': '1990-01-31T08:30:00'}
+        response = self.client.post('/api/users/', data, format='msgpack')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(User.objects.get(email='packed@example.org').birthdate,
+                         datetime(1990, 1, 31, 8, 30))
+
+        response = self.client.post('/api/users/', b'\xc1', content_type='application/msgpack')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_users_export(self):
+        """
+        The export streams every user of the organization, in batches by id
+        """
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        url = '/api/organizations/%d/users/export/' % aaaimx.id
+        expected = list(User.objects.filter(organization=aaaimx)
+                        .order_by('id').values('id', 'name'))
+
+        self.authenticate('guest@test.org')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.authenticate('viewer@test.org')
+        with mock.patch('users.views.EXPORT_BATCH_SIZE', 1), \
+                CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+            body = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(body), expected)
+        self.assertEqual(sum('"users_user"."id" >' in q['sql'] for q in queries), 3)
+
+        response = self.client.get(url + '?fields=id', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(b''.join(response.streaming_content))
+        self.assertEqual(list(unpacker), [{'id': user['id']} for user in expected])
+
+    @mock.patch('users.events.CHANGES_PAGE_SIZE', 2)
+    @mock.patch('users.events.close_old_connections')
+    def test_event_stream(self, close_old_connections):
+        """
+        Organization event stream replays the change feed after the last
+        event id page by page and pushes published changes to authorized
+        subscribers
+        """
+        aaaimx = Organization.objects.get(name='AAAIMX')
+        lht = Organization.objects.get(name='Lighthouse Tech')
+        app = EventStreamApp(None)
+        path = '/api/organizations/%d/events/' % aaaimx.id
+        admin = User.objects.get(email='admin@test.org')
+        access = get_token(admin)
+        other_ticket = StreamTicket.for_organization(admin, lht.id)
+        guest = 'Bearer %s' % get_token(User.objects.get(email='guest@test.org'))
+        self.authenticate('admin@test.org')
+        response = self.client.post(path + 'ticket/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        ticket = response.json()['ticket']
+        self.authenticate('guest@test.org')
+        self.assertEqual(self.client.post(path + 'ticket/').status_code, status.HTTP_403_FORBIDDEN)
+
+        async def connect(query='', headers=()):
+            communicator = ApplicationCommunicator(app, {
+                'type': 'http', 'method': 'GET', 'path': path,
+                'query_string': query.encode(), 'headers': list(headers),
+            })
+            await communicator.send_input({'type': 'http.request'})
+            return communicator, await communicator.receive_output(5)
+
+        async def read_event(communicator):
+            message = await communicator.receive_output(5)
+            fields = dict(line.split(': ', 1) for line in message['body'].decode().split('\n') if line)
+            return fields['event'], json.loads(fields['data'])
+
+        @async_to_sync
+        async def scenario():
+            communicator, start = await connect()
+            self.assertEqual(start['status'], status.HTTP_401_UNAUTHORIZED)
+            # access tokens stay out of the URL, tickets only open streams
+            for query in ('token=%s' % access, 'ticket=%s' % access):
+                communicator, start = await connect(query)
+                self.assertEqual(start['status'], status.HTTP_401_UNAUTHORIZED)
+            communicator, start = await connect('ticket=%s' % other_ticket)
+            self.assertEqual(start['status'], status.HTTP_403_FORBIDDEN)
+            communicator, start = await connect(headers=[(b'authorization', guest.encode())])
+            self.assertEqual(start['status'], status.HTTP_403_FORBIDDEN)
+
+            communicator, start = await connect('ticket=' + ticket, [(b'last-event-id', b'0')])
+            self.assertEqual(start['status'], status.HTTP_200_OK)
+            self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+            replayed = [await read_event(communicator) for _ in range(3)]
+            self.assertEqual([event for event, _ in replayed],
+                             ['organization.created', 'user.created', 'user.created'])
+
+            self.assertTrue(broker.has_subscribers(aaaimx.id))
+            broker.publish(aaaimx.id, {'token': 10 ** 9, 'type': 'user', 'action': 'deleted',
+                                       'id': 1, 'data': None})
+            self.assertEqual(await read_event(communicator), ('user.deleted', {
+                'token': 10 ** 9, 'type': 'user', 'action': 'deleted', 'id': 1, 'data': None}))
+
+            await communicator.send_input({'type': 'http.disconnect'})
+            await communicator.wait(5)
+            self.assertFalse(broker.has_subscribers(aaaimx.id))
+
+        scenario()
+
+
+class CompressionTests(SimpleTestCase):
+
+    def test_choose_codec(self):
+        """
+        The accepted encoding of highest quality wins, ties go to the
+        configured order
+        """
+        codecs = {'zstd': SimpleNamespace(name='zstd'), 'gzip': SimpleNamespace(name='gzip')}
+        with mock.patch('project.compression.get_codecs', return_value=codecs):
+            self.assertEqual(choose_codec('gzip, zstd').name, 'zstd')
+            self.assertEqual(choose_codec('gzip, zstd;q=0.5').name, 'gzip')
+            self.assertEqual(choose_codec('*').name, 'zstd')
+            self.assertEqual(choose_codec('*, zstd;q=0').name, 'gzip')
+            self.assertIsNone(choose_codec('identity'))
+            self.assertIsNone(choose_codec(None))
+
+    def test_codecs(self):
+        """
+        Every available codec compresses bodies and streams
+        """
+        body = b''.join(b'{"id":%d,"name":"User %d"},' % (i, i) for i in range(500))
+        for name, codec in get_codecs().items():
+            with self.subTest(codec=name):
+                decompress = {
+                    'gzip': gzip.decompress,
+                    'br': lambda data: __import__('brotli').decompress(data),
+                    'zstd': lambda data: __import__('zstandard').ZstdDecompressor()
+                    .decompressobj().decompress(data),
+                }[name]
+                self.assertEqual(decompress(codec.compress(body)), body)
+                self.assertEqual(decompress(b''.join(codec.stream([body[:100], body[100:]]))), body)
+
+
+class PasswordPolicyTests(SimpleTestCase):
+
+    def test_matches_django(self):
+        """
+        The compiled policy rejects the passwords Django's validators reject,
+        with their errors
+        """
+        user = User(email='jane.doe@example.org', name='Jane Doe')
+        for password in ('', '1234', 'password', 'janedoe1', 'jane.doe@example.org',
+                         '9876543210', 'Doe-jane-2024', 'correct horse battery'):
+            try:
+                django_validate_password(password, user)
+                expected = None
+            except DjangoValidationError as error:
+                expected = error.messages
+            try:
+                get_password_policy().validate(password, user)
+                result = None
+            except DjangoValidationError as error:
+                result = error.messages
+            self.assertEqual(result, expected, password)
+
+    def test_compiled_once(self):
+        """
+        The common password list is loaded once per process
+        """
+        get_default_password_validators.cache_clear()
+        get_password_policy.cache_clear()
+        with mock.patch('django.contrib.auth.password_validation.gzip.open',
+                        wraps=gzip.open) as opened:
+            for _ in range(3):
+                with self.assertRaises(DjangoValidationError):
+                    get_password_policy().validate('qwerty123')
+        self.assertEqual(opened.call_count, 1)
+
+    def test_benchmark(self):
+        report = measure_password_validation(users=200)
+        self.assertEqual(report['django']['rejected'], report['policy']['rejected'])
+        self.assertGreater(report['policy']['rejected'], 0)
+
+
+class BucketStoreTests(SimpleTestCase):
+
+    def test_stores(self):
+        """
+        Stores let a burst of `capacity` through then refill at `rate`
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            stores = [LocalBucketStore(), CacheBucketStore(),
+                      SharedMemoryBucketStore(os.path.join(tmp, 'buckets'), slots=16)]
+            for store in stores:
+                store.clear()
+                with mock.patch('project.throttling.time.time', return_value=1000.0) as now:
+                    self.assertEqual([store.consume('k', 0.5, 2) for _ in range(3)], [0, 0, 2.0])
+                    self.assertEqual(store.consume('other', 0.5, 2), 0)
+                    now.return_value = 1002.0
+                    self.assertEqual(store.consume('k', 0.5, 2), 0)
+                    self.assertEqual(store.consume('k', 0.5, 2), 2.0)
+                    store.refund('k', 0.5, 2)
+                    self.assertEqual(store.consume('k', 0.5, 2), 0)
+
+
+class SQLiteBackendTests(SimpleTestCase):
+    aliases = ('sqlite_a', 'sqlite_b')
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'db.sqlite3')
+        self.addCleanup(self.remove_aliases)
+
+    def configure(self, **options):
+        for alias in self.aliases:
+            connections.databases[alias] = {
+                'ENGINE': 'project.sqlite3', 'NAME': self.path,
+                'OPTIONS': {'timeout': 0, **options},
+            }
+        with connections['sqlite_a'].cursor() as cursor:
+            cursor.execute('CREATE TABLE IF NOT EXISTS t (id INTEGER PRIMARY KEY)')
+
+    def remove_aliases(self):
+        for alias in self.aliases:
+            if hasattr(connections._connections, alias):
+                connections[alias].close()
+                del connections[alias]
+            connections.databases.pop(alias, None)
+
+    def pragma(self, alias, name):
+        with connections[alias].cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        """
+        Connections use WAL, relaxed syncs and the busy timeout
+        """
+        self.configure(timeout=2, pragmas={'cache_size': -1024})
+        self.assertEqual(self.pragma('sqlite_a', 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma('sqlite_a', 'synchronous'), 1)
+        self.assertEqual(self.pragma('sqlite_a', 'cache_size'), -1024)
+        self.assertEqual(self.pragma('sqlite_a', 'busy_timeout'), 2000)
+
+    def test_immediate_transactions(self):
+        """
+        Atomic blocks hold the write lock from the start
+        """
+        self.configure()
+        with transaction.atomic(using='sqlite_a'):
+            connections['sqlite_a'].cursor().execute('SELECT COUNT(*) FROM t')
+            with self.assertRaisesMessage(OperationalError, 'locked'):
+                connections['sqlite_b'].cursor().execute('INSERT INTO t VALUES (1)')
+        connections['sqlite_b'].cursor().execute('INSERT INTO t VALUES (1)')
+
+    def test_single_writer(self):
+        """
+        Writers wait for their turn instead of failing on a locked database
+        """
+        self.configure(single_writer=True)
+        errors = []
+
+        def write():
+            try:
+                connections['sqlite_b'].cursor().execute('INSERT INTO t VALUES (2)')
+            except OperationalError as e:
+                errors.append(e)
+            finally:
+                connections['sqlite_b'].close()
+
+        with transaction.atomic(using='sqlite_a'):
+            connections['sqlite_a'].cursor().execute('INSERT INTO t VALUES (1)')
+            writer = threading.Thread(target=write)
+            writer.start()
+            writer.join(0.2)
+            self.assertTrue(writer.is_alive())
+        writer.join()
+        self.assertEqual(errors, [])
+        with connections['sqlite_a'].cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM t')
+            self.assertEqual(cursor.fetchone()[0], 2)
+
+
+@override_settings(DATABASE_REPLICAS=['replica_0', 'replica_1'])
+class ReplicaRouterTests(SimpleTestCase):
+    aliases = ('replica_0', 'replica_1')
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.factory = APIRequestFactory()
+        replica_health.reset()
+
+    def route(self, method, user=None):
+        request = getattr(self.factory, method)('/api/users/')
+        if user is not None:
+            request.user = user
+        token = bind_state(request)
+        try:
+            return self.router.db_for_read(User), self.router.db_for_write(User)
+        finally:
+            unbind_state(token)
+
+    def add_replicas(self, *paths):
+        for alias, path in zip(self.aliases, paths):
+            connections.databases[alias] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+            connections.ensure_defaults(alias)
+            connections.prepare_test_settings(alias)
+        self.addCleanup(self.remove_replicas)
+
+    def remove_replicas(self):
+        for alias in self.aliases:
+            self.remove_alias(alias)
+
+    @staticmethod
+    def remove_alias(alias):
+        if hasattr(connections._connections, alias):
+            connections[alias].close()
+            del connections[alias]
+        connections.databases.pop(alias, None)
+
+    def test_reads_and_writes(self):
+        """
+        Safe requests read from a replica, writes go to the primary
+        """
+        with mock.patch.object(replica_health, 'check', return_value=True):
+            read_db, write_db = self.route('get')
+            self.assertIn(read_db, ['replica_0', 'replica_1'])
+            self.assertIsNone(write_db)
+
+            self.assertEqual(self.route('patch'), (None, None))
+
+        # no request bound, e.g. management commands
+        self.assertIsNone(self.router.db_for_read(User))
+
+    def test_read_your_writes(self):
+        """
+        Users are pinned to the primary for a short window after a write,
+        by a signed cookie with a process local cache
+        """
+        user = User(id=999, email='pinned@test.org')
+        with mock.patch.object(replica_health, 'check', return_value=True):
+            self.assertIsNotNone(self.route('get', user)[0])
+            response = HttpResponse()
+            pin_user(user, response)
+            self.factory.cookies = response.cookies
+            self.assertIsNone(self.route('get', user)[0])
+            self.assertIsNotNone(self.route('get', User(id=1000, email='other@test.org'))[0])
+            self.factory.cookies[PIN_COOKIE] = '999'
+            self.assertIsNotNone(self.route('get', user)[0])
+
+            with tempfile.TemporaryDirectory() as tmp, override_settings(
+                    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                            'pins': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                     'LOCATION': tmp}},
+                    REPLICA_PIN_CACHE='pins'):
+                self.factory = APIRequestFactory()
+                self.assertIsNotNone(self.route('get', user)[0])
+                response = HttpResponse()
+                pin_user(user, response)
+                self.assertNotIn(PIN_COOKIE, response.cookies)
+                self.assertIsNone(self.route('get', user)[0])
+
+    @override_settings(USER_SHARDS=['shard_0'], USER_SHARD_REPLICAS={'shard_0': ['shard_0_replica_0']})
+    def test_shard_replicas(self):
+        """
+        Safe requests read sharded models from a replica of their shard,
+        instances read from it are written to the shard
+        """
+        router = ShardRouter()
+        connections.databases['shard_0'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        connections.ensure_defaults('shard_0')
+        connections.prepare_test_settings('shard_0')
+        self.addCleanup(self.remove_alias, 'shard_0')
+        with mock.patch.object(replica_health, 'check', return_value=True):
+            for method, read_db in (('get', 'shard_0_replica_0'), ('patch', 'shard_0')):
+                token = bind_state(getattr(self.factory, method)('/api/users/'))
+                try:
+                    with use_shard('shard_0'):
+                        self.assertEqual(router.db_for_read(User), read_db)
+                        self.assertEqual(router.db_for_write(User), 'shard_0')
+                    user = User(id=1)
+                    user._state.db = 'shard_0_replica_0'
+                    self.assertEqual(router.db_for_read(User, instance=user), read_db)
+                    self.assertEqual(router.db_for_write(User, instance=user), 'shard_0')
+                    self.assertEqual(router.db_for_write(Group, instance=user), 'shard_0')
+                finally:
+                    unbind_state(token)
+
+    def test_replica_health(self):
+        """
+        Unhealthy replicas are skipped, fallback to primary if none is left
+        """
+        with mock.patch.object(replica_health, 'check',
+                               side_effect=lambda alias: alias == 'replica_1'):
+            self.assertEqual(self.route('get')[0], 'replica_1')
+
+        replica_health.mark_down('replica_1')
+        self.assertIsNone(self.route('get')[0])
+
+    def test_sqlite_replicas(self):
+        """
+        Reads of a safe request are served by one of two SQLite replicas,
+        the other one when it is down
+        """
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.add_replicas(*(os.path.join(tmp.name, alias + '.sqlite3') for alias in self.aliases))
+        for alias in self.aliases:
+            with connections[alias].schema_editor() as editor:
+                editor.create_model(Organization)
+                editor.create_model(User)
+            User.objects.using(alias).bulk_create([User(email='%s@test.org' % alias)])
+
+        def read(user=None):
+            request = self.factory.get('/api/users/')
+            request.user = user or User(id=999, email='pinned@test.org')
+            token = bind_state(request)
+            try:
+                return [User.objects.values_list('email', flat=True).get()
+                        for _ in range(3)]
+            finally:
+                unbind_state(token)
+
+        emails = read()
+        self.assertIn(emails[0], ['replica_0@test.org', 'replica_1@test.org'])
+        self.assertEqual(emails, emails[:1] * 3)
+        down, up = ('replica_0', 'replica_1') if emails[0].startswith('replica_0') \
+            else ('replica_1', 'replica_0')
+        connections[down].close()
+        connections.databases[down]['NAME'] = os.path.join(tmp.name, 'missing', 'down.sqlite3')
+        replica_health.reset()
+        self.assertEqual(read(), ['%s@test.org' % up] * 3)
+        self.assertFalse(replica_health.is_healthy(down))
+
+        user = User(id=999, email='pinned@test.org')
+        response = HttpResponse()
+        pin_user(user, response)
+        self.factory.cookies = response.cookies
+        self.assertEqual(self.route('get', user), (None, None))
+
+
+class ShardingTests(APITestCase):
+    shards = ('shard_0', 'shard_1')
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.template = os.path.join(cls.tmp.name, 'template.sqlite3')
+        cls.add_alias('shard_template', cls.template)
+        call_command('migrate', database='shard_template', verbosity=0)
+        cls.remove_alias('shard_template')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+        super().tearDownClass()
+
+    @staticmethod
+    def add_alias(alias, path):
+        connections.databases[alias] = {'ENGINE': 'project.sqlite3', 'NAME': path}
+        connections.ensure_defaults(alias)
+        connections.prepare_test_settings(alias)
+
+    @staticmethod
+    def remove_alias(alias):
+        if hasattr(connections._connections, alias):
+            connections[alias].close()
+            del connections[alias]
+        connections.databases.pop(alias, None)
+
+    def setUp(self):
+        for alias in self.shards:
+            path = os.path.join(self.tmp.name, alias + '.sqlite3')
+            shutil.copy(self.template, path)
+            self.add_alias(alias, path)
+            self.addCleanup(self.remove_alias, alias)
+        self.admin_group = Group.objects.get(name='Administrator')
+        placements.invalidate()
+        self.addCleanup(placements.invalidate)
+
+    def sharded(self):
+        return override_settings(USER_SHARDS=list(self.shards), SHARD_PLACEMENT_TTL=0)
+
+    def create_admin(self, email, organization):
+        user = User.objects.create_user(email=email, password='12345', name='Admin',
+                                        organization=organization)
+        user.groups.add(self.admin_group)
+        return user
+
+    def locate(self, pk):
+        return [alias for alias in ('default', *self.shards)
+                if User.objects.using(alias).filter(pk=pk).exists()]
+
+    def test_shard_groups(self):
+        """
+        Shards migrated later get the groups and permissions of the default
+        database with their ids
+        """
+        Group.objects.filter(name='Viewer').delete()
+        viewer = Group.objects.create(name='Viewer')
+        viewer.permissions.set(Permission.objects.filter(codename='view_user'))
+        self.add_alias('shard_late', os.path.join(self.tmp.name, 'late.sqlite3'))
+        self.addCleanup(self.remove_alias, 'shard_late')
+        call_command('migrate', database='shard_late', verbosity=0)
+
+        for queryset in (Group.objects.values_list('pk', 'name'),
+                         Permission.objects.values_list('pk', 'codename', 'content_type_id'),
+                         Group.permissions.through.objects.values_list('group_id', 'permission_id')):
+            self.assertEqual(set(queryset.using('shard_late')), set(queryset))
+        self.assertEqual(Group.objects.using('shard_late').get(name='Viewer').pk, viewer.pk)
+
+    def test_sharded_users(self):
+        """
+        Users live on the shard of their organization, logins and email
+        uniqueness go through the directory
+        """
+        with self.sharded():
+            organization = Organization.objects.create(name='Sharded')
+            self.assertEqual(organization.shard, hash_shard(organization.pk))
+            self.assertTrue(Organization.objects.using(organization.shard)
+                            .filter(pk=organization.pk).exists())
+            admin = self.create_admin('Admin@shard.org', organization)
+            self.assertEqual(self.locate(admin.pk), [organization.shard])
+            self.assertEqual(UserDirectory.objects.get(pk=admin.pk).shard, organization.shard)
+
+            response = self.client.post('/api/auth/login/', {
+                'email': 'admin@shard.org', 'password': '12345'})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + response.data['access'])
+
+            response = self.client.post('/api/users/', {
+                'email': 'new@shard.org', 'password': 'New-pass-2024', 'name': 'New'})
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(self.locate(response.data['id']), [organization.shard])
+            response = self.client.post('/api/users/', {
+                'email': 'NEW@shard.org', 'password': 'New-pass-2024', 'name': 'Again'})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            response = self.client.get('/api/organizations/%d/users/' % organization.pk)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual({user['name'] for user in response.data['results']},
+                             {'Admin', 'New'})
+
+            # a user moving to another organization moves to its shard
+            user = User.objects.get_by_natural_key('new@shard.org')
+            other = Organization.objects.create(name='Other')
+            while other.shard == organization.shard:
+                other = Organization.objects.create(name='Other')
+            user.organization = other
+            user.save()
+            self.assertEqual(self.locate(user.pk), [other.shard])
+            self.assertEqual(User.objects.get_by_natural_key('new@shard.org').organization, other)
+
+            user.delete()
+            self.assertFalse(UserDirectory.objects.filter(pk=user.pk).exists())
+
+    def test_failed_save(self):
+        """
+        A failed save rolls back its directory entry and the move of the user
+        """
+        with self.sharded():
+            organization = Organization.objects.create(name='Sharded')
+            other = Organization.objects.create(name='Other')
+            while other.shard == organization.shard:
+                other = Organization.objects.create(name='Other')
+            admin = self.create_admin('admin@shard.org', organization)
+
+            user = User(email='new@shard.org', name='New', organization=organization)
+            with mock.patch.object(User, 'save_base', side_effect=OperationalError):
+                with self.assertRaises(OperationalError):
+                    user.save()
+                self.assertIsNone(user.pk)
+                self.assertFalse(UserDirectory.objects.filter(email_key='new@shard.org').exists())
+
+                admin.organization = other
+                with self.assertRaises(OperationalError):
+                    admin.save()
+            self.assertEqual(admin._state.db, organization.shard)
+            self.assertEqual(self.locate(admin.pk), [organization.shard])
+            self.assertEqual(UserDirectory.objects.get(pk=admin.pk).shard, organization.shard)
+            self.assertTrue(User.groups.through.objects.using(organization.shard)
+                            .filter(user_id=admin.pk).exists())
+
+            user.save()
+            self.assertEqual(self.locate(user.pk), [organization.shard])
+
+    def test_rebalance_catch_up(self):
+        """
+        Moves copy the writes made meanwhile and can be run again after a crash
+        """
+        organization = Organization.objects.create(name='Legacy')
+        admin = self.create_admin('admin@legacy.org', organization)
+        users = [User.objects.create_user(email='user%d@legacy.org' % i, password='12345',
+                                          organization=organization) for i in range(4)]
+        deleted = users[1].pk
+
+        with self.sharded():
+            # ids allocated by the directory start above the listed ones
+            point_directory([admin.pk] + [user.pk for user in users], 'default')
+            target = hash_shard(organization.pk)
+            # left behind by an interrupted move
+            copy_users([admin.pk, users[0].pk], 'default', target)
+
+            def write(count):
+                if count == 2:
+                    users[0].name = 'Renamed'
+                    users[0].save()
+                    users[1].delete()
+                    User.objects.create_user(email='late@legacy.org', password='12345',
+                                             organization=organization)
+
+            moved = move_organization(organization, target, batch_size=2, wait=0, progress=write)
+            self.assertEqual(moved, 5)
+            self.assertFalse(User.objects.using('default').filter(
+                organization=organization).exists())
+            self.assertEqual(User.objects.using(target).get(pk=users[0].pk).name, 'Renamed')
+            self.assertFalse(User.objects.using(target).filter(pk=deleted).exists())
+            late = User.objects.using(target).get(email_key='late@legacy.org')
+            self.assertEqual(UserDirectory.objects.get(pk=late.pk).shard, target)
+            self.assertTrue(User.groups.through.objects.using(target)
+                            .filter(user_id=admin.pk).exists())
+            self.assertEqual(Tombstone.objects.using(target).filter(
+                organization_id=organization.pk, object_id=deleted).count(), 1)
+
+    def test_rebalance(self):
+        """
+        rebalance_shards moves organizations and their users between databases
+        """
+        organization = Organization.objects.create(name='Legacy')
+        admin = self.create_admin('admin@legacy.org', organization)
+        self.assertEqual(self.locate(admin.pk), ['default'])
+
+        with self.sharded():
+            target = hash_shard(organization.pk)
+            out = StringIO()
+            call_command('rebalance_shards', dry_run=True, stdout=out)
+            self.assertIn('default -> %s' % target, out.getvalue())
+            self.assertEqual(self.locate(admin.pk), ['default'])
+
+            call_command('rebalance_shards', wait=0, stdout=StringIO())
+            self.assertEqual(self.locate(admin.pk), [target])
+            organization.refresh_from_db()
+            self.assertEqual(organization.shard, target)
+            self.assertEqual(UserDirectory.objects.get(pk=admin.pk).shard, target)
+
+            other = next(alias for alias in self.shards if alias != target)
+            call_command('rebalance_shards', organization=organization.pk, to=other, wait=0,
+                         stdout=StringIO())
+            self.assertEqual(self.locate(admin.pk), [other])
+
+            self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + get_token(admin))
+            response = self.client.get('/api/organizations/%d/users/' % organization.pk)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['count'], 1)
+            self.assertFalse(Tombstone.objects.using(other).exists())
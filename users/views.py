@@ -1,4 +1,5 @@
 from django.contrib.auth.models import Group
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import (
     viewsets,
@@ -8,9 +9,26 @@ from rest_framework import (
     views
 )
 from rest_framework.compat import coreapi
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
+from jobs.queue import enqueue
+from jobs.views import accepted
+from project.profiling import ProfilingMixin
+from project.renderers import JSONRenderer, TimedSerializerMixin
+
+from .constants import (
+    CHANGES_PAGE_SIZE,
+    CHANGES_MAX_PAGE_SIZE,
+    EXPORT_BATCH_SIZE
+)
+from .events import StreamTicket
+from .mixins import SparseFieldsetMixin
 from .models import User, Organization
+from .registry import group_registry
+from .stats import get_stats
+from .sync import get_changes
 from .permissions import (
     OrgPermissions,
     UserPermissions,
@@ -21,20 +39,30 @@ from .serializers import (
     UserDefaultSerializer,
     UserInfoSerializer,
     UserCreateSerializer,
+    UserGroupsSerializer,
     UserOrgSerializer,
     OrganizationSerializer
 )
 
 
-class GroupList(generics.ListAPIView):
+class GroupList(ProfilingMixin, generics.ListAPIView):
     """
     A generic List API for viewing Authentication Groups.
+    Groups are served from the process local `group_registry`.
     """
     queryset = Group.objects.all()
     serializer_class = GroupSerializer
+    filter_backends = []
 
+    def list(self, request, *args, **kwargs):
+        groups = group_registry.groups()
+        page = self.paginate_queryset(groups)
+        if page is not None:
+            return self.get_paginated_response(page)
+        return Response(groups)
 
-class InfoAPIView(views.APIView):
+
+class InfoAPIView(ProfilingMixin, views.APIView):
     """
     API for viewing user and server info.
     """
@@ -52,7 +80,10 @@ class InfoAPIView(views.APIView):
         })
 
 
-class OrganizationViewSet(mixins.RetrieveModelMixin,
+class OrganizationViewSet(ProfilingMixin,
+                          TimedSerializerMixin,
+                          SparseFieldsetMixin,
+                          mixins.RetrieveModelMixin,
                           mixins.UpdateModelMixin,
                           viewsets.GenericViewSet):
     """
@@ -61,12 +92,57 @@ class OrganizationViewSet(mixins.RetrieveModelMixin,
     serializer_class = OrganizationSerializer
     queryset = Organization.objects.all()
     permission_classes = [OrgPermissions, ]
-    http_method_names = ['get', 'patch', 'options', 'head']
+    http_method_names = ['get', 'post', 'patch', 'options', 'head']
     ordering_fields = []
     ordering = []
 
+    def get_queryset(self):
+        return self.sparse_queryset(Organization.tenant_objects.all())
+
+    @action(detail=True, methods=['get'])
+    def changes(self, request, pk=None):
+        """
+        GET users and organization changes after the `since` sync token,
+        oldest first. Pass the returned `next` token as `since` of the
+        following call, `has_more` tells if more changes are waiting.
+        """
+        organization = self.get_object()
+        try:
+            since = int(request.query_params.get('since', 0))
+            limit = int(request.query_params.get('limit', CHANGES_PAGE_SIZE))
+        except ValueError:
+            raise ValidationError('since and limit must be integers')
+        limit = max(1, min(limit, CHANGES_MAX_PAGE_SIZE))
+
+        changes, next_token, has_more = get_changes(organization, since, limit)
+        return Response({
+            'next': next_token,
+            'has_more': has_more,
+            'results': changes
+        })
+
+    @action(detail=True, methods=['get'])
+    def stats(self, request, pk=None):
+        """
+        GET user statistics of the organization: users, active and inactive
+        ones, signups by month of `date_joined`, age bands from `birthdate`
+        and the role mix. Read from rollups, whatever the organization size.
+        """
+        organization = self.get_object()
+        return Response(get_stats(organization.pk))
+
+    @action(detail=True, methods=['post'], url_path='events/ticket')
+    def events_ticket(self, request, pk=None):
+        """
+        POST for a ticket opening the event stream of the organization at
+        `/api/organizations/{id}/events/?ticket=`, for `EVENTS_TICKET_SECONDS`.
+        """
+        organization = self.get_object()
+        return Response({'ticket': str(StreamTicket.for_organization(request.user, organization.pk))})
+
 
-class UserOrganizationViewSet(viewsets.ReadOnlyModelViewSet):
+class UserOrganizationViewSet(ProfilingMixin, TimedSerializerMixin, SparseFieldsetMixin,
+                              viewsets.ReadOnlyModelViewSet):
     """
     A viewset for viewing users org instances.
     """
@@ -78,14 +154,36 @@ class UserOrganizationViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         pk = self.kwargs.get('org_id')
-        try:
-            org = Organization.objects.get(pk=pk)
-            return User.objects.filter(organization=org)
-        except Organization.DoesNotExist:
-            return User.objects.none()
-
-
-class UserViewSet(viewsets.ModelViewSet):
+        return self.sparse_queryset(User.tenant_objects.filter(organization_id=pk))
+
+    def export_batches(self, queryset):
+        last = 0
+        while True:
+            batch = list(queryset.filter(pk__gt=last).order_by('pk')[:EXPORT_BATCH_SIZE])
+            if not batch:
+                return
+            last = batch[-1].pk
+            yield self.get_serializer(batch, many=True).data
+
+    @action(detail=False, methods=['get'])
+    def export(self, request, org_id=None):
+        """
+        GET every user of the organization streamed in the negotiated format,
+        read in batches by id. JSON is a single array, MessagePack a sequence
+        of objects. Supports `?fields=`.
+        """
+        renderer = request.accepted_renderer
+        if not hasattr(renderer, 'render_stream'):
+            renderer = JSONRenderer()
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type += '; charset=%s' % renderer.charset
+        batches = self.export_batches(self.get_queryset())
+        return StreamingHttpResponse(renderer.render_stream(batches), content_type=content_type)
+
+
+class UserViewSet(ProfilingMixin, TimedSerializerMixin, SparseFieldsetMixin,
+                  viewsets.ModelViewSet):
     """
     A viewset for viewing and editing user instances.
     """
@@ -98,17 +196,21 @@ class UserViewSet(viewsets.ModelViewSet):
     search_fields = ['name', 'email']
     ordering_fields = []
     ordering = []
+    expandable_fields = ('organization',)
+    select_related_fields = {'organization': ('id', 'name')}
+    prefetch_related_fields = ('groups', 'user_permissions')
 
     def get_serializer_class(self):
         if self.action == 'list':
             return UserDefaultSerializer
         if self.action == 'create':
             return UserCreateSerializer
+        if self.action == 'groups':
+            return UserGroupsSerializer
         return UserInfoSerializer
 
     def get_queryset(self):
-        org = self.request.user.organization
-        return User.objects.filter(organization=org)
+        return self.sparse_queryset(User.tenant_objects.all())
 
     def create(self, request):
         """
@@ -121,3 +223,18 @@ class UserViewSet(viewsets.ModelViewSet):
 
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+    @action(detail=False, methods=['post'])
+    def groups(self, request):
+        """
+        Set the `groups` of the `users` of the organization in the background.
+        Request user must be `Administrator`, answers 202 with the job at
+        `/api/jobs/{id}/`.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        users = serializer.validated_data['users']
+        job = enqueue('users.assign_groups', user=request.user,
+                      organization_id=request.user.organization_id, total=len(users),
+                      users=users, groups=[group.pk for group in serializer.validated_data['groups']])
+        return accepted(request, job)